@@ -19,14 +19,19 @@
 #
 from __future__ import division
 
+import bisect
 import collections
 import copy
 import json
 import logging
+import numpy as np
 from crush.libcrush import LibCrush
+from crush.libcrush import ITEM_NONE  # noqa re-exported for map_batch
 
 log = logging.getLogger(__name__)
 
+STRAW2_CACHE_BUDGET = 128 * 1024 * 1024
+
 
 class Crush(object):
     """Control object placement in a hierarchy.
@@ -102,6 +107,19 @@ class Crush(object):
             [ "set_chooseleaf_vary_r", 0 or 1 ]
             [ "set_chooseleaf_stable", 0 or 1 ]
 
+    **Pickling**
+
+    A Crush object can be pickled, for instance to send it to
+    multiprocessing workers. The parsed map is pickled with a binary
+    encoding of its buckets, rules, tunables, choose_args and names:
+    unpickling rebuilds a map that is ready for mapping without
+    parsing the crushmap again. The encoding is only meant to be
+    unpickled on a host with the same byte order and the same version
+    of the module. Weights, choose_args and straw2 caches compiled
+    with compile_weights(), compile_choose_args() and
+    compile_straw2_cache() cannot be pickled and must be compiled
+    again.
+
     """
 
     def __init__(self, verbose=False, backward_compatibility=False):
@@ -118,8 +136,9 @@ class Crush(object):
         """
         self.c = LibCrush(verbose=verbose and 1 or 0,
                           backward_compatibility=backward_compatibility and 1 or 0)
+        self._info_crushmap = None
 
-    def parse(self, something):
+    def parse(self, something, copy_crushmap=True):
         """Validate and parse `something` which can be one of the
         following:
 
@@ -132,14 +151,31 @@ class Crush(object):
           crushmap compatible with Luminuous and below
 
         The details of the validation and parsing are documented
-        in the parse_crushmap() method.
+        in the parse_crushmap() method, including the meaning of
+        `copy_crushmap`. A crushmap read from a file or converted from
+        the Ceph format is never copied since nobody else has a
+        reference to it.
 
         """
-        return self.parse_crushmap(self._convert_to_crushmap(something))
+        crushmap = self._convert_to_crushmap(something)
+        return self.parse_crushmap(crushmap,
+                                   copy_crushmap=copy_crushmap and crushmap is something)
 
-    def parse_crushmap(self, crushmap):
+    def parse_crushmap(self, crushmap, copy_crushmap=True):
         """Validate and parse the `crushmap` object.
 
+        If `copy_crushmap` is True (the default), a deep copy of the
+        `crushmap` is made and the `crushmap` is not modified. If it
+        is False, the `crushmap` is owned by the Crush object from
+        now on, which saves the time and memory of the copy for large
+        crushmaps: the ids of the buckets that do not have one are set
+        in the `crushmap` and it is modified by the methods that modify
+        the crushmap returned by **get_crushmap()**, such as
+        **filter()** or **add_item()**. The caller must not modify it
+        afterwards, unless **parse()** is called again. It is always
+        safe to parse the result of **get_crushmap()** without a copy,
+        after modifying it.
+
         The `crushmap` is a hierarchical description of devices in
         which objects can be stored and rules to place the objects.
         It is verified to obey the specifications below. An exception
@@ -521,12 +557,14 @@ class Crush(object):
           documentation for more information.
 
         """
-        self.crushmap = copy.deepcopy(crushmap)
+        if copy_crushmap:
+            crushmap = copy.deepcopy(crushmap)
+        self.crushmap = crushmap
         self.c.parse(self.crushmap)
         self._update_info()
         return True
 
-    def map(self, rule, value, replication_count, weights=None, choose_args=None):
+    def map(self, rule, value, replication_count, weights=None, choose_args=None, ids=False):
         """Map an object to a list of devices.
 
         The **rule** is used to map the **value** (representing an
@@ -599,11 +637,18 @@ class Crush(object):
         - **replication_count**: the desired number of devices
             (required positive integer)
 
-        - **weights**: map of name to weight float (optional, default to None)
+        - **weights**: map of name to weight float, array of float
+            indexed by device id or the result of **compile_weights()**
+            (optional, default to None)
 
-        - **choose_args**: name to lookup in the map or a list (optional, default to None)
+        - **choose_args**: name to lookup in the map, a list or the
+            result of **compile_choose_args()** (optional, default to None)
 
-        Return a list of device names.
+        - **ids**: if True return device ids instead of device names
+            and **crush.ITEM_NONE** instead of None (optional, default
+            to False)
+
+        Return a list of device names or ids.
 
         """
         kwargs = {
@@ -611,12 +656,719 @@ class Crush(object):
             "value": value,
             "replication_count": replication_count,
         }
-        if weights:
-            kwargs["weights"] = weights
+        if ids:
+            kwargs["ids"] = 1
+        if weights is not None:
+            kwargs["weights"] = self._compiled_weights(weights)
         if choose_args:
             kwargs["choose_args"] = choose_args
         return self.c.map(**kwargs)
 
+    def prepare(self, rule, replication_count, weights=None, choose_args=None, ids=False):
+        """Resolve the arguments of **map()** once and return a mapper.
+
+        The mapper is a callable that takes a value and returns the
+        same list as **map()** called with the same **rule**,
+        **replication_count**, **weights**, **choose_args** and
+        **ids**. The rule is looked up and the **weights** and
+        **choose_args** are compiled when the mapper is created so
+        that calling it for one value costs little more than the
+        mapping itself. For instance::
+
+            mapper = c.prepare("data", 3, weights={ "device0": 0.50 })
+            for value in range(1000000):
+                mapper(value)
+
+        The mapper is only valid until **parse()** is called again or
+        an item is added to or removed from a bucket.
+
+        - **rule**: the rule name (required string)
+
+        - **replication_count**: the desired number of devices
+            (required positive integer)
+
+        - **weights**: as in **map()** or an array of float indexed
+            by device id (optional, default to None)
+
+        - **choose_args**: as in **map()** (optional, default to None)
+
+        - **ids**: as in **map()** (optional, default to False)
+
+        Return a callable.
+
+        """
+        kwargs = {
+            "rule": rule,
+            "replication_count": replication_count,
+        }
+        if ids:
+            kwargs["ids"] = 1
+        if weights is not None:
+            if isinstance(weights, (list, tuple, np.ndarray)):
+                weights = np.ascontiguousarray(weights, dtype=np.float64)
+            kwargs["weights"] = weights
+        if choose_args:
+            kwargs["choose_args"] = choose_args
+        return self.c.prepare(**kwargs)
+
+    def map_batch(self, rule, values, replication_count, weights=None, choose_args=None,
+                  threads=1, straw2_cache=None, stats=None):
+        """Map a batch of objects to device ids.
+
+        Each element of **values** is mapped as if by **map()** and the
+        result is a numpy array of int32 with one row per value and
+        **replication_count** columns. The mapping is done in a single
+        call to libcrush and is much faster than calling **map()** for
+        each value.
+
+        The array contains device ids instead of device names. If a
+        mapping fails, the missing devices are replaced by
+        **crush.ITEM_NONE**. For instance, if asking for 3 replicas,
+        the row of a failed mapping could be::
+
+            [ 1, 5, ITEM_NONE ] # 2 instead of 3
+            [ 8, ITEM_NONE, 0 ] # second device is missing
+
+        - **rule**: the rule name (required string)
+
+        - **values**: the numbers to map (required range, list or
+            int32 buffer such as a numpy array)
+
+        - **replication_count**: the desired number of devices
+            (required positive integer)
+
+        - **weights**: map of name to weight float, array of float
+            indexed by device id or the result of **compile_weights()**
+            (optional, default to None)
+
+        - **choose_args**: name to lookup in the map, a list or the
+            result of **compile_choose_args()** (optional, default to None)
+
+        - **threads**: the number of native threads mapping the values
+            in parallel, without holding the Python global interpreter
+            lock (optional positive integer, default to 1)
+
+        - **straw2_cache**: the result of **compile_straw2_cache()**
+            for the same **values** (optional, default to None)
+
+        - **stats**: a dict in which the choices made while mapping
+            are counted (optional, default to None). It is set with:
+
+            - **tries**: the number of descents from the bucket of a
+              choose step, including those that are retried
+
+            - **local_retries**: the number of choices retried in the
+              same bucket
+
+            - **rejects**: the number of devices rejected because
+              they are out, as set by **weights**
+
+            - **collisions**: the number of items rejected because they
+              were already chosen
+
+            - **choose_tries**: a numpy array of int64 with the number
+              of items chosen after N failed descents, indexed by N
+
+            - **bucket_collisions**: a numpy array of int64 with the
+              number of collisions in each bucket, indexed by -1 - id
+              as the buckets returned by **histogram()**
+
+            Mappings that retry often are slower and the distribution
+            of their values differs from the weights. Counting has no
+            cost when **stats** is None.
+
+        Return a numpy array of shape (len(values), replication_count).
+
+        """
+        kwargs = {
+            "rule": rule,
+            "values": values,
+            "replication_count": replication_count,
+            "threads": threads,
+        }
+        if weights is not None:
+            kwargs["weights"] = self._compiled_weights(weights)
+        if choose_args:
+            kwargs["choose_args"] = choose_args
+        if straw2_cache is not None:
+            kwargs["straw2_cache"] = straw2_cache
+        if stats is not None:
+            kwargs["stats"] = stats
+        mapped = self.c.map_batch(**kwargs)
+        Crush._convert_stats(stats)
+        return np.frombuffer(mapped, dtype=np.int32).reshape(-1, replication_count)
+
+    def histogram(self, rule, values, replication_count, weights=None, choose_args=None,
+                  threads=1, straw2_cache=None, stats=None):
+        """Count how many times each item is mapped by **map_batch()**.
+
+        The values are mapped as by **map_batch()** but, instead of
+        returning the devices, the number of times each device is
+        mapped is counted. The count of a bucket is the sum of the
+        counts of its children. For instance, a host containing two
+        devices respectively mapped 10 and 20 times has a count of
+        30.
+
+        The arguments are the same as for **map_batch()**.
+
+        Return a tuple with three elements:
+
+        - a numpy array of int64 with the count of each device, indexed
+          by device id
+
+        - a numpy array of int64 with the count of each bucket, indexed
+          by -1-id, i.e. the count of bucket -1 is at index 0, the count
+          of bucket -2 is at index 1 etc.
+
+        - the number of values that were not mapped to exactly
+          **replication_count** devices
+
+        """
+        kwargs = {
+            "rule": rule,
+            "values": values,
+            "replication_count": replication_count,
+            "threads": threads,
+        }
+        if weights is not None:
+            kwargs["weights"] = self._compiled_weights(weights)
+        if choose_args:
+            kwargs["choose_args"] = choose_args
+        if straw2_cache is not None:
+            kwargs["straw2_cache"] = straw2_cache
+        if stats is not None:
+            kwargs["stats"] = stats
+        (devices, buckets, failed) = self.c.histogram(**kwargs)
+        Crush._convert_stats(stats)
+        return (np.frombuffer(devices, dtype=np.int64),
+                np.frombuffer(buckets, dtype=np.int64),
+                failed)
+
+    @staticmethod
+    def _convert_stats(stats):
+        if stats is None:
+            return
+        for key in ("choose_tries", "bucket_collisions"):
+            stats[key] = np.frombuffer(stats[key], dtype=np.int64)
+
+    def map_record(self, rule, values, replication_count, weights=None, choose_args=None,
+                   threads=1, straw2_cache=None, stats=None):
+        """Map **values** as **map_batch()** and record the buckets and
+        the items each mapping depends on.
+
+        The mapping of a value depends on the buckets it chooses from
+        and the items it chooses, including the items rejected because
+        they are out or because they collide with an item already
+        chosen. If the weights, the items or the weight_set of a bucket
+        change, only the values that chose from this bucket can be
+        mapped differently. If an item is removed from a straw2 bucket
+        and the weights of the other items do not change, only the
+        values that chose this item can be mapped differently. The
+        **remap()** method maps these values again and copies the
+        mapping of the others. For instance::
+
+            mapping = c.map_record("data", values, 3)
+            # change the weight_set of host1 and parse() again
+            mapping = c.remap(mapping, [c.get_item_by_name("host1")["id"]])
+
+        The arguments are the same as for **map_batch()**.
+
+        Return an opaque object to be used with **remap()**,
+        **mapping_results()** or **mapping_histogram()**.
+
+        """
+        kwargs = {
+            "rule": rule,
+            "values": values,
+            "replication_count": replication_count,
+            "threads": threads,
+        }
+        if weights is not None:
+            kwargs["weights"] = self._compiled_weights(weights)
+        if choose_args:
+            kwargs["choose_args"] = choose_args
+        if straw2_cache is not None:
+            kwargs["straw2_cache"] = straw2_cache
+        if stats is not None:
+            kwargs["stats"] = stats
+        mapping = self.c.map_record(**kwargs)
+        Crush._convert_stats(stats)
+        return mapping
+
+    def remap(self, mapping, changed, weights=None, choose_args=None, threads=1,
+              straw2_cache=None, stats=None):
+        """Map again the values of **mapping** that depend on the
+        **changed** ids, with this crushmap.
+
+        The **mapping** is the result of **map_record()** or
+        **remap()**, with this crushmap or another crushmap in which
+        the ids of the buckets and devices are the same. The values
+        which mapping chose from one of the **changed** bucket ids or
+        chose one of the **changed** item ids are mapped with the same
+        rule and replication count. The mapping of the other values is
+        copied: it is the responsibility of the caller to list all the
+        ids that changed. The **mapping** is not modified.
+
+        - **mapping**: the result of **map_record()** or **remap()**
+            (required)
+
+        - **changed**: a list of bucket or device ids (required)
+
+        - **weights**, **choose_args**, **threads**,
+            **straw2_cache** and **stats**: as in **map_batch()**
+
+        Return an opaque object, like **map_record()**.
+
+        """
+        kwargs = {
+            "mapping": mapping,
+            "changed": changed,
+            "threads": threads,
+        }
+        if weights is not None:
+            kwargs["weights"] = self._compiled_weights(weights)
+        if choose_args:
+            kwargs["choose_args"] = choose_args
+        if straw2_cache is not None:
+            kwargs["straw2_cache"] = straw2_cache
+        if stats is not None:
+            kwargs["stats"] = stats
+        mapping = self.c.remap(**kwargs)
+        Crush._convert_stats(stats)
+        return mapping
+
+    def mapping_results(self, mapping):
+        """Return the devices of a **mapping** recorded by
+        **map_record()** or **remap()** as a numpy array of shape
+        (len(values), replication_count), like **map_batch()**.
+
+        """
+        mapped = self.c.mapping_results(mapping)
+        replication_count = self.c.mapping_info(mapping)["replication_count"]
+        return np.frombuffer(mapped, dtype=np.int32).reshape(-1, replication_count)
+
+    def mapping_histogram(self, mapping):
+        """Count how many times each item is mapped by a **mapping**
+        recorded by **map_record()** or **remap()**. The counts of the
+        buckets are computed with this crushmap. The result is the
+        same as **histogram()**.
+
+        """
+        (devices, buckets, failed) = self.c.mapping_histogram(mapping)
+        return (np.frombuffer(devices, dtype=np.int64),
+                np.frombuffer(buckets, dtype=np.int64),
+                failed)
+
+    def mapping_info(self, mapping):
+        """Return a dict describing a **mapping** recorded by
+        **map_record()** or **remap()**: the **rule**, the
+        **replication_count**, the number of **values**, the number of
+        **ids** recorded, the number of values for which some ids could
+        not be recorded (**overflow**, they are always mapped again by
+        **remap()**) and the number of values **remapped** by the
+        **remap()** that returned the mapping.
+
+        """
+        return self.c.mapping_info(mapping)
+
+    def movement(self, rule, values, replication_count, destination=None,
+                 weights=None, choose_args=None,
+                 destination_weights=None, destination_choose_args=None,
+                 order_matters=False, threads=1):
+        """Count the items moving from one mapping to another.
+
+        The **values** are mapped with **map_batch()** by this crushmap
+        (the origin) and by the **destination** crushmap. The
+        destination can be the same crushmap, with different weights or
+        choose_args. The items in the origin mapping of a value that
+        are not in its destination mapping move to the items that are
+        not in the origin mapping. For instance::
+
+            [ "device1", "device2", "device3" ] # origin
+            [ "device4", "device2", "device5" ] # destination
+
+        moves one value from device1 to device4 and one value from
+        device3 to device5. If **order_matters** is True, which is
+        the case with erasure coded pools, an item moves if the item
+        at the same position differs. For instance::
+
+            [ "device1", "device2", "device3" ] # origin
+            [ "device1", "device3", "device2" ] # destination
+
+        moves one value from device2 to device3 and one value from
+        device3 to device2 only if **order_matters** is True.
+
+        - **rule**: the rule name (required string)
+
+        - **values**: the numbers to map, as in **map_batch()** (required)
+
+        - **replication_count**: the desired number of devices
+            (required positive integer)
+
+        - **destination**: the destination crushmap (optional Crush,
+            default to self)
+
+        - **weights**, **choose_args**: for the origin mapping, as
+            in **map_batch()** (optional, default to None)
+
+        - **destination_weights**, **destination_choose_args**: for the
+            destination mapping, as in **map_batch()** (optional,
+            default to None)
+
+        - **order_matters**: (optional boolean, default to False)
+
+        - **threads**: as in **map_batch()** (optional, default to 1)
+
+        Return a tuple with three elements:
+
+        - a numpy array of int64 with one row for each (from, to)
+          pair, sorted, and three columns: the id of the item in the
+          origin crushmap, the id of the item in the destination
+          crushmap and the number of values moving from the first to
+          the second
+
+        - the origin mapping, as returned by **map_batch()**
+
+        - the destination mapping, as returned by **map_batch()**
+
+        """
+        if destination is None:
+            destination = self
+        origin_mapped = self.map_batch(rule, values, replication_count, weights,
+                                       choose_args, threads=threads)
+        destination_mapped = destination.map_batch(rule, values, replication_count,
+                                                   destination_weights,
+                                                   destination_choose_args,
+                                                   threads=threads)
+        (moved_from, moved_to, count) = self.c.movement(origin_mapped, destination_mapped,
+                                                        replication_count,
+                                                        1 if order_matters else 0)
+        moved = np.column_stack((np.frombuffer(moved_from, dtype=np.int32),
+                                 np.frombuffer(moved_to, dtype=np.int32),
+                                 np.frombuffer(count, dtype=np.int64)))
+        return (moved, origin_mapped, destination_mapped)
+
+    def items_table(self):
+        """Return the ids of all items in the crushmap, devices and
+        buckets, and their names. It can be used to convert the result
+        of **map_batch()** or of **map(ids=True)** into names in bulk.
+        For instance::
+
+            (ids, names) = c.items_table()
+            mapped = c.map_batch("data", range(100), 3)
+            mapped_names = names[np.searchsorted(ids, mapped)]
+
+        Return a tuple with a numpy array of int32 sorted in ascending
+        order and a numpy array of the corresponding names.
+
+        """
+        (ids, names) = self.c.items_table()
+        return (np.frombuffer(ids, dtype=np.int32), np.array(names, dtype=object))
+
+    def compile_weights(self, weights):
+        """Convert weights once, to be used by many calls to **map()**
+        or **map_batch()**.
+
+        The **weights** are either a dictionary of device names to
+        float, as described in **map()**, or a sequence of floats
+        such as a numpy float32 or float64 array, indexed by device
+        id. The weight of a device that is not in the dictionary or
+        whose id is beyond the end of the array is 1.
+
+        The result is an opaque object that can be used instead of the
+        **weights** dictionary of **map()** or **map_batch()**. It is
+        only valid until **parse()** is called again or an item is
+        added to or removed from a bucket. For instance::
+
+            weights = c.compile_weights({ "device0": 0.50 })
+            for value in range(1000000):
+                c.map("data", value, 3, weights)
+
+        - **weights**: map of name to weight float or array of float
+            indexed by device id (required)
+
+        Return an opaque object.
+
+        """
+        if not isinstance(weights, dict):
+            weights = np.ascontiguousarray(weights, dtype=np.float64)
+        return self.c.compile_weights(weights)
+
+    def _compiled_weights(self, weights):
+        if isinstance(weights, (list, tuple, np.ndarray)):
+            return self.compile_weights(weights)
+        return weights
+
+    def compile_choose_args(self, choose_args):
+        """Convert a **choose_args** list once, to be used by many calls
+        to **map()** or **map_batch()**.
+
+        The **choose_args** list is as described in **parse()**. The
+        result is an opaque object that can be used instead of the
+        **choose_args** list of **map()** or **map_batch()**. It is
+        only valid until **parse()** is called again or an item is
+        added to or removed from a bucket. The weight_set
+        of a bucket can be modified in place with
+        **update_choose_args_weight_set()**.
+
+        - **choose_args**: a list of choose_args_bucket (required)
+
+        Return an opaque object.
+
+        """
+        return self.c.compile_choose_args(choose_args)
+
+    def update_choose_args_weight_set(self, compiled, choose_args_bucket):
+        """Replace the weight_set of a bucket in **compiled**, the result
+        of **compile_choose_args()**. For instance::
+
+            compiled = c.compile_choose_args([
+              { "bucket_name": "host0", "weight_set": [ [ 0x10000, 0x10000 ] ] },
+            ])
+            c.update_choose_args_weight_set(compiled,
+              { "bucket_name": "host0", "weight_set": [ [ 0x20000, 0x10000 ] ] })
+
+        If **compiled** is the name of choose_args of the crushmap,
+        they are modified without calling **parse()** again and the
+        weight_set of the bucket in the crushmap returned by
+        **get_crushmap()** is replaced as well.
+
+        The **choose_args_bucket** is as described in **parse()** but
+        only its weight_set is used. The bucket must be in the list
+        given to **compile_choose_args()** (or in the named
+        choose_args) and the new weight_set cannot have more positions
+        than the largest weight_set in this list. If the
+        **choose_args_bucket** is invalid, **compiled** is not
+        modified.
+
+        - **compiled**: the result of **compile_choose_args()** or the
+            name of choose_args of the crushmap (required)
+
+        - **choose_args_bucket**: the bucket and its new weight_set (required)
+
+        Return True.
+
+        """
+        r = self.c.update_choose_args_weight_set(compiled, choose_args_bucket)
+        if not isinstance(compiled, (str, type(u''))):  # unicode on python 2
+            return r
+        bucket = self._choose_args_bucket(choose_args_bucket)
+        for choose_arg in self.crushmap['choose_args'][compiled]:
+            if self._choose_arg_is(choose_arg, bucket):
+                choose_arg['weight_set'] = copy.deepcopy(choose_args_bucket['weight_set'])
+        return r
+
+    def adjust_item_weight(self, bucket, item, weight):
+        """Change the **weight** of the **item** of a **bucket** in
+        the parsed crushmap, without calling **parse()** again. The
+        weight of the **bucket** in its parents is updated, unless it
+        is set explicitly, and so on up to the root. The crushmap
+        returned by **get_crushmap()** is modified in the same way. For
+        instance::
+
+            c.adjust_item_weight("host0", "device0", 2 * 0x10000)
+
+        The result of **compile_weights()**, **compile_choose_args()**
+        and **prepare()** can still be used afterwards.
+
+        - **bucket**: the name of the bucket (required)
+
+        - **item**: the name of a device or bucket in **bucket** (required)
+
+        - **weight**: the new weight as a Q16.16 int (required)
+
+        Return True.
+
+        """
+        b = self.get_item_by_name(bucket)
+        i = self.get_item_by_name(item)
+        self._propagate_weight(b, self.c.adjust_item_weight(b['id'], i['id'], weight))
+        b['children'][self._child_position(b, i['id'])]['weight'] = weight
+        return True
+
+    def add_item(self, bucket, item):
+        """Add the **item** to the children of a **bucket** in the
+        parsed crushmap, without calling **parse()** again. The weight
+        of the **bucket** in its parents is updated as in
+        **adjust_item_weight()** and the crushmap returned by
+        **get_crushmap()** is modified in the same way. For instance::
+
+            c.add_item("host0", { "id": 10, "name": "device10", "weight": 0x10000 })
+
+        The **item** is a device or a reference to a bucket, as in the
+        **children** of a bucket described in **parse()**. If the
+        **bucket** has a weight_set in **choose_args**, the weight of
+        the **item** is appended to each position; if it has ids, the
+        id of the **item** is appended.
+
+        The result of **compile_weights()**, **compile_choose_args()**
+        and **prepare()** must be created again afterwards.
+
+        - **bucket**: the name of the bucket (required)
+
+        - **item**: a device or a reference (required)
+
+        Return True.
+
+        """
+        b = self.get_item_by_name(bucket)
+        item = copy.deepcopy(item)
+        id = item.get('id', item.get('reference_id'))
+        weight = item.get('weight', 0x10000)
+
+        def change(choose_arg):
+            if 'ids' in choose_arg:
+                choose_arg['ids'].append(id)
+            for weights in choose_arg.get('weight_set', []):
+                weights.append(weight)
+        choose_args = self._choose_args_change(b, change)
+        self._propagate_weight(b, self.c.add_item(b['id'], id, weight,
+                                                  name=item.get('name'),
+                                                  choose_args=choose_args))
+        if choose_args is not None:
+            self.crushmap['choose_args'] = choose_args
+        b.setdefault('children', []).append(item)
+        self._update_info()
+        return True
+
+    def remove_item(self, bucket, item):
+        """Remove the **item** from the children of a **bucket** in
+        the parsed crushmap, without calling **parse()** again. The
+        weight of the **bucket** in its parents is updated as in
+        **adjust_item_weight()** and the crushmap returned by
+        **get_crushmap()** is modified in the same way, including the
+        weight_set and ids of the **bucket** in **choose_args**. For
+        instance::
+
+            c.remove_item("host0", "device0")
+
+        The result of **compile_weights()**, **compile_choose_args()**
+        and **prepare()** must be created again afterwards.
+
+        - **bucket**: the name of the bucket (required)
+
+        - **item**: the name of a device or bucket in **bucket** (required)
+
+        Return True.
+
+        """
+        b = self.get_item_by_name(bucket)
+        i = self.get_item_by_name(item)
+        pos = self._child_position(b, i['id'])
+
+        def change(choose_arg):
+            if 'ids' in choose_arg:
+                del choose_arg['ids'][pos]
+            for weights in choose_arg.get('weight_set', []):
+                del weights[pos]
+        choose_args = self._choose_args_change(b, change)
+        self._propagate_weight(b, self.c.remove_item(b['id'], i['id'],
+                                                     choose_args=choose_args))
+        if choose_args is not None:
+            self.crushmap['choose_args'] = choose_args
+        del b['children'][pos]
+        self._update_info()
+        return True
+
+    @staticmethod
+    def _child_position(bucket, id):
+        for pos, child in enumerate(bucket.get('children', [])):
+            if child.get('id', child.get('reference_id')) == id:
+                return pos
+        raise RuntimeError(str(id) + " is not in bucket " + bucket['name'])
+
+    def _choose_args_bucket(self, choose_args_bucket):
+        if 'bucket_name' in choose_args_bucket:
+            return self.get_item_by_name(choose_args_bucket['bucket_name'])
+        return self.get_item_by_id(choose_args_bucket['bucket_id'])
+
+    @staticmethod
+    def _choose_arg_is(choose_arg, bucket):
+        return (choose_arg.get('bucket_id') == bucket['id'] or
+                choose_arg.get('bucket_name') == bucket['name'])
+
+    def _choose_args_change(self, bucket, change):
+        #
+        # Return a copy of the choose_args of the crushmap where the
+        # choose_args of the bucket are modified by change() or None if
+        # the bucket has no choose_args
+        #
+        choose_args = copy.deepcopy(self.crushmap.get('choose_args', {}))
+        changed = False
+        for name, choose_args_list in choose_args.items():
+            for choose_arg in choose_args_list:
+                if self._choose_arg_is(choose_arg, bucket):
+                    change(choose_arg)
+                    changed = True
+        return choose_args if changed else None
+
+    def _propagate_weight(self, bucket, weight):
+        #
+        # The weight of a bucket in its parents is the sum of the weights
+        # of its children unless it is set explicitly
+        #
+        if 'weight' in bucket:
+            return
+        self._check_info()
+        for parent in self._parents.get(bucket['id'], []):
+            for child in parent.get('children', []):
+                if child.get('reference_id') == bucket['id'] and 'weight' in child:
+                    continue
+                if child.get('id', child.get('reference_id')) == bucket['id']:
+                    self._propagate_weight(
+                        parent, self.c.adjust_item_weight(parent['id'], bucket['id'], weight))
+
+    def compile_straw2_cache(self, values, replication_count, budget=STRAW2_CACHE_BUDGET):
+        """Create a cache of the straw2 hashes of **values**, to be used
+        by many calls to **map_batch()** or **histogram()** with the
+        same **values** and different weights or choose_args.
+
+        The straw2 draw of an item is the logarithm of a hash of the
+        value, the item id and the replica rank, divided by the weight
+        of the item. Only the weights change when the same values are
+        mapped again with other weights or weight_set, for instance
+        when optimizing. The logarithms are computed and kept in the
+        cache the first time a value is mapped and the following
+        mappings only divide them by the current weights. The result
+        is exactly the same as without the cache. For instance::
+
+            values = range(100000)
+            cache = c.compile_straw2_cache(values, 3)
+            for weights in candidates:
+                c.histogram("data", values, 3, weights, straw2_cache=cache)
+
+        The cache keeps a table for each straw2 bucket with at least
+        eight items (hashing fewer items is faster than reading the
+        cache), starting with the buckets closest to the take step of
+        the rule. When the tables do not fit in **budget**, the least
+        recently used table is evicted or the bucket is not cached. A
+        table is dropped if the bucket changes (the ids or the number
+        of items), but not if **parse()** is called again or if the
+        weights change. A replica rank that is greater than
+        **replication_count**, which happens when retrying after a
+        collision or a rejected item, is computed without the cache.
+
+        - **values**: the numbers to map, as in **map_batch()** (required)
+
+        - **replication_count**: the replica ranks to cache (required
+            positive integer)
+
+        - **budget**: the maximum size of the cache, in bytes
+            (optional, default to 128MB)
+
+        Return an opaque object.
+
+        """
+        return self.c.compile_straw2_cache(values, replication_count, budget)
+
+    def straw2_cache_info(self, cache):
+        """Return a dict with the **budget** of the **cache** created
+        by **compile_straw2_cache()**, the number of bytes
+        **allocated** and the ids of the **buckets** that have a table.
+
+        """
+        return self.c.straw2_cache_info(cache)
+
     def _convert_to_crushmap(self, something):
         if type(something) in (dict, collections.OrderedDict):
             return something
@@ -688,7 +1440,8 @@ class Crush(object):
     #
     def get_crushmap(self):
         """
-        Return the original crushmap given to the parse() method.
+        Return the crushmap given to the parse() method, or its copy
+        unless it was parsed with copy_crushmap=False.
 
         The returned crushmap does not contain any reference_id,
         they are replaced by a pointer to the actual bucket. This
@@ -698,23 +1451,72 @@ class Crush(object):
         """
         return self.crushmap
 
-    def _collect_items(self, children):
+    @staticmethod
+    def _bucket_key(bucket):
+        # the id of all buckets or, if they have none, their unique name
+        return bucket.get('id', bucket.get('name'))
+
+    def _collect_items(self, parent, children, count):
         for child in children:
             if 'id' in child:
                 self._name2item[child['name']] = child
                 self._id2item[child['id']] = child
-            self._collect_items(child.get('children', []))
+            if 'name' in child:
+                self._name2first.setdefault(child['name'], child)
+            item = child.get('id', child.get('reference_id'))
+            if item is not None and item >= 0:
+                continue  # a device
+            if parent is not None and item is not None:
+                self._parents[item].append(parent)
+            if 'reference_id' in child:
+                continue
+            first = count
+            count += 1
+            if 'type' in child:
+                self._type2items[child['type']].append(child)
+                self._type2order[child['type']].append(first)
+            if 'children' in child:
+                count = self._collect_items(child, child['children'], count)
+            self._order[Crush._bucket_key(child)] = (first, count - 1)
+        return count
 
     def _update_info(self):
+        #
+        # Index the items of the crushmap by name and by id, the
+        # buckets by type and their parents by bucket id. A depth
+        # first walk of the trees numbers the items: the descendants
+        # of an item are numbered after it and before its next
+        # sibling, which is what find_buckets_by_type() needs.
+        # find_bucket() returns the first item found with a name,
+        # get_item_by_name() the last one.
+        #
+        # The indexes are rebuilt when the crushmap is parsed, when
+        # its trees are modified by filter(), add_item() or
+        # remove_item() and when another crushmap is assigned to
+        # self.crushmap. update_choose_args() does not modify the
+        # trees and the indexes remain valid.
+        #
         self._name2item = {}
         self._id2item = {}
-        trees = self.crushmap.get('trees', [])
-        self._collect_items(trees)
+        self._name2first = {}
+        self._type2items = collections.defaultdict(list)
+        self._type2order = collections.defaultdict(list)
+        self._parents = collections.defaultdict(list)
+        self._order = {}
+        self._collect_items(None, self.crushmap.get('trees', []), 0)
+        self._info_crushmap = self.crushmap
+
+    def _check_info(self):
+        crushmap = self.crushmap
+        if self._info_crushmap is not crushmap:
+            self._update_info()
 
     def get_item_by_id(self, id):
+        self._check_info()
         return self._id2item[id]
 
     def get_item_by_name(self, name):
+        self._check_info()
         return self._name2item[name]
 
     def rule_get_take_failure_domain(self, name):
@@ -731,26 +1533,42 @@ class Crush(object):
         return (take, failure_domain)
 
     def find_bucket(self, name):
-        def walk(children):
-            for child in children:
-                if child.get('name') == name:
-                    return child
-                found = walk(child.get('children', []))
-                if found:
-                    return found
-            return None
-        return walk(self.crushmap.get('trees', []))
+        self._check_info()
+        return self._name2first.get(name)
+
+    def find_buckets_by_type(self, type, root=None):
+        """Return the list of the buckets of the given **type** in the
+        crushmap, in the order they are found when walking the trees
+        depth first. If **root** is set, it must be a bucket of the
+        crushmap, as returned by **find_bucket()**, and only the
+        **root** bucket and its descendants are returned.
+
+        The buckets of each type are indexed when the crushmap is
+        parsed: the cost does not depend on the size of the crushmap
+        but on the number of buckets returned.
+
+        """
+        self._check_info()
+        buckets = self._type2items.get(type, [])
+        if root is None:
+            return list(buckets)
+        if Crush._bucket_key(root) not in self._order:
+            return Crush.collect_buckets_by_type([root], type)
+        (first, last) = self._order[Crush._bucket_key(root)]
+        order = self._type2order.get(type, [])
+        return buckets[bisect.bisect_left(order, first):bisect.bisect_right(order, last)]
 
     @staticmethod
     def collect_buckets_by_type(root, type):
+        found = []
+
         def walk(children):
-            found = []
             for child in children:
                 if child.get('type') == type:
                     found.append(child)
-                found.extend(Crush.collect_buckets_by_type(child.get('children', []), type))
-            return found
-        return walk(root)
+                walk(child.get('children', []))
+        walk(root)
+        return found
 
     def _merge_choose_args(self):
         if 'choose_args' not in self.crushmap:
@@ -800,6 +1618,30 @@ class Crush(object):
             u[choose_arg['bucket_id']] = choose_arg
         self.crushmap['choose_args'][name] = sorted(u.values(), key=lambda v: v['bucket_id'])
 
+    @staticmethod
+    def copy_buckets(crushmap):
+        """Return a copy of the **crushmap** in which the buckets, their
+        children lists and the choose_args are copied but the devices,
+        the rules and the tunables are shared with the **crushmap**.
+        It costs a fraction of a deep copy when there are many devices
+        and is enough to **filter()** and **parse()** the copy without
+        modifying the **crushmap**. Methods that modify the devices,
+        such as **adjust_item_weight()**, must not be used on the copy.
+
+        """
+        def copy_bucket(item):
+            if 'children' not in item:
+                return item
+            bucket = copy.copy(item)
+            bucket['children'] = [copy_bucket(child) for child in item['children']]
+            return bucket
+        result = copy.copy(crushmap)
+        if 'trees' in crushmap:
+            result['trees'] = [copy_bucket(root) for root in crushmap['trees']]
+        if 'choose_args' in crushmap:
+            result['choose_args'] = copy.deepcopy(crushmap['choose_args'])
+        return result
+
     def filter(self, fun, root):
         names = self.crushmap.get('choose_args', {}).keys()
         self._merge_choose_args()
@@ -825,6 +1667,7 @@ class Crush(object):
             for name in names:
                 if name not in self.crushmap['choose_args']:
                     self.crushmap['choose_args'][name] = []
+        self._info_crushmap = None
 
     @staticmethod
     def collect_paths(children, path):
@@ -21,13 +21,12 @@ from __future__ import division
 
 import argparse
 import collections
-import copy
 import logging
 import textwrap
 import pandas as pd
 import numpy as np
 
-from crush import Crush
+from crush import Crush, ITEM_NONE
 
 log = logging.getLogger(__name__)
 
@@ -291,16 +290,46 @@ class Analyze(object):
         d['~over/under filled %~'] = (d['~' + n + '~'] / capacity - 1.0) * 100 - d['~cropped %~']
         return d
 
-    def run_simulation(self, c, root_name, failure_domain):
+    def simulation_weights(self, c):
         if self.args.weights:
             with open(self.args.weights) as f_weights:
-                weights = c.parse_weights_file(f_weights)
+                return c.compile_weights(c.parse_weights_file(f_weights))
         else:
-            weights = None
+            return None
 
-        values = self.main.hook_create_values()
+    def run_simulation(self, c, root_name, failure_domain, straw2_cache=None, mapping=None):
+        #
+        # the weights and the values are not needed to count a
+        # mapping, unless it failed and the culprit must be shown
+        #
+        rule = self.args.rule
         replication_count = self.args.replication_count
-        total_objects = replication_count * len(values)
+        if mapping is not None:
+            (devices, buckets, failed) = c.mapping_histogram(mapping)
+            values_count = c.mapping_info(mapping)['values']
+        else:
+            weights = self.simulation_weights(c)
+            values = self.main.hook_create_value_array()
+            (devices, buckets, failed) = c.histogram(rule, values, replication_count, weights,
+                                                     choose_args=self.args.choose_args,
+                                                     straw2_cache=straw2_cache)
+            values_count = len(values)
+        if failed:
+            if mapping is not None:
+                weights = self.simulation_weights(c)
+                values = self.main.hook_create_value_array()
+                mapped = c.mapping_results(mapping)
+            else:
+                mapped = c.map_batch(rule, values, replication_count, weights,
+                                     choose_args=self.args.choose_args)
+            for i in range(len(values)):
+                if ITEM_NONE in mapped[i]:
+                    value = int(values[i])
+                    m = c.map(rule, value, replication_count, weights,
+                              choose_args=self.args.choose_args)
+                    raise BadMapping("{} mapped to {}".format(value, m))
+
+        total_objects = replication_count * values_count
 
         root = c.find_bucket(root_name)
         log.debug("root = " + str(root))
@@ -309,43 +338,65 @@ class Analyze(object):
         d = Analyze.collect_nweight(d)
         d = Analyze.collect_expected_objects(d, total_objects)
 
-        rule = self.args.rule
-        device2count = collections.defaultdict(lambda: 0)
-        for (name, value) in values.items():
-            m = c.map(rule, value, replication_count, weights, choose_args=self.args.choose_args)
-            if len(m) != replication_count:
-                raise BadMapping("{} mapped to {}".format(value, m))
-            for device in m:
-                device2count[device] += 1
-
-        item2path = c.collect_item2path([root])
-        log.debug("item2path = " + str(item2path))
-        d['~' + self.main.value_name() + '~'] = 0
-        for (device, count) in device2count.items():
-            for item in item2path[device]:
-                d.at[item, '~' + self.main.value_name() + '~'] += count
+        ids = d['~id~'].values
+        is_device = ids >= 0
+        counts = np.zeros(len(ids), dtype=np.int64)
+        counts[is_device] = devices[ids[is_device]]
+        counts[~is_device] = buckets[-1 - ids[~is_device]]
+        d['~' + self.main.value_name() + '~'] = counts
 
         return self.collect_usage(d, total_objects)
 
+    @staticmethod
+    def collect_removed_ids(root, name):
+        """Return the ids of the items and buckets whose removal or
+        change may modify the mapping of a value when the item **name**
+        is removed from the **root** tree. Removing an item from a
+        straw2 bucket only modifies the mapping of the values that
+        chose it. The bucket weights that are not explicitly set change
+        up to the **root**.
+        """
+        def walk(bucket, path):
+            changed = set()
+            path = path + [bucket]
+            for child in bucket.get('children', []):
+                if child.get('name') == name:
+                    changed.add(child['id'])
+                    if bucket.get('algorithm', 'straw2') != 'straw2':
+                        changed.add(bucket['id'])
+                    for (parent, bucket_child) in zip(reversed(path[:-1]), reversed(path[1:])):
+                        if 'weight' in bucket_child:
+                            break
+                        changed.add(parent['id'])
+                else:
+                    changed |= walk(child, path)
+            return changed
+        return sorted(walk(root, []))
+
     def analyze_failures(self, c, take, failure_domain):
         if failure_domain == 0:  # failure domain == device is a border case
             return None
         root = c.find_bucket(take)
         worst = pd.DataFrame()
-        available_buckets = c.collect_buckets_by_type([root], failure_domain)
+        available_buckets = c.find_buckets_by_type(failure_domain, root)
         if len(available_buckets) <= self.args.replication_count:
             log.error("there are not enough " + failure_domain +
                       " to sustain failure")
             return None
+        values = self.main.hook_create_value_array()
+        base = c.map_record(self.args.rule, values, self.args.replication_count,
+                            self.simulation_weights(c), choose_args=self.args.choose_args)
         for may_fail in available_buckets:
+            changed = Analyze.collect_removed_ids(root, may_fail.get('name'))
             f = Crush(verbose=self.args.debug,
                       backward_compatibility=self.args.backward_compatibility)
-            f.crushmap = copy.deepcopy(c.get_crushmap())
-            root = f.find_bucket(take)
-            f.filter(lambda x: x.get('name') != may_fail.get('name'), root)
-            f.parse(f.crushmap)
+            f.crushmap = Crush.copy_buckets(c.get_crushmap())
+            f.filter(lambda x: x.get('name') != may_fail.get('name'), f.find_bucket(take))
+            f.parse(f.crushmap, copy_crushmap=False)
+            mapping = f.remap(base, changed, self.simulation_weights(f),
+                              choose_args=self.args.choose_args)
             try:
-                a = self.run_simulation(f, take, failure_domain)
+                a = self.run_simulation(f, take, failure_domain, mapping=mapping)
                 a['~over filled %~'] = a['~over/under filled %~']
                 a = a[['~type~', '~over filled %~']]
                 worst = pd.concat([worst, a]).groupby(['~type~']).max().reset_index()
@@ -369,7 +420,7 @@ class Analyze(object):
     def analyze(self):
         self.pre_sanity_check_args()
         c = Crush(backward_compatibility=self.args.backward_compatibility)
-        c.parse(self.main.convert_to_crushmap(self.args.crushmap))
+        c.parse(self.main.convert_to_crushmap(self.args.crushmap), copy_crushmap=False)
         self.post_sanity_check_args()
         (take, failure_domain) = c.rule_get_take_failure_domain(self.args.rule)
         d = self.run_simulation(c, take, failure_domain)
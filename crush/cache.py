@@ -0,0 +1,149 @@
+# -*- mode: python; coding: utf-8 -*-
+#
+# Copyright (C) 2017 <contact@redhat.com>
+#
+# Author: Loic Dachary <loic@dachary.org>
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+#
+import errno
+import hashlib
+import logging
+import os
+import pickle
+import tempfile
+
+log = logging.getLogger(__name__)
+
+
+class Cache(object):
+    """On-disk cache of the crushmaps converted from a file.
+
+    Each entry is a file in the `directory`, named after a hash of
+    the content of the converted file and of everything else the
+    conversion depends on. The least recently used entries are
+    removed when the total size of the entries is larger than `size`
+    bytes.
+
+    Several processes can share the same `directory`: an entry is
+    written in a temporary file which is then renamed and an entry
+    that disappears or cannot be read is converted again.
+
+    """
+
+    SUFFIX = '.pickle'
+
+    _code_version = None
+
+    def __init__(self, directory, size):
+        self.directory = directory
+        self.size = size
+
+    @staticmethod
+    def code_version():
+        """Return a hash of the code converting the crushmaps, so that
+        the entries cached by another version of it are ignored. The
+        extension is identified by its size and modification time
+        because it is too large to be read every time.
+
+        """
+        if Cache._code_version is None:
+            # imported here because they import this module
+            import crush.ceph
+            import crush.libcrush
+            import crush.main
+            h = hashlib.sha256()
+            for module in (crush, crush.main, crush.ceph):
+                with open(module.__file__.replace('.pyc', '.py'), 'rb') as f:
+                    h.update(f.read())
+            s = os.stat(crush.libcrush.__file__)
+            h.update(str((s.st_size, s.st_mtime)).encode('utf-8'))
+            Cache._code_version = h.hexdigest()
+        return Cache._code_version
+
+    @staticmethod
+    def key(content, *args):
+        """Return the key of the file `content` (bytes) converted
+        with `args`, which must have a stable str() representation.
+
+        """
+        h = hashlib.sha256()
+        h.update(content)
+        h.update(str((Cache.code_version(),) + args).encode('utf-8'))
+        return h.hexdigest()
+
+    def path(self, key):
+        return os.path.join(self.directory, key + Cache.SUFFIX)
+
+    def get(self, key):
+        """Return the object stored for `key`, or None if there is none."""
+        path = self.path(key)
+        try:
+            with open(path, 'rb') as f:
+                value = pickle.load(f)
+            os.utime(path, None)
+        except Exception as e:
+            if getattr(e, 'errno', None) == errno.ENOENT:
+                return None
+            log.warning('remove cache entry ' + path + ': ' + str(e))
+            try:
+                os.unlink(path)
+            except OSError:
+                pass
+            return None
+        log.debug('cache hit ' + path)
+        return value
+
+    def put(self, key, value):
+        """Store `value` for `key` and remove the least recently used
+        entries if the cache is too big.
+
+        """
+        try:
+            os.makedirs(self.directory)
+        except OSError as e:
+            if e.errno != errno.EEXIST:
+                raise
+        (fd, tmp) = tempfile.mkstemp(dir=self.directory, suffix='.tmp')
+        try:
+            with os.fdopen(fd, 'wb') as f:
+                pickle.dump(value, f, pickle.HIGHEST_PROTOCOL)
+            os.rename(tmp, self.path(key))
+        except Exception:
+            os.unlink(tmp)
+            raise
+        log.debug('cache store ' + self.path(key))
+        self.evict()
+
+    def evict(self):
+        entries = []
+        for name in os.listdir(self.directory):
+            if not name.endswith(Cache.SUFFIX):
+                continue
+            path = os.path.join(self.directory, name)
+            try:
+                s = os.stat(path)
+            except OSError:
+                continue
+            entries.append((s.st_mtime, s.st_size, path))
+        total = sum(size for (_, size, _) in entries)
+        for (_, size, path) in sorted(entries):
+            if total <= self.size:
+                break
+            try:
+                os.unlink(path)
+            except OSError:
+                pass
+            total -= size
+            log.debug('cache evict ' + path)
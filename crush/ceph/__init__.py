@@ -27,11 +27,12 @@ import logging
 import re
 import struct
 import textwrap
+import numpy as np
 
 from crush import main
 from crush import analyze
 from crush.ceph import convert
-from crush import Crush, LibCrush
+from crush import Crush, LibCrush, ITEM_NONE
 
 log = logging.getLogger(__name__)
 
@@ -80,15 +81,6 @@ class CephReport(object):
         c = LibCrush(backward_compatibility=True)
         c.parse(crushmap)
 
-        name2id = {}
-
-        def collect_items(children):
-            for child in children:
-                if 'id' in child:
-                    name2id[child['name']] = child['id']
-                collect_items(child.get('children', []))
-        collect_items(crushmap['trees'])
-
         weights = Crush.parse_osdmap_weights(report['osdmap'])
 
         for osd in report['osdmap']["osds"]:
@@ -120,9 +112,9 @@ class CephReport(object):
             size = pool['size']
             log.info("verifying pool {} pg_num {} pgp_num {}".format(
                 pool['pool'], pool['pg_num'], pool['pg_placement_num']))
-            values = LibCrush().ceph_pool_pps(pool['pool'],
-                                              pool['pg_num'],
-                                              pool['pg_placement_num'])
+            (pools, ps, pps) = CephCrush.pools_pps([(pool['pool'],
+                                                     pool['pg_num'],
+                                                     pool['pg_placement_num'])])
             kwargs = {
                 "rule": str(rule),
                 "replication_count": size,
@@ -131,14 +123,20 @@ class CephReport(object):
                 kwargs["choose_args"] = choose_args
             if weights:
                 kwargs["weights"] = weights
-            for (name, pps) in values.items():
-                if name not in mappings:
+            names = []
+            found = []
+            for name in CephCrush.pg_names(pools, ps):
+                found.append(name in mappings)
+                if not found[-1]:
                     failed_mapping = True
                     log.error(name + " is not in pgmap")
                     continue
-                kwargs["value"] = pps
-                mapped = c.map(**kwargs)
-                osds = [name2id[x] for x in mapped]
+                names.append(name)
+            kwargs["values"] = np.ascontiguousarray(pps[np.array(found, dtype=bool)])
+            mapped = np.frombuffer(c.map_batch(**kwargs), dtype=np.int32).reshape(-1, size)
+            for i in range(len(names)):
+                name = names[i]
+                osds = [int(x) for x in mapped[i] if x != ITEM_NONE]
                 if osds != mappings[name]:
                     failed_mapping = True
                     log.error("{} map to {} instead of {}".format(
@@ -393,16 +391,102 @@ class CephCrushmapConverter(object):
 
 class CephCrush(Crush):
 
+    #
+    # placement groups
+    #
+
+    @staticmethod
+    def pools_pps(pools):
+        """Return the placement seeds of all PGs in the pools
+
+        The pools argument is a list of (pool, pg_num, pgp_num)
+        tuples. The return value is a tuple of three numpy int32
+        arrays of the same length, with one row per PG, in the order
+        of the pools and then of the PG number within the pool:
+
+        - the pool of the PG
+        - the ps of the PG, i.e. its number within the pool
+        - the pps of the PG, i.e. the value given to the crush rule
+
+        The pps array can be given as is to **map_batch** or
+        **histogram**. The PG names are only built on demand with
+        **pg_names**.
+
+        """
+        return tuple(np.frombuffer(a, dtype=np.int32)
+                     for a in LibCrush().ceph_pools_pps(pools))
+
+    @staticmethod
+    def pg_names(pool, ps):
+        """Return the list of PG names (for instance 1.3f) for the
+        pool and ps arrays returned by **pools_pps**
+
+        """
+        return ["%d.%x" % (p, s) for (p, s) in zip(pool.tolist(), ps.tolist())]
+
     #
     # reading a crushmap from a file
     #
 
+    # attributes of a crushmap loaded by ceph_load(), until it is converted
+    _lazy = ('_ceph_binary', 'crushmap', '_name2item', '_id2item')
+
+    def parse(self, something, copy_crushmap=True):
+        """Same as Crush.parse except for a Ceph binary crushmap, which
+        is loaded as is by LibCrush. It is only converted to the
+        crushmap returned by **get_crushmap()** when a method needs
+        it: mapping objects does not. The weights of its choose_args
+        are exactly those of the Ceph crushmap instead of the rounded
+        floats found in the converted crushmap.
+
+        A Ceph crushmap with -target-weight buckets, as written for
+        Ceph versions older than luminous, is always converted to
+        recover its choose_args.
+
+        """
+        for name in CephCrush._lazy:
+            self.__dict__.pop(name, None)
+        if self._load_ceph_binary(something):
+            return True
+        return super(CephCrush, self).parse(something, copy_crushmap=copy_crushmap)
+
+    def _load_ceph_binary(self, something):
+        if type(something) in (dict, collections.OrderedDict):
+            return False
+        if not CephCrush._is_ceph_binary(something):
+            return False
+        with open(something, mode='rb') as f:
+            data = f.read()
+        if not self.c.ceph_load(data):
+            return False
+        self._ceph_binary = data
+        return True
+
+    def __getattr__(self, name):
+        if name in CephCrush._lazy[1:] and '_ceph_binary' in self.__dict__:
+            crushmap = json.loads(self.c.ceph_read_binary(self._ceph_binary))
+            self.crushmap = self._convert_to_crushmap(crushmap)
+            self._update_info()
+            del self._ceph_binary
+            return getattr(self, name)
+        raise AttributeError(name)
+
+    def __getstate__(self):
+        # convert once instead of once per unpickled copy
+        self.crushmap
+        return self.__dict__
+
     @staticmethod
-    def _is_ceph_file(something):
+    def _is_ceph_binary(something):
         fmt = "I"
         crush_magic = 0x00010000
         head = open(something, mode='rb').read(struct.calcsize(fmt))
-        if struct.unpack(fmt, head)[0] == crush_magic:
+        return (len(head) == struct.calcsize(fmt) and
+                struct.unpack(fmt, head)[0] == crush_magic)
+
+    @staticmethod
+    def _is_ceph_file(something):
+        if CephCrush._is_ceph_binary(something):
             return True
         content = open(something).read()
         if (re.search("^device ", content, re.MULTILINE) and
@@ -513,11 +597,11 @@ class CephCrush(Crush):
         if 'choose_args' not in self.crushmap:
             return False
         self.choose_args_int_index(self.crushmap)
-        self.parse(self.crushmap)
+        self.parse(self.crushmap, copy_crushmap=False)
         if version >= 'luminous':
             return True
         self.ceph_version_compat()
-        self.parse(self.crushmap)
+        self.parse(self.crushmap, copy_crushmap=False)
         return True
 
     def to_file(self, path, format, version):
@@ -659,12 +743,31 @@ class Ceph(main.Main):
         super(Ceph, self).hook_optimize_post_sanity_check_args(args)
         self.hook_common_post_sanity_check_args(args)
 
+    def hook_profile_args(self, parser):
+        self.hook_common_args(parser)
+
+    def hook_profile_pre_sanity_check_args(self, args):
+        super(Ceph, self).hook_profile_pre_sanity_check_args(args)
+
+    def hook_profile_post_sanity_check_args(self, args):
+        super(Ceph, self).hook_profile_post_sanity_check_args(args)
+        self.hook_common_post_sanity_check_args(args)
+
     def hook_create_values(self):
         if self.args.pool is not None:
             return LibCrush().ceph_pool_pps(self.args.pool, self.args.pg_num, self.args.pgp_num)
         else:
             return super(Ceph, self).hook_create_values()
 
+    def hook_create_value_array(self):
+        if self.args.pool is not None:
+            (pools, ps, pps) = CephCrush.pools_pps([(self.args.pool,
+                                                     self.args.pg_num,
+                                                     self.args.pgp_num)])
+            return pps
+        else:
+            return super(Ceph, self).hook_create_value_array()
+
     def value_name(self):
         return 'PGs'
 
@@ -768,13 +871,23 @@ class Ceph(main.Main):
         choose_args = crushmap['choose_args']
         choose_args[choose_args_name] = choose_args[' placeholder ']
         del choose_args[' placeholder ']
-        c.parse(crushmap)
+        c.parse(crushmap, copy_crushmap=False)
+
+    def _convert_to_crushmap(self, crushmap):
+        c = CephCrush(verbose=self.args.debug,
+                      backward_compatibility=self.args.backward_compatibility)
+        #
+        # the subcommands need the converted crushmap: loading a Ceph
+        # binary crushmap as is with CephCrush.parse would only delay
+        # the conversion
+        #
+        super(CephCrush, c).parse(crushmap)
+        return c.get_crushmap()
 
     def convert_to_crushmap(self, crushmap):
         c = CephCrush(verbose=self.args.debug,
                       backward_compatibility=self.args.backward_compatibility)
-        c.parse(crushmap)
-        crushmap = c.get_crushmap()
+        crushmap = self.cached_crushmap(crushmap, self._convert_to_crushmap)
         if self.args.func.__name__ == 'Analyze':
             choose_args_name = self.set_analyze_args(crushmap)
         elif self.args.func.__name__ == 'Optimize':
@@ -784,6 +897,8 @@ class Ceph(main.Main):
             choose_args_name = self.get_compat_choose_args(crushmap)
         elif self.args.func.__name__ == 'Compare':
             choose_args_name = self.set_analyze_args(crushmap)
+        elif self.args.func.__name__ == 'Profile':
+            choose_args_name = self.args.choose_args
         else:
             raise Exception('Unexpected func=' + str(self.args.func.__name__))
         self.set_compat_choose_args(c, crushmap, choose_args_name)
@@ -21,11 +21,12 @@ from __future__ import division
 
 import argparse
 import collections
+import numpy as np
 import pandas as pd
 import logging
 import textwrap
 
-from crush import Crush
+from crush import Crush, ITEM_NONE
 from crush.analyze import Analyze
 
 log = logging.getLogger(__name__)
@@ -50,7 +51,7 @@ class Compare(object):
     def set_origin_crushmap(self, origin):
         self.args.choose_args = self.args.origin_choose_args
         o = Crush(backward_compatibility=self.args.backward_compatibility)
-        o.parse(self.main.convert_to_crushmap(origin))
+        o.parse(self.main.convert_to_crushmap(origin), copy_crushmap=False)
         self.set_origin(o)
 
     def set_destination(self, c):
@@ -59,7 +60,7 @@ class Compare(object):
     def set_destination_crushmap(self, destination):
         self.args.choose_args = self.args.destination_choose_args
         d = Crush(backward_compatibility=self.args.backward_compatibility)
-        d.parse(self.main.convert_to_crushmap(destination))
+        d.parse(self.main.convert_to_crushmap(destination), copy_crushmap=False)
         self.set_destination(d)
 
     @staticmethod
@@ -192,41 +193,42 @@ class Compare(object):
 
     def compare(self):
         a = self.origin
-        self.origin_d = collections.defaultdict(lambda: 0)
         b = self.destination
-        self.destination_d = collections.defaultdict(lambda: 0)
         replication_count = self.args.replication_count
-        values = self.main.hook_create_values()
+        values = self.main.hook_create_value_array()
         rule = self.args.rule
+        orig_weights = self.orig_weights and a.compile_weights(self.orig_weights)
+        dest_weights = self.dest_weights and b.compile_weights(self.dest_weights)
+        (moved, am, bm) = a.movement(rule, values, replication_count, destination=b,
+                                     weights=orig_weights,
+                                     choose_args=self.args.origin_choose_args,
+                                     destination_weights=dest_weights,
+                                     destination_choose_args=self.args.destination_choose_args,
+                                     order_matters=self.args.order_matters)
+        assert not (am == ITEM_NONE).any(), "origin failed to map some values"
+        assert not (bm == ITEM_NONE).any(), "destination failed to map some values"
+        a_name = Compare.id2name(a)
+        b_name = Compare.id2name(b)
+        self.origin_d = Compare.count_by_name(am, a_name)
+        self.destination_d = Compare.count_by_name(bm, b_name)
         self.from_to = collections.defaultdict(lambda: collections.defaultdict(lambda: 0))
-        for (name, value) in values.items():
-            am = a.map(rule, value, replication_count, self.orig_weights,
-                       choose_args=self.args.origin_choose_args)
-            log.debug("am {} == {} mapped to {}".format(name, value, am))
-            assert len(am) == replication_count
-            for d in am:
-                self.origin_d[d] += 1
-            bm = b.map(rule, value, replication_count, self.dest_weights,
-                       choose_args=self.args.destination_choose_args)
-            log.debug("bm {} == {} mapped to {}".format(name, value, bm))
-            assert len(bm) == replication_count
-            for d in bm:
-                self.destination_d[d] += 1
-            if self.args.order_matters:
-                for i in range(len(am)):
-                    if am[i] != bm[i]:
-                        self.from_to[am[i]][bm[i]] += 1
-            else:
-                am = set(am)
-                bm = set(bm)
-                if am == bm:
-                    continue
-                ar = list(am - bm)
-                br = list(bm - am)
-                for i in range(len(ar)):
-                    self.from_to[ar[i]][br[i]] += 1
+        for (moved_from, moved_to, count) in moved:
+            self.from_to[a_name(moved_from)][b_name(moved_to)] += int(count)
         return self.from_to
 
+    @staticmethod
+    def id2name(c):
+        (ids, names) = c.items_table()
+        return dict(zip(ids.tolist(), names.tolist())).get
+
+    @staticmethod
+    def count_by_name(mapped, id2name):
+        d = collections.defaultdict(lambda: 0)
+        (ids, counts) = np.unique(mapped, return_counts=True)
+        for (id, count) in zip(ids, counts):
+            d[id2name(id)] += int(count)
+        return d
+
     def compare_bucket(self, bucket):
         a = self.origin
         self.origin_d = collections.defaultdict(lambda: 0)
@@ -239,12 +241,14 @@ class Compare(object):
         self.in_out = collections.defaultdict(lambda: collections.defaultdict(lambda: 0))
         item2path = a.collect_item2path([bucket])
         log.debug("item2path " + str(item2path))
+        orig_weights = self.orig_weights and a.compile_weights(self.orig_weights)
+        dest_weights = self.dest_weights and b.compile_weights(self.dest_weights)
         for (name, value) in values.items():
-            am = a.map(rule, value, replication_count, self.orig_weights,
+            am = a.map(rule, value, replication_count, orig_weights,
                        choose_args=self.args.choose_args)
             log.debug("am {} == {} mapped to {}".format(name, value, am))
             assert len(am) == replication_count
-            bm = b.map(rule, value, replication_count, self.dest_weights,
+            bm = b.map(rule, value, replication_count, dest_weights,
                        choose_args=self.args.choose_args)
             log.debug("bm {} == {} mapped to {}".format(name, value, bm))
             assert len(bm) == replication_count
@@ -229,6 +229,17 @@ int ceph_read_txt_to_json(const char *in, char **out)
   return 0;
 }
 
+static int ceph_decode(ceph::bufferlist &bl, CrushWrapper &crush)
+{
+  ceph::bufferlist::iterator p = bl.begin();
+  try {
+    crush.decode(p);
+  } catch(...) {
+    return -EINVAL;
+  }
+  return 0;
+}
+
 int ceph_read_binary_to_json(const char *in, char **out)
 {
   ceph::bufferlist bl;
@@ -236,13 +247,198 @@ int ceph_read_binary_to_json(const char *in, char **out)
   int r = bl.read_file(in, &error);
   if (r < 0)
     return r;
-  ceph::bufferlist::iterator p = bl.begin();
   CrushWrapper crush;
-  try {
-    crush.decode(p);
-  } catch(...) {
-    return -EINVAL;
-  }
+  r = ceph_decode(bl, crush);
+  if (r < 0)
+    return r;
   *out = crush_to_json(crush);
   return 0;
 }
+
+int ceph_read_binary_data_to_json(const char *data, size_t size, char **out)
+{
+  ceph::bufferlist bl;
+  bl.append(data, size);
+  CrushWrapper crush;
+  int r = ceph_decode(bl, crush);
+  if (r < 0)
+    return r;
+  *out = crush_to_json(crush);
+  return 0;
+}
+
+//
+// Load a binary Ceph crushmap in self without converting it to the
+// python-crush crushmap. The crush_map decoded by CrushWrapper is used
+// as is and the name tables are filled as parse() would. A crushmap
+// that parse() would not get the same way, because it has buckets
+// created by ceph_write() to store the choose_args for Ceph versions
+// older than luminous or buckets that libcrush does not support,
+// is not loaded and -ENOTSUP is returned.
+//
+static int ceph_load_supported(CrushWrapper &crush)
+{
+  struct crush_map *map = crush.crush;
+  for (int b = 0; b < map->max_buckets; b++) {
+    struct crush_bucket *bucket = map->buckets[b];
+    if (bucket == NULL)
+      continue;
+    if (bucket->alg == CRUSH_BUCKET_TREE)
+      return 0;
+    if (bucket->alg == CRUSH_BUCKET_UNIFORM && !crush.choose_args.empty())
+      return 0;
+    if (crush.name_map.count(bucket->id) == 0)
+      return 0;
+    const std::string &name = crush.name_map[bucket->id];
+    if (name.size() > 14 && name.compare(name.size() - 14, 14, "-target-weight") == 0)
+      return 0;
+    for (__u32 i = 0; i < bucket->size; i++)
+      if (bucket->items[i] >= 0 && crush.name_map.count(bucket->items[i]) == 0)
+        return 0;
+  }
+  for (__u32 r = 0; r < map->max_rules; r++)
+    if (map->rules[r] != NULL && crush.rule_name_map.count(r) == 0)
+      return 0;
+  for (auto &c : crush.choose_args) {
+    for (__u32 b = 0; b < c.second.size && b < (__u32)map->max_buckets; b++) {
+      struct crush_bucket *bucket = map->buckets[b];
+      struct crush_choose_arg *arg = &c.second.args[b];
+      if (arg->ids_size == 0 && arg->weight_set_size == 0)
+        continue;
+      if (bucket == NULL)
+        return 0;
+      if (arg->ids_size != 0 && arg->ids_size != bucket->size)
+        return 0;
+      for (__u32 position = 0; position < arg->weight_set_size; position++)
+        if (arg->weight_set[position].size != bucket->size)
+          return 0;
+    }
+  }
+  return 1;
+}
+
+static int ceph_load_name(PyObject *dict, PyObject *rdict, const std::string &name, int id)
+{
+  PyObject *python_name = PyUnicode_FromString(name.c_str());
+  if (python_name == NULL)
+    return 0;
+  PyObject *python_id = MyInt_FromInt(id);
+  int r = PyDict_SetItem(dict, python_name, python_id);
+  if (r == 0 && rdict != NULL)
+    r = PyDict_SetItem(rdict, python_id, python_name);
+  Py_DECREF(python_name);
+  Py_DECREF(python_id);
+  return r == 0;
+}
+
+static int ceph_load_choose_args(LibCrush *self, CrushWrapper &crush, PyCapsule_Destructor destructor)
+{
+  struct crush_map *map = self->map;
+  PyDict_Clear(self->choose_args);
+  for (auto &c : crush.choose_args) {
+    crush_choose_arg_map &from = c.second;
+    __u32 size = std::min(from.size, (__u32)map->max_buckets);
+    int num_positions = 0;
+    for (__u32 b = 0; b < size; b++)
+      num_positions = std::max(num_positions, (int)from.args[b].weight_set_size);
+    struct crush_choose_arg *args = crush_make_choose_args(map, num_positions);
+    if (args == NULL) {
+      PyErr_NoMemory();
+      return 0;
+    }
+    for (int b = 0; b < map->max_buckets; b++) {
+      struct crush_choose_arg *arg = &args[b];
+      struct crush_choose_arg *from_arg = (__u32)b < size ? &from.args[b] : NULL;
+      if (map->buckets[b] == NULL || from_arg == NULL ||
+          (from_arg->ids_size == 0 && from_arg->weight_set_size == 0)) {
+        memset(arg, '\0', sizeof(struct crush_choose_arg));
+        continue;
+      }
+      memcpy(arg->ids, from_arg->ids, sizeof(__s32) * from_arg->ids_size);
+      arg->ids_size = from_arg->ids_size;
+      arg->weight_set_size = from_arg->weight_set_size;
+      for (__u32 position = 0; position < from_arg->weight_set_size; position++)
+        memcpy(arg->weight_set[position].weights, from_arg->weight_set[position].weights,
+               sizeof(__u32) * from_arg->weight_set[position].size);
+    }
+    PyObject *capsule = PyCapsule_New((void *)args, NULL, destructor);
+    if (capsule == NULL) {
+      crush_destroy_choose_args(args);
+      return 0;
+    }
+    PyObject *key = PyUnicode_FromString(std::to_string(c.first).c_str());
+    int r = key == NULL ? -1 : PyDict_SetItem(self->choose_args, key, capsule);
+    Py_XDECREF(key);
+    Py_DECREF(capsule);
+    if (r != 0)
+      return 0;
+  }
+  return 1;
+}
+
+static int _ceph_load(LibCrush *self, CrushWrapper &crush, PyCapsule_Destructor destructor)
+{
+  struct crush_map *map = crush.crush;
+
+  self->tunables->choose_local_tries = map->choose_local_tries;
+  self->tunables->choose_local_fallback_tries = map->choose_local_fallback_tries;
+  self->tunables->chooseleaf_descend_once = map->chooseleaf_descend_once;
+  self->tunables->chooseleaf_vary_r = map->chooseleaf_vary_r;
+  self->tunables->chooseleaf_stable = map->chooseleaf_stable;
+  self->tunables->straw_calc_version = map->straw_calc_version;
+  self->tunables->choose_total_tries = map->choose_total_tries;
+
+  PyDict_Clear(self->types);
+  for (auto &t : crush.type_map)
+    if (!ceph_load_name(self->types, NULL, t.second, t.first))
+      return -EINVAL;
+
+  // like parse(), only name the buckets and the devices they contain
+  PyDict_Clear(self->items);
+  PyDict_Clear(self->ritems);
+  self->highest_device_id = -1;
+  for (int b = 0; b < map->max_buckets; b++) {
+    struct crush_bucket *bucket = map->buckets[b];
+    if (bucket == NULL)
+      continue;
+    if (!ceph_load_name(self->items, self->ritems, crush.name_map[bucket->id], bucket->id))
+      return -EINVAL;
+    for (__u32 i = 0; i < bucket->size; i++) {
+      int item = bucket->items[i];
+      if (item < 0)
+        continue;
+      if (!ceph_load_name(self->items, self->ritems, crush.name_map[item], item))
+        return -EINVAL;
+      if (item > self->highest_device_id)
+        self->highest_device_id = item;
+    }
+  }
+  self->has_bucket_weights = 1;
+
+  PyDict_Clear(self->rules);
+  for (auto &r : crush.rule_name_map)
+    if (!ceph_load_name(self->rules, NULL, r.second, r.first))
+      return -EINVAL;
+
+  crush_destroy(self->map);
+  self->map = map;
+  crush.crush = NULL;
+
+  if (!ceph_load_choose_args(self, crush, destructor))
+    return -EINVAL;
+
+  return 0;
+}
+
+int ceph_load(LibCrush *self, const char *data, size_t size, PyCapsule_Destructor destructor)
+{
+  ceph::bufferlist bl;
+  bl.append(data, size);
+  CrushWrapper crush;
+  int r = ceph_decode(bl, crush);
+  if (r < 0)
+    return r;
+  if (!ceph_load_supported(crush))
+    return -ENOTSUP;
+  return _ceph_load(self, crush, destructor);
+}
@@ -6,6 +6,8 @@ extern "C" {
 
   int ceph_read_txt_to_json(const char *in, char **out);
   int ceph_read_binary_to_json(const char *in, char **out);
+  int ceph_read_binary_data_to_json(const char *data, size_t size, char **out);
+  int ceph_load(LibCrush *self, const char *data, size_t size, PyCapsule_Destructor destructor);
   int ceph_write(LibCrush *self, const char *path, const char *format, PyObject *info);
   int ceph_incompat(LibCrush *self, int *out);
 #ifdef __cplusplus
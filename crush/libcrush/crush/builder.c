@@ -857,6 +857,9 @@ int crush_add_straw2_bucket_item(struct crush_map *map,
 	bucket->h.weight += weight;
 	bucket->h.size++;
 
+	if (bucket->item_reciprocals)
+		return crush_bucket_straw2_reciprocals(bucket);
+
 	return 0;
 }
 
@@ -893,13 +896,17 @@ int crush_remove_uniform_bucket_item(struct crush_bucket_uniform *bucket, int it
 	if (i == bucket->h.size)
 		return -ENOENT;
 
-	for (j = i; j < bucket->h.size; j++)
+	for (j = i; j < bucket->h.size - 1; j++)
 		bucket->h.items[j] = bucket->h.items[j+1];
 	newsize = --bucket->h.size;
 	if (bucket->item_weight < bucket->h.weight)
 		bucket->h.weight -= bucket->item_weight;
 	else
 		bucket->h.weight = 0;
+	if (!newsize) {
+		/* don't bother reallocating a 0-length array. */
+		return 0;
+	}
 
 	if ((_realloc = realloc(bucket->h.items, sizeof(__s32)*newsize)) == NULL) {
 		return -ENOMEM;
@@ -922,7 +929,7 @@ int crush_remove_list_bucket_item(struct crush_bucket_list *bucket, int item)
 		return -ENOENT;
 
 	weight = bucket->item_weights[i];
-	for (j = i; j < bucket->h.size; j++) {
+	for (j = i; j < bucket->h.size - 1; j++) {
 		bucket->h.items[j] = bucket->h.items[j+1];
 		bucket->item_weights[j] = bucket->item_weights[j+1];
 		bucket->sum_weights[j] = bucket->sum_weights[j+1] - weight;
@@ -932,6 +939,10 @@ int crush_remove_list_bucket_item(struct crush_bucket_list *bucket, int item)
 	else
 		bucket->h.weight = 0;
 	newsize = --bucket->h.size;
+	if (!newsize) {
+		/* don't bother reallocating a 0-length array. */
+		return 0;
+	}
 	
 	void *_realloc = NULL;
 
@@ -1030,12 +1041,11 @@ int crush_remove_straw_bucket_item(struct crush_map *map,
 
 	for (i = 0; i < bucket->h.size; i++) {
 		if (bucket->h.items[i] == item) {
-			bucket->h.size--;
 			if (bucket->item_weights[i] < bucket->h.weight)
 				bucket->h.weight -= bucket->item_weights[i];
 			else
 				bucket->h.weight = 0;
-			for (j = i; j < bucket->h.size; j++) {
+			for (j = i; j < bucket->h.size - 1; j++) {
 				bucket->h.items[j] = bucket->h.items[j+1];
 				bucket->item_weights[j] = bucket->item_weights[j+1];
 			}
@@ -1044,6 +1054,11 @@ int crush_remove_straw_bucket_item(struct crush_map *map,
 	}
 	if (i == bucket->h.size)
 		return -ENOENT;
+	bucket->h.size--;
+	if (!newsize) {
+		/* don't bother reallocating a 0-length array. */
+		return 0;
+	}
 	
 	void *_realloc = NULL;
 
@@ -1074,12 +1089,11 @@ int crush_remove_straw2_bucket_item(struct crush_map *map,
 
 	for (i = 0; i < bucket->h.size; i++) {
 		if (bucket->h.items[i] == item) {
-			bucket->h.size--;
 			if (bucket->item_weights[i] < bucket->h.weight)
 				bucket->h.weight -= bucket->item_weights[i];
 			else
 				bucket->h.weight = 0;
-			for (j = i; j < bucket->h.size; j++) {
+			for (j = i; j < bucket->h.size - 1; j++) {
 				bucket->h.items[j] = bucket->h.items[j+1];
 				bucket->item_weights[j] = bucket->item_weights[j+1];
 			}
@@ -1088,6 +1102,11 @@ int crush_remove_straw2_bucket_item(struct crush_map *map,
 	}
 	if (i == bucket->h.size)
 		return -ENOENT;
+	bucket->h.size--;
+	if (!newsize) {
+		/* don't bother reallocating a 0-length array. */
+		return 0;
+	}
 
 	void *_realloc = NULL;
 
@@ -1102,6 +1121,9 @@ int crush_remove_straw2_bucket_item(struct crush_map *map,
 		bucket->item_weights = _realloc;
 	}
 
+	if (bucket->item_reciprocals)
+		return crush_bucket_straw2_reciprocals(bucket);
+
 	return 0;
 }
 
@@ -1226,6 +1248,8 @@ int crush_adjust_straw2_bucket_item_weight(struct crush_map *map,
 	diff = weight - bucket->item_weights[idx];
 	bucket->item_weights[idx] = weight;
 	bucket->h.weight += diff;
+	if (bucket->item_reciprocals)
+		crush_reciprocal_init(&bucket->item_reciprocals[idx], weight);
 
 	return diff;
 }
@@ -1368,6 +1392,8 @@ static int crush_reweight_straw2_bucket(struct crush_map *map, struct crush_buck
 			struct crush_bucket *c = map->buckets[-1-id];
 			crush_reweight_bucket(map, c);
 			bucket->item_weights[i] = c->weight;
+			if (bucket->item_reciprocals)
+				crush_reciprocal_init(&bucket->item_reciprocals[i], c->weight);
 		}
 
                 if (crush_addition_is_unsafe(bucket->h.weight, bucket->item_weights[i]))
@@ -1412,13 +1438,15 @@ struct crush_choose_arg *crush_make_choose_args(struct crush_map *map, int num_p
           sum_bucket_size, map->max_buckets, bucket_count);
   int size = (sizeof(struct crush_choose_arg) * map->max_buckets +
               sizeof(struct crush_weight_set) * bucket_count * num_positions +
+              sizeof(struct crush_reciprocal) * sum_bucket_size * num_positions + // reciprocals
               sizeof(__u32) * sum_bucket_size * num_positions + // weights
               sizeof(__u32) * sum_bucket_size); // ids
   char *space = malloc(size);
   struct crush_choose_arg *arg = (struct crush_choose_arg *)space;
   struct crush_weight_set *weight_set = (struct crush_weight_set *)(arg + map->max_buckets);
-  __u32 *weights = (__u32 *)(weight_set + bucket_count * num_positions);
-  char *weight_set_ends = (char*)weights;
+  struct crush_reciprocal *reciprocals = (struct crush_reciprocal *)(weight_set + bucket_count * num_positions);
+  char *weight_set_ends = (char*)reciprocals;
+  __u32 *weights = (__u32 *)(reciprocals + sum_bucket_size * num_positions);
   int *ids = (int *)(weights + sum_bucket_size * num_positions);
   char *weights_end = (char *)ids;
   char *ids_end = (char *)(ids + sum_bucket_size);
@@ -1435,6 +1463,9 @@ struct crush_choose_arg *crush_make_choose_args(struct crush_map *map, int num_p
       memcpy(weights, bucket->item_weights, sizeof(__u32) * bucket->h.size);
       weight_set[position].weights = weights;
       weight_set[position].size = bucket->h.size;
+      crush_reciprocals_init(reciprocals, weights, bucket->h.size);
+      weight_set[position].reciprocals = reciprocals;
+      reciprocals += bucket->h.size;
       dprintk("moving weight %d bytes forward\n", (int)((weights + bucket->h.size) - weights));
       weights += bucket->h.size;
     }
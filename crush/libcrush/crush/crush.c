@@ -2,6 +2,7 @@
 # include <linux/slab.h>
 # include <linux/crush/crush.h>
 #else
+# include <errno.h>
 # include "crush_compat.h"
 # include "crush.h"
 #endif
@@ -74,6 +75,9 @@ void crush_destroy_bucket_straw(struct crush_bucket_straw *b)
 
 void crush_destroy_bucket_straw2(struct crush_bucket_straw2 *b)
 {
+#ifndef __KERNEL__
+	kfree(b->item_reciprocals);
+#endif
 	kfree(b->item_weights);
 	kfree(b->h.items);
 	kfree(b);
@@ -135,3 +139,54 @@ void crush_destroy_rule(struct crush_rule *rule)
 {
 	kfree(rule);
 }
+
+#ifndef __KERNEL__
+void crush_reciprocal_init(struct crush_reciprocal *reciprocal, __u32 divisor)
+{
+	int l = 0;
+	__u64 a, x, q1, q2;
+
+	reciprocal->divisor = divisor;
+	if (divisor == 0) {
+		reciprocal->multiplier = 0;
+		reciprocal->shift1 = 0;
+		reciprocal->shift2 = 0;
+		return;
+	}
+	while (((__u64)1 << l) < divisor)
+		l++;
+	/*
+	 * multiplier = floor(2^64 * (2^l - divisor) / divisor) + 1 computed
+	 * as a long division in two 32 bits steps, which is possible
+	 * because 2^l - divisor < divisor < 2^32
+	 */
+	a = ((__u64)1 << l) - divisor;
+	x = a << 32;
+	q1 = x / divisor;
+	x = (x % divisor) << 32;
+	q2 = x / divisor;
+	reciprocal->multiplier = (q1 << 32) + q2 + 1;
+	reciprocal->shift1 = l < 1 ? l : 1;
+	reciprocal->shift2 = l > 1 ? l - 1 : 0;
+}
+
+void crush_reciprocals_init(struct crush_reciprocal *reciprocals, const __u32 *divisors, int size)
+{
+	int i;
+	for (i = 0; i < size; i++)
+		crush_reciprocal_init(&reciprocals[i], divisors[i]);
+}
+
+int crush_bucket_straw2_reciprocals(struct crush_bucket_straw2 *b)
+{
+	struct crush_reciprocal *reciprocals;
+
+	reciprocals = realloc(b->item_reciprocals,
+			      sizeof(struct crush_reciprocal) * (b->h.size + 1));
+	if (!reciprocals)
+		return -ENOMEM;
+	b->item_reciprocals = reciprocals;
+	crush_reciprocals_init(reciprocals, b->item_weights, b->h.size);
+	return 0;
+}
+#endif
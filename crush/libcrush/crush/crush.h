@@ -238,6 +238,25 @@ struct crush_bucket {
         __s32 *items;    /*!< array of children: < 0 are buckets, >= 0 items */
 };
 
+#ifndef __KERNEL__
+/** @ingroup API
+ *
+ * The reciprocal of a straw2 weight, computed by crush_reciprocal_init(),
+ * replaces the 64-bit division of the draw by the weight with a
+ * multiplication and two shifts that always give the same result
+ * (Granlund and Montgomery, Division by Invariant Integers using
+ * Multiplication, 1994, figure 4.1). It is only used when __divisor__
+ * is equal to the weight so that a stale reciprocal falls back to the
+ * division instead of changing the mapping.
+ */
+struct crush_reciprocal {
+  __u64 multiplier; /*!< 2^64 * (2^l - divisor) / divisor + 1 with l = ceil(log2(divisor)) */
+  __u32 divisor;    /*!< the weight, 0 if the reciprocal is not set */
+  __u16 shift1;     /*!< min(l, 1) */
+  __u16 shift2;     /*!< max(l - 1, 0) */
+};
+#endif
+
 /** @ingroup API
  *
  * Replacement weights for each item in a bucket. The size of the
@@ -248,6 +267,9 @@ struct crush_bucket {
 struct crush_weight_set {
   __u32 *weights; /*!< 16.16 fixed point weights in the same order as items */
   __u32 size;     /*!< size of the __weights__ array */
+#ifndef __KERNEL__
+  struct crush_reciprocal *reciprocals; /*!< NULL or the reciprocal of each weight */
+#endif
 };
 
 /** @ingroup API
@@ -340,6 +362,9 @@ struct crush_bucket_straw {
 struct crush_bucket_straw2 {
         struct crush_bucket h; /*!< generic bucket information */
 	__u32 *item_weights;   /*!< 16.16 fixed point weight for each item */
+#ifndef __KERNEL__
+	struct crush_reciprocal *item_reciprocals; /*!< NULL or the reciprocal of each weight */
+#endif
 };
 
 
@@ -456,6 +481,12 @@ struct crush_map {
 	__u32 allowed_bucket_algs;
 
 	__u32 *choose_tries;
+
+	/*
+	 * if set, straw2 buckets are evaluated by blocks of items with
+	 * loops the compiler can vectorize. The result is the same.
+	 */
+	__u8 straw2_block;
 #endif
 	/*! @endcond */
 };
@@ -501,6 +532,31 @@ extern void crush_destroy_rule(struct crush_rule *r);
  */
 extern void crush_destroy(struct crush_map *map);
 
+#ifndef __KERNEL__
+/** @ingroup API
+ *
+ * Set __reciprocal__ so that dividing by __divisor__ can be replaced
+ * by a multiplication and shifts. See ::crush_reciprocal.
+ *
+ * @param reciprocal the reciprocal to set
+ * @param divisor the straw2 weight
+ */
+extern void crush_reciprocal_init(struct crush_reciprocal *reciprocal, __u32 divisor);
+/** @ingroup API
+ *
+ * Call crush_reciprocal_init() for each of the __size__ __divisors__.
+ */
+extern void crush_reciprocals_init(struct crush_reciprocal *reciprocals, const __u32 *divisors, int size);
+/** @ingroup API
+ *
+ * Allocate or resize the __item_reciprocals__ of __b__ and set them
+ * from its __item_weights__.
+ *
+ * @returns 0 on success, -ENOMEM on allocation failure
+ */
+extern int crush_bucket_straw2_reciprocals(struct crush_bucket_straw2 *b);
+#endif
+
 static inline int crush_calc_tree_node(int i)
 {
 	return ((i+1) << 1)-1;
@@ -540,10 +596,38 @@ struct crush_work_bucket {
 	__u32 perm_x; /* @x for which *perm is defined */
 	__u32 perm_n; /* num elements of *perm that are permuted/defined */
 	__u32 *perm;  /* Permutation of the bucket's items */
+#ifndef __KERNEL__
+	__u32 choices_x; /* @x for which *choices is defined */
+	__u32 choices_n; /* num elements of *choices, 0 if none */
+	const int *choices; /* straw2 choice for r in [0,choices_n[ at position 0 */
+	__u32 lns_r_max; /* r for which *lns are cached, 0 if none */
+	const int *lns_index; /* the row of *lns_filled for the value being mapped */
+	__s64 *lns; /* straw2 ln(hash) of each item, one row per index and r */
+	unsigned char *lns_filled; /* non zero if the row of *lns is computed */
+#endif
 };
 
+#ifndef __KERNEL__
+/* Counters of the choices made by crush_do_rule, see crush_use_stats */
+struct crush_stats {
+	__u64 tries; /* descents from the bucket of a choose step */
+	__u64 local_retries; /* choices retried in the same bucket */
+	__u64 rejects; /* devices rejected because they are out */
+	__u64 collisions; /* items that were already chosen */
+	__u64 *choose_tries; /* [n] items chosen after n failed descents */
+	int choose_tries_size; /* size of *choose_tries, the last counts the others */
+	__u64 *bucket_collisions; /* [-1-id] collisions in the bucket id, max_buckets */
+};
+#endif
+
 struct crush_work {
 	struct crush_work_bucket **work; /* Per-bucket working store */
+#ifndef __KERNEL__
+	int *record; /* the ids of the buckets chosen from and of the items chosen */
+	int record_max; /* size of *record */
+	int record_size; /* number of ids recorded, may be more than record_max */
+	struct crush_stats *stats; /* counters of the choices or NULL */
+#endif
 };
 
 #endif
@@ -140,6 +140,82 @@ __u32 crush_hash32_5(int type, __u32 a, __u32 b, __u32 c, __u32 d, __u32 e)
 	}
 }
 
+#ifndef __KERNEL__
+/*
+ * crush_hash32_rjenkins1_3 for n values of b at once. Each iteration is
+ * independent and only uses 32 bits additions, subtractions, xors and
+ * constant shifts so that the compiler can map the loop to SIMD
+ * registers.
+ */
+static void crush_hash32_rjenkins1_3_b(__u32 a, const __s32 *b, __u32 c,
+				       __u32 *hashes, int n)
+{
+	int i;
+	for (i = 0; i < n; i++) {
+		__u32 la = a;
+		__u32 lb = b[i];
+		__u32 lc = c;
+		__u32 hash = crush_hash_seed ^ la ^ lb ^ lc;
+		__u32 x = 231232;
+		__u32 y = 1232;
+		crush_hashmix(la, lb, hash);
+		crush_hashmix(lc, x, hash);
+		crush_hashmix(y, la, hash);
+		crush_hashmix(lb, x, hash);
+		crush_hashmix(y, lc, hash);
+		hashes[i] = hash;
+	}
+}
+
+/*
+ * crush_hash32_rjenkins1_3 for n values of a at once, interleaved like
+ * crush_hash32_rjenkins1_3_b
+ */
+static void crush_hash32_rjenkins1_3_a(const __s32 *a, __u32 b, __u32 c,
+				       __u32 *hashes, int n)
+{
+	int i;
+	for (i = 0; i < n; i++) {
+		__u32 la = a[i];
+		__u32 lb = b;
+		__u32 lc = c;
+		__u32 hash = crush_hash_seed ^ la ^ lb ^ lc;
+		__u32 x = 231232;
+		__u32 y = 1232;
+		crush_hashmix(la, lb, hash);
+		crush_hashmix(lc, x, hash);
+		crush_hashmix(y, la, hash);
+		crush_hashmix(lb, x, hash);
+		crush_hashmix(y, lc, hash);
+		hashes[i] = hash;
+	}
+}
+
+void crush_hash32_3_a(int type, const __s32 *a, __u32 b, __u32 c,
+		      __u32 *hashes, int n)
+{
+	switch (type) {
+	case CRUSH_HASH_RJENKINS1:
+		crush_hash32_rjenkins1_3_a(a, b, c, hashes, n);
+		break;
+	default:
+		memset(hashes, 0, sizeof(__u32) * n);
+	}
+}
+
+void crush_hash32_3_b(int type, __u32 a, const __s32 *b, __u32 c,
+		      __u32 *hashes, int n)
+{
+	switch (type) {
+	case CRUSH_HASH_RJENKINS1:
+		crush_hash32_rjenkins1_3_b(a, b, c, hashes, n);
+		break;
+	default:
+		memset(hashes, 0, sizeof(__u32) * n);
+	}
+}
+#endif
+
 const char *crush_hash_name(int type)
 {
 	switch (type) {
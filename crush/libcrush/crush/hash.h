@@ -19,5 +19,13 @@ extern __u32 crush_hash32_3(int type, __u32 a, __u32 b, __u32 c);
 extern __u32 crush_hash32_4(int type, __u32 a, __u32 b, __u32 c, __u32 d);
 extern __u32 crush_hash32_5(int type, __u32 a, __u32 b, __u32 c, __u32 d,
 			    __u32 e);
+#ifndef __KERNEL__
+/* hashes[i] = crush_hash32_3(type, a[i], b, c) for i in [0,n[ */
+extern void crush_hash32_3_a(int type, const __s32 *a, __u32 b, __u32 c,
+			     __u32 *hashes, int n);
+/* hashes[i] = crush_hash32_3(type, a, b[i], c) for i in [0,n[ */
+extern void crush_hash32_3_b(int type, __u32 a, const __s32 *b, __u32 c,
+			     __u32 *hashes, int n);
+#endif
 
 #endif
@@ -18,6 +18,7 @@
 # include <linux/crush/crush.h>
 # include <linux/crush/hash.h>
 #else
+# include <errno.h>
 # include "crush_compat.h"
 # include "crush.h"
 # include "hash.h"
@@ -312,6 +313,51 @@ static inline __u32 *get_choose_arg_weights(const struct crush_bucket_straw2 *bu
   return arg->weight_set[position].weights;
 }
 
+#ifndef __KERNEL__
+static inline struct crush_reciprocal *get_choose_arg_reciprocals(const struct crush_bucket_straw2 *bucket,
+                                                                  const struct crush_choose_arg *arg,
+                                                                  int position)
+{
+  if ((arg == NULL) ||
+      (arg->weight_set == NULL) ||
+      (arg->weight_set_size == 0))
+    return bucket->item_reciprocals;
+  if (position >= arg->weight_set_size)
+    position = arg->weight_set_size - 1;
+  return arg->weight_set[position].reciprocals;
+}
+
+/* high 64 bits of the 128 bits product of a and b */
+static inline __u64 crush_mulhi64(__u64 a, __u64 b)
+{
+#ifdef __SIZEOF_INT128__
+	return (__u64)(((unsigned __int128)a * b) >> 64);
+#else
+	__u64 a_lo = (__u32)a, a_hi = a >> 32;
+	__u64 b_lo = (__u32)b, b_hi = b >> 32;
+	__u64 lo_lo = a_lo * b_lo;
+	__u64 hi_lo = a_hi * b_lo;
+	__u64 lo_hi = a_lo * b_hi;
+	__u64 cross = (lo_lo >> 32) + (__u32)hi_lo + lo_hi;
+	return (hi_lo >> 32) + (cross >> 32) + a_hi * b_hi;
+#endif
+}
+
+/*
+ * same as div64_s64(dividend, reciprocal->divisor): the unsigned
+ * quotient is computed as in Granlund and Montgomery figure 4.1 and the
+ * sign applied afterwards so that it rounds toward zero, like the
+ * division
+ */
+static inline __s64 crush_reciprocal_div(__s64 dividend, const struct crush_reciprocal *reciprocal)
+{
+	__u64 n = dividend < 0 ? -(__u64)dividend : (__u64)dividend;
+	__u64 t = crush_mulhi64(reciprocal->multiplier, n);
+	__u64 q = (t + ((n - t) >> reciprocal->shift1)) >> reciprocal->shift2;
+	return dividend < 0 ? -(__s64)q : (__s64)q;
+}
+#endif
+
 static inline int *get_choose_arg_ids(const struct crush_bucket_straw2 *bucket,
                                         const struct crush_choose_arg *arg)
 {
@@ -329,6 +375,9 @@ static int bucket_straw2_choose(const struct crush_bucket_straw2 *bucket,
 	__s64 ln, draw, high_draw = 0;
         __u32 *weights = get_choose_arg_weights(bucket, arg, position);
         int *ids = get_choose_arg_ids(bucket, arg);
+#ifndef __KERNEL__
+	struct crush_reciprocal *reciprocals = get_choose_arg_reciprocals(bucket, arg, position);
+#endif
 	for (i = 0; i < bucket->h.size; i++) {
                 dprintk("weight 0x%x item %d\n", weights[i], ids[i]);
 		if (weights[i]) {
@@ -353,6 +402,11 @@ static int bucket_straw2_choose(const struct crush_bucket_straw2 *bucket,
 			 * weight means a larger (less negative) value
 			 * for draw.
 			 */
+#ifndef __KERNEL__
+			if (reciprocals && reciprocals[i].divisor == weights[i])
+				draw = crush_reciprocal_div(ln, &reciprocals[i]);
+			else
+#endif
 			draw = div64_s64(ln, weights[i]);
 		} else {
 			draw = S64_MIN;
@@ -367,8 +421,107 @@ static int bucket_straw2_choose(const struct crush_bucket_straw2 *bucket,
 	return bucket->h.items[high];
 }
 
+#ifndef __KERNEL__
+/*
+ * Same as bucket_straw2_choose but the hashes and the natural logs of
+ * CRUSH_STRAW2_BLOCK items are computed in separate loops that do not
+ * depend on each other and can be vectorized by the compiler. The
+ * draws are then compared in the same order as bucket_straw2_choose so
+ * that the result is the same.
+ */
+#define CRUSH_STRAW2_BLOCK 64
+
+static int bucket_straw2_choose_block(const struct crush_bucket_straw2 *bucket,
+				      int x, int r, const struct crush_choose_arg *arg,
+				      int position)
+{
+	unsigned int i, j, n, high = 0;
+	__u32 hashes[CRUSH_STRAW2_BLOCK];
+	__s64 lns[CRUSH_STRAW2_BLOCK];
+	__s64 draw, high_draw = 0;
+	__u32 *weights = get_choose_arg_weights(bucket, arg, position);
+	int *ids = get_choose_arg_ids(bucket, arg);
+	struct crush_reciprocal *reciprocals = get_choose_arg_reciprocals(bucket, arg, position);
+
+	for (i = 0; i < bucket->h.size; i += n) {
+		n = bucket->h.size - i;
+		if (n > CRUSH_STRAW2_BLOCK)
+			n = CRUSH_STRAW2_BLOCK;
+		crush_hash32_3_b(bucket->h.hash, x, ids + i, r, hashes, n);
+		for (j = 0; j < n; j++)
+			lns[j] = crush_ln(hashes[j] & 0xffff) - 0x1000000000000ll;
+		for (j = 0; j < n; j++) {
+			__u32 weight = weights[i + j];
+			if (weight) {
+				if (reciprocals && reciprocals[i + j].divisor == weight)
+					draw = crush_reciprocal_div(lns[j], &reciprocals[i + j]);
+				else
+					draw = div64_s64(lns[j], weight);
+			} else {
+				draw = S64_MIN;
+			}
+			if (i + j == 0 || draw > high_draw) {
+				high = i + j;
+				high_draw = draw;
+			}
+		}
+	}
+
+	return bucket->h.items[high];
+}
+
+/*
+ * Same as bucket_straw2_choose but the ln(hash) of the items are
+ * cached in work->lns, see crush_use_lns.
+ */
+static int bucket_straw2_choose_lns(const struct crush_bucket_straw2 *bucket,
+				    struct crush_work_bucket *work,
+				    int x, int r, const struct crush_choose_arg *arg,
+				    int position)
+{
+	unsigned int i, j, n, high = 0;
+	__u32 hashes[CRUSH_STRAW2_BLOCK];
+	__s64 draw, high_draw = 0;
+	__u32 *weights = get_choose_arg_weights(bucket, arg, position);
+	int *ids = get_choose_arg_ids(bucket, arg);
+	struct crush_reciprocal *reciprocals = get_choose_arg_reciprocals(bucket, arg, position);
+	size_t row = (size_t)*work->lns_index * work->lns_r_max + r;
+	__s64 *lns = work->lns + row * bucket->h.size;
+
+	if (!work->lns_filled[row]) {
+		for (i = 0; i < bucket->h.size; i += n) {
+			n = bucket->h.size - i;
+			if (n > CRUSH_STRAW2_BLOCK)
+				n = CRUSH_STRAW2_BLOCK;
+			crush_hash32_3_b(bucket->h.hash, x, ids + i, r, hashes, n);
+			for (j = 0; j < n; j++)
+				lns[i + j] = crush_ln(hashes[j] & 0xffff) - 0x1000000000000ll;
+		}
+		work->lns_filled[row] = 1;
+	}
 
-static int crush_bucket_choose(const struct crush_bucket *in,
+	for (i = 0; i < bucket->h.size; i++) {
+		__u32 weight = weights[i];
+		if (weight) {
+			if (reciprocals && reciprocals[i].divisor == weight)
+				draw = crush_reciprocal_div(lns[i], &reciprocals[i]);
+			else
+				draw = div64_s64(lns[i], weight);
+		} else {
+			draw = S64_MIN;
+		}
+		if (i == 0 || draw > high_draw) {
+			high = i;
+			high_draw = draw;
+		}
+	}
+
+	return bucket->h.items[high];
+}
+#endif
+
+static int crush_bucket_choose(const struct crush_map *map,
+			       const struct crush_bucket *in,
 			       struct crush_work_bucket *work,
 			       int x, int r,
                                const struct crush_choose_arg *arg,
@@ -392,6 +545,22 @@ static int crush_bucket_choose(const struct crush_bucket *in,
 			(const struct crush_bucket_straw *)in,
 			x, r);
 	case CRUSH_BUCKET_STRAW2:
+#ifndef __KERNEL__
+		/* the choices were prepared with the weights of position 0 */
+		if ((__u32)r < work->choices_n && work->choices_x == (__u32)x &&
+		    (position == 0 ||
+		     get_choose_arg_weights((const struct crush_bucket_straw2 *)in, arg, position) ==
+		     get_choose_arg_weights((const struct crush_bucket_straw2 *)in, arg, 0)))
+			return work->choices[r];
+		if ((__u32)r < work->lns_r_max)
+			return bucket_straw2_choose_lns(
+				(const struct crush_bucket_straw2 *)in,
+				work, x, r, arg, position);
+		if (map->straw2_block)
+			return bucket_straw2_choose_block(
+				(const struct crush_bucket_straw2 *)in,
+				x, r, arg, position);
+#endif
 		return bucket_straw2_choose(
 			(const struct crush_bucket_straw2 *)in,
 			x, r, arg, position);
@@ -421,6 +590,54 @@ static int is_out(const struct crush_map *map,
 	return 1;
 }
 
+/*
+ * Record that item was chosen from the bucket in, see crush_use_record.
+ */
+static inline void crush_record(struct crush_work *work, int in, int item)
+{
+#ifndef __KERNEL__
+	if (work->record == NULL)
+		return;
+	if (work->record_size + 2 <= work->record_max) {
+		work->record[work->record_size] = in;
+		work->record[work->record_size + 1] = item;
+	}
+	work->record_size += 2;
+#endif
+}
+
+/*
+ * Count the choices in the crush_stats of the workspace, if any, see
+ * crush_use_stats.
+ */
+#ifndef __KERNEL__
+#define crush_stats_inc(work, counter) \
+	do { if ((work)->stats) (work)->stats->counter++; } while (0)
+#else
+#define crush_stats_inc(work, counter) do { } while (0)
+#endif
+
+static inline void crush_stats_collision(struct crush_work *work, int in)
+{
+#ifndef __KERNEL__
+	if (work->stats == NULL)
+		return;
+	work->stats->collisions++;
+	work->stats->bucket_collisions[-1-in]++;
+#endif
+}
+
+static inline void crush_stats_chosen(struct crush_work *work, unsigned int ftotal)
+{
+#ifndef __KERNEL__
+	if (work->stats == NULL)
+		return;
+	if (ftotal >= (unsigned int)work->stats->choose_tries_size)
+		ftotal = work->stats->choose_tries_size - 1;
+	work->stats->choose_tries[ftotal]++;
+#endif
+}
+
 /**
  * crush_choose_firstn - choose numrep distinct items of given type
  * @map: the crush_map
@@ -485,6 +702,7 @@ parent_r %d stable %d\n",
 		do {
 			retry_descent = 0;
 			in = bucket;              /* initial bucket */
+			crush_stats_inc(work, tries);
 
 			/* choose through intervening buckets */
 			flocal = 0;
@@ -508,10 +726,11 @@ parent_r %d stable %d\n",
 						x, r);
 				else
 					item = crush_bucket_choose(
-						in, work->work[-1-in->id],
+						map, in, work->work[-1-in->id],
 						x, r,
                                                 (choose_args ? &choose_args[-1-in->id] : 0),
                                                 outpos);
+				crush_record(work, in->id, item);
 				if (item >= map->max_devices) {
 					dprintk("   bad item %d\n", item);
 					skip_rep = 1;
@@ -545,6 +764,8 @@ parent_r %d stable %d\n",
 						break;
 					}
 				}
+				if (collide)
+					crush_stats_collision(work, in->id);
 
 				reject = 0;
 				if (!collide && recurse_to_leaf) {
@@ -580,10 +801,13 @@ parent_r %d stable %d\n",
 
 				if (!reject && !collide) {
 					/* out? */
-					if (itemtype == 0)
+					if (itemtype == 0) {
 						reject = is_out(map, weight,
 								weight_max,
 								item, x);
+						if (reject)
+							crush_stats_inc(work, rejects);
+					}
 				}
 
 reject:
@@ -604,6 +828,8 @@ reject:
 					else
 						/* else give up */
 						skip_rep = 1;
+					if (retry_bucket)
+						crush_stats_inc(work, local_retries);
 					dprintk("  reject %d  collide %d  "
 						"ftotal %u  flocal %u\n",
 						reject, collide, ftotal,
@@ -621,6 +847,7 @@ reject:
 		out[outpos] = item;
 		outpos++;
 		count--;
+		crush_stats_chosen(work, ftotal);
 #ifndef __KERNEL__
 		if (map->choose_tries && ftotal <= map->choose_total_tries)
 			map->choose_tries[ftotal]++;
@@ -689,6 +916,7 @@ static void crush_choose_indep(const struct crush_map *map,
 				continue;
 
 			in = bucket;  /* initial bucket */
+			crush_stats_inc(work, tries);
 
 			/* choose through intervening buckets */
 			for (;;) {
@@ -718,10 +946,11 @@ static void crush_choose_indep(const struct crush_map *map,
 				}
 
 				item = crush_bucket_choose(
-					in, work->work[-1-in->id],
+					map, in, work->work[-1-in->id],
 					x, r,
                                         (choose_args ? &choose_args[-1-in->id] : 0),
                                         outpos);
+				crush_record(work, in->id, item);
 				if (item >= map->max_devices) {
 					dprintk("   bad item %d\n", item);
 					out[rep] = CRUSH_ITEM_NONE;
@@ -762,8 +991,10 @@ static void crush_choose_indep(const struct crush_map *map,
 						break;
 					}
 				}
-				if (collide)
+				if (collide) {
+					crush_stats_collision(work, in->id);
 					break;
+				}
 
 				if (recurse_to_leaf) {
 					if (item < 0) {
@@ -788,12 +1019,15 @@ static void crush_choose_indep(const struct crush_map *map,
 
 				/* out? */
 				if (itemtype == 0 &&
-				    is_out(map, weight, weight_max, item, x))
+				    is_out(map, weight, weight_max, item, x)) {
+					crush_stats_inc(work, rejects);
 					break;
+				}
 
 				/* yay! */
 				out[rep] = item;
 				left--;
+				crush_stats_chosen(work, ftotal);
 				break;
 			}
 		}
@@ -850,6 +1084,12 @@ void crush_init_workspace(const struct crush_map *m, void *v) {
 	char *point = (char *)v;
 	__s32 b;
 	point += sizeof(struct crush_work);
+#ifndef __KERNEL__
+	w->record = NULL;
+	w->record_max = 0;
+	w->record_size = 0;
+	w->stats = NULL;
+#endif
 	w->work = (struct crush_work_bucket **)point;
 	point += m->max_buckets * sizeof(struct crush_work_bucket *);
 	for (b = 0; b < m->max_buckets; ++b) {
@@ -865,6 +1105,15 @@ void crush_init_workspace(const struct crush_map *m, void *v) {
 		w->work[b]->perm_x = 0;
 		w->work[b]->perm_n = 0;
 		w->work[b]->perm = (__u32 *)point;
+#ifndef __KERNEL__
+		w->work[b]->choices_x = 0;
+		w->work[b]->choices_n = 0;
+		w->work[b]->choices = NULL;
+		w->work[b]->lns_r_max = 0;
+		w->work[b]->lns_index = NULL;
+		w->work[b]->lns = NULL;
+		w->work[b]->lns_filled = NULL;
+#endif
 		point += m->buckets[b]->size * sizeof(__u32);
 	}
 	BUG_ON((char *)point - (char *)w != m->working_size);
@@ -939,6 +1188,7 @@ int crush_do_rule(const struct crush_map *map,
 			     map->buckets[-1-curstep->arg1])) {
 				w[0] = curstep->arg1;
 				wsize = 1;
+				crush_record(cw, curstep->arg1, curstep->arg1);
 			} else {
 				dprintk(" bad take value %d\n", curstep->arg1);
 			}
@@ -1087,3 +1337,132 @@ int crush_do_rule(const struct crush_map *map,
 
 	return result_len;
 }
+
+#ifndef __KERNEL__
+int crush_reciprocal_check(__u32 divisor)
+{
+	struct crush_reciprocal reciprocal;
+	unsigned int u;
+	int mismatches = 0;
+
+	crush_reciprocal_init(&reciprocal, divisor);
+	for (u = 0; u <= 0xffff; u++) {
+		__s64 ln = crush_ln(u) - 0x1000000000000ll;
+		if (crush_reciprocal_div(ln, &reciprocal) != div64_s64(ln, divisor))
+			mismatches++;
+	}
+	return mismatches;
+}
+#endif
+
+#ifndef __KERNEL__
+/*
+ * The straw2 draws of a child are computed for CRUSH_STRAW2_BLOCK values
+ * at once: the hashes are interleaved by crush_hash32_3_a and the
+ * highest draw of each value is kept in an array, so that there are no
+ * dependencies between values within a block.
+ */
+int crush_prepare_choices(const struct crush_map *map,
+			  const struct crush_choose_arg *choose_args,
+			  int bucket_id, const int *xs, int n, int r_max,
+			  int *choices)
+{
+	const struct crush_bucket_straw2 *bucket;
+	const struct crush_choose_arg *arg;
+	__u32 *weights;
+	int *ids;
+	struct crush_reciprocal *reciprocals;
+	__u32 hashes[CRUSH_STRAW2_BLOCK];
+	__s64 draws[CRUSH_STRAW2_BLOCK];
+	__s64 high_draw[CRUSH_STRAW2_BLOCK];
+	int high[CRUSH_STRAW2_BLOCK];
+	int v, i, j, m, r;
+
+	if (bucket_id >= 0 || -1-bucket_id >= map->max_buckets ||
+	    map->buckets[-1-bucket_id] == NULL ||
+	    map->buckets[-1-bucket_id]->alg != CRUSH_BUCKET_STRAW2 ||
+	    map->buckets[-1-bucket_id]->size == 0)
+		return -EINVAL;
+	bucket = (const struct crush_bucket_straw2 *)map->buckets[-1-bucket_id];
+	arg = choose_args ? &choose_args[-1-bucket_id] : NULL;
+	weights = get_choose_arg_weights(bucket, arg, 0);
+	ids = get_choose_arg_ids(bucket, arg);
+	reciprocals = get_choose_arg_reciprocals(bucket, arg, 0);
+
+	for (r = 0; r < r_max; r++) {
+		for (v = 0; v < n; v += m) {
+			m = n - v;
+			if (m > CRUSH_STRAW2_BLOCK)
+				m = CRUSH_STRAW2_BLOCK;
+			for (i = 0; i < bucket->h.size; i++) {
+				__u32 weight = weights[i];
+				int reciprocal = reciprocals && reciprocals[i].divisor == weight;
+				crush_hash32_3_a(bucket->h.hash, xs + v, ids[i], r, hashes, m);
+				if (weight == 0) {
+					for (j = 0; j < m; j++)
+						draws[j] = S64_MIN;
+				} else {
+					for (j = 0; j < m; j++)
+						draws[j] = crush_ln(hashes[j] & 0xffff) - 0x1000000000000ll;
+					if (reciprocal)
+						for (j = 0; j < m; j++)
+							draws[j] = crush_reciprocal_div(draws[j], &reciprocals[i]);
+					else
+						for (j = 0; j < m; j++)
+							draws[j] = div64_s64(draws[j], weight);
+				}
+				for (j = 0; j < m; j++) {
+					if (i == 0 || draws[j] > high_draw[j]) {
+						high[j] = i;
+						high_draw[j] = draws[j];
+					}
+				}
+			}
+			for (j = 0; j < m; j++)
+				choices[(v + j) * r_max + r] = bucket->h.items[high[j]];
+		}
+	}
+	return 0;
+}
+
+void crush_use_choices(const struct crush_map *map, void *cwin, int bucket_id,
+		       int x, const int *choices, int r_max)
+{
+	struct crush_work *w = (struct crush_work *)cwin;
+	struct crush_work_bucket *work = w->work[-1-bucket_id];
+	work->choices_x = x;
+	work->choices_n = r_max;
+	work->choices = choices;
+}
+
+void crush_use_lns(const struct crush_map *map, void *cwin, int bucket_id,
+		   __s64 *lns, unsigned char *filled, int r_max, const int *index)
+{
+	struct crush_work *w = (struct crush_work *)cwin;
+	struct crush_work_bucket *work = w->work[-1-bucket_id];
+	work->lns_r_max = lns ? r_max : 0;
+	work->lns_index = index;
+	work->lns = lns;
+	work->lns_filled = filled;
+}
+
+void crush_use_record(void *cwin, int *record, int record_max)
+{
+	struct crush_work *w = (struct crush_work *)cwin;
+	w->record = record;
+	w->record_max = record_max;
+	w->record_size = 0;
+}
+
+int crush_recorded(void *cwin)
+{
+	struct crush_work *w = (struct crush_work *)cwin;
+	return w->record_size;
+}
+
+void crush_use_stats(void *cwin, struct crush_stats *stats)
+{
+	struct crush_work *w = (struct crush_work *)cwin;
+	w->stats = stats;
+}
+#endif
@@ -90,4 +90,113 @@ static inline size_t crush_work_size(const struct crush_map *map,
 
 extern void crush_init_workspace(const struct crush_map *m, void *v);
 
+#ifndef __KERNEL__
+/** @ingroup API
+ *
+ * Compare the straw2 draws computed with the reciprocal of __divisor__
+ * to the draws computed with a division, for every possible
+ * 16 bits hash.
+ *
+ * @param divisor the straw2 weight, > 0
+ *
+ * @return the number of draws that differ, always 0
+ */
+extern int crush_reciprocal_check(__u32 divisor);
+
+/** @ingroup API
+ *
+ * Compute the items the straw2 bucket __bucket_id__ chooses for each
+ * of the __n__ values __xs__ and each r in [0,__r_max__[, at position
+ * 0, and store them in __choices[v * r_max + r]__. They are computed
+ * for many values at once, which is faster than one value at a time.
+ *
+ * @param map the crush_map
+ * @param choose_args the same as given to crush_do_rule()
+ * @param bucket_id the straw2 bucket, usually the first take of a rule
+ * @param xs the values to be mapped
+ * @param n the size of __xs__
+ * @param r_max the number of replicas
+ * @param choices an array of size __n__ * __r_max__
+ *
+ * @return 0 on success, -EINVAL if __bucket_id__ is not a straw2 bucket
+ */
+extern int crush_prepare_choices(const struct crush_map *map,
+				 const struct crush_choose_arg *choose_args,
+				 int bucket_id, const int *xs, int n, int r_max,
+				 int *choices);
+/** @ingroup API
+ *
+ * Make the next crush_do_rule() with __cwin__ for value __x__ use
+ * the __choices__ computed by crush_prepare_choices() for __x__
+ * instead of computing them again. The __choices__ are only used for
+ * __x__ and must not be freed while they are in use. Set __r_max__
+ * to 0 to stop using them.
+ */
+extern void crush_use_choices(const struct crush_map *map, void *cwin, int bucket_id,
+			      int x, const int *choices, int r_max);
+/** @ingroup API
+ *
+ * Make crush_do_rule() with __cwin__ cache the ln(hash) terms of the
+ * straw2 bucket __bucket_id__, for r in [0,__r_max__[. They do not
+ * depend on the weights and are computed once per value, the
+ * following mappings only compare the draws with the current weights
+ * or weight_set. Other r values, for instance when retrying after a
+ * collision, are computed as usual.
+ *
+ * The value being mapped is identified by *__index__, which must be
+ * set before each crush_do_rule(). The row of ln for __index__ and r
+ * is __lns__ + (__index__ * __r_max__ + r) * size, where size is the
+ * size of the bucket, and is computed if __filled__[__index__ *
+ * __r_max__ + r] is zero. The rows are only valid for the ids of the
+ * bucket (or the ids of the choose_args) they were computed with.
+ *
+ * @param map the crush_map
+ * @param cwin the workspace given to crush_do_rule()
+ * @param bucket_id the straw2 bucket
+ * @param lns the cached ln(hash) rows or NULL to stop using them
+ * @param filled the rows of __lns__ that are computed
+ * @param r_max the number of rows for each value
+ * @param index the index of the value being mapped
+ */
+extern void crush_use_lns(const struct crush_map *map, void *cwin, int bucket_id,
+			  __s64 *lns, unsigned char *filled, int r_max, const int *index);
+/** @ingroup API
+ *
+ * Make crush_do_rule() with __cwin__ record the ids of the buckets
+ * it chooses from and the items it chooses, including the items that
+ * are rejected or collide, in __record__. A mapping can only change
+ * if the weights, ids or items of one of the recorded buckets change
+ * or if one of the recorded items is removed. Each choice is recorded
+ * as a pair (bucket id, item id) and the take step as (id, id).
+ * Recording starts again from the beginning of __record__ each time
+ * crush_use_record() is called.
+ *
+ * @param cwin the workspace given to crush_do_rule()
+ * @param record an array of __record_max__ ids or NULL to stop recording
+ * @param record_max the size of __record__
+ */
+extern void crush_use_record(void *cwin, int *record, int record_max);
+/** @ingroup API
+ *
+ * Return the number of ids recorded since crush_use_record(). If it is
+ * greater than __record_max__, the ids that did not fit were lost.
+ *
+ * @param cwin the workspace given to crush_do_rule()
+ */
+extern int crush_recorded(void *cwin);
+/** @ingroup API
+ *
+ * Make crush_do_rule() with __cwin__ count its choices in __stats__:
+ * the descents it tries, the choices retried in the same bucket, the
+ * devices rejected because they are out and the items that collide
+ * with an item already chosen, in total and for each bucket. The
+ * number of failed descents before each item is chosen is counted in
+ * __stats->choose_tries__. The counters are not reset.
+ *
+ * @param cwin the workspace given to crush_do_rule()
+ * @param stats the counters or NULL to stop counting
+ */
+extern void crush_use_stats(void *cwin, struct crush_stats *stats);
+#endif
+
 #endif
@@ -20,6 +20,8 @@
 #include "libcrush.h"
 
 #include <bytesobject.h>
+#include <errno.h>
+#include <pthread.h>
 
 #include "hash.h"
 #include "builder.h"
@@ -34,14 +36,27 @@ LibCrush_init(LibCrush *self, PyObject *args, PyObject *kwds)
 {
   self->verbose = 0;
   self->backward_compatibility = 0;
+  self->reciprocals = 1;
+  self->straw2_block = 1;
+  self->interleave = 1;
 
-  static char *kwlist[] = {"verbose", "backward_compatibility", NULL};
-  if (!PyArg_ParseTupleAndKeywords(args, kwds, "|ii", kwlist,
+  static char *kwlist[] = {"verbose", "backward_compatibility", "reciprocals", "straw2_block",
+                           "interleave", NULL};
+  if (!PyArg_ParseTupleAndKeywords(args, kwds, "|iiiii", kwlist,
                                    &self->verbose,
-                                   &self->backward_compatibility))
+                                   &self->backward_compatibility,
+                                   &self->reciprocals,
+                                   &self->straw2_block,
+                                   &self->interleave))
     return RET_ERROR;
 
   self->map = NULL;
+  self->mapping = 0;
+  self->work = NULL;
+  self->work_result_max = 0;
+  self->work_initialized = 0;
+  self->default_weights = NULL;
+  self->serial = 0;
   self->tunables = crush_create();
 
   if (self->tunables == NULL) {
@@ -62,6 +77,8 @@ LibCrush_dealloc(LibCrush *self)
 {
   if (self->map != NULL)
     crush_destroy(self->map);
+  free(self->work);
+  free(self->default_weights);
   if (self->tunables != NULL)
     crush_destroy(self->tunables);
   Py_DECREF(self->types);
@@ -72,6 +89,21 @@ LibCrush_dealloc(LibCrush *self)
   Py_TYPE(self)->tp_free((PyObject*)self);
 }
 
+//
+// A trace records what parse() and the functions parsing choose_args
+// do, to be printed when verbose is set. It is NULL otherwise and
+// TRACE() does nothing: nothing is allocated or formatted. A trace
+// record is a (format, arguments) tuple keeping the bucket ids, step
+// indexes and parsed objects as they are. The message is only
+// formatted by print_trace(), with format % arguments. When a call
+// fails, the last record is ("error %s", (message,)).
+//
+#define TRACE(trace, format, arguments_format, ...)                       \
+  do {                                                                  \
+    if ((trace) != NULL)                                                \
+      append_trace(trace, Py_BuildValue("(s(" arguments_format "))", format, __VA_ARGS__)); \
+  } while (0)
+
 static void append_trace(PyObject *trace, PyObject *object)
 {
   if (object == NULL) // may happen on Control-C
@@ -80,6 +112,13 @@ static void append_trace(PyObject *trace, PyObject *object)
   Py_DECREF(object);
 }
 
+static PyObject *trace_new(LibCrush *self)
+{
+  if (!self->verbose)
+    return NULL;
+  return PyList_New(0);
+}
+
 static int parse_types(LibCrush *self, PyObject *map, PyObject *trace)
 {
   PyDict_Clear(self->types);
@@ -88,7 +127,7 @@ static int parse_types(LibCrush *self, PyObject *map, PyObject *trace)
   if (types == NULL)
     return 1;
 
-  append_trace(trace, PyUnicode_FromFormat("types %S", types));
+  TRACE(trace, "types %s", "O", types);
 
   if (!PyList_Check(types)) {
     PyErr_Format(PyExc_RuntimeError, "must be a list");
@@ -131,7 +170,7 @@ static int parse_type(LibCrush *self, PyObject *bucket, int *typeout, PyObject *
   if (type_name == NULL) {
     *typeout = -1;
   } else {
-    append_trace(trace, PyUnicode_FromFormat("type %S", type_name));
+    TRACE(trace, "type %s", "O", type_name);
     if (MyText_AsString(type_name) == NULL)
       return 0;
     if (!PyDict_Contains(self->types, type_name)) {
@@ -161,14 +200,14 @@ static int parse_bucket_id(LibCrush *self, PyObject *bucket, int *idout, PyObjec
   PyObject *id = PyDict_GetItemString(bucket, "id");
   if (id == NULL) {
     *idout = crush_get_next_bucket_id(self->map);
-    append_trace(trace, PyUnicode_FromFormat("id %d (default)", *idout));
+    TRACE(trace, "id %d (default)", "i", *idout);
     PyObject *python_id = MyInt_FromInt(*idout);
     int r = PyDict_SetItemString(bucket, "id", python_id);
     Py_DECREF(python_id);
     if (r < 0)
       return r;
   } else {
-    append_trace(trace, PyUnicode_FromFormat("id %S", id));
+    TRACE(trace, "id %s", "O", id);
     *idout = MyInt_AsInt(id);
     if (PyErr_Occurred())
       return 0;
@@ -187,7 +226,7 @@ static int parse_device_id(LibCrush *self, PyObject *bucket, int *idout, PyObjec
     PyErr_SetString(PyExc_RuntimeError, "missing id");
     return 0;
   } else {
-    append_trace(trace, PyUnicode_FromFormat("id %S", id));
+    TRACE(trace, "id %s", "O", id);
     *idout = MyInt_AsInt(id);
     if (PyErr_Occurred())
       return 0;
@@ -207,7 +246,7 @@ static int parse_bucket_algorithm(LibCrush *self, PyObject *bucket, int *algorit
   if (algorithm == NULL) {
     *algorithmout = CRUSH_BUCKET_STRAW2;
   } else {
-    append_trace(trace, PyUnicode_FromFormat("algorithm %S", algorithm));
+    TRACE(trace, "algorithm %s", "O", algorithm);
     const char *a = MyText_AsString(algorithm);
     if (a == NULL)
       return 0;
@@ -238,13 +277,13 @@ static int parse_weight(LibCrush *self, PyObject *item, int *weightout, PyObject
   if (weight == NULL) {
     *weightout = 0x10000;
   } else {
-    append_trace(trace, PyUnicode_FromFormat("weight %S", weight));
+    TRACE(trace, "weight %s", "O", weight);
     if (!MyInt_Check(weight)) {
       PyErr_SetString(PyExc_RuntimeError, "weight must be an int");
       return 0;
     }
     *weightout = MyInt_AsInt(weight);
-    append_trace(trace, PyUnicode_FromFormat("weight %d", *weightout));
+    TRACE(trace, "weight %d", "i", *weightout);
     if (PyErr_Occurred())
       return 0;
   }
@@ -290,7 +329,7 @@ static int parse_bucket_or_device(LibCrush *self, PyObject *bucket, int *idout,
 
 static int parse_bucket(LibCrush *self, PyObject *bucket, int *idout, int *weightout, PyObject *trace)
 {
-  append_trace(trace, PyUnicode_FromFormat("bucket content %S", bucket));
+  TRACE(trace, "bucket content %s", "O", bucket);
   int id;
   if (!parse_bucket_id(self, bucket, &id, trace))
     return 0;
@@ -353,7 +392,7 @@ static int parse_bucket(LibCrush *self, PyObject *bucket, int *idout, int *weigh
   if (children != NULL) {
     for (pos = 0; pos < PyList_Size(children); pos++) {
       PyObject *item = PyList_GetItem(children, pos);
-      append_trace(trace, PyUnicode_FromFormat("bucket or device %S", item));
+      TRACE(trace, "bucket or device %s", "O", item);
       if (!PyDict_Check(item)) {
         PyErr_Format(PyExc_RuntimeError, "must be a dict");
         return 0;
@@ -393,7 +432,7 @@ static int parse_reference_id(LibCrush *self, PyObject *bucket, int *idout, PyOb
     PyErr_SetString(PyExc_RuntimeError, "missing reference_id");
     return 0;
   } else {
-    append_trace(trace, PyUnicode_FromFormat("reference_id %S", id));
+    TRACE(trace, "reference_id %s", "O", id);
     *idout = MyInt_AsInt(id);
     if (PyErr_Occurred())
       return 0;
@@ -403,7 +442,7 @@ static int parse_reference_id(LibCrush *self, PyObject *bucket, int *idout, PyOb
 
 static int parse_reference(LibCrush *self, PyObject *bucket, int *idout, int *weightout, PyObject *trace)
 {
-  append_trace(trace, PyUnicode_FromFormat("reference content %S", bucket));
+  TRACE(trace, "reference content %s", "O", bucket);
 
   if (!parse_reference_id(self, bucket, idout, trace))
     return 0;
@@ -428,7 +467,7 @@ static int parse_reference(LibCrush *self, PyObject *bucket, int *idout, int *we
 
 static int parse_device(LibCrush *self, PyObject *device, int *idout, int *weightout, PyObject *trace)
 {
-  append_trace(trace, PyUnicode_FromFormat("device content %S", device));
+  TRACE(trace, "device content %s", "O", device);
   if (!parse_device_id(self, device, idout, trace))
     return 0;
   if (!parse_weight(self, device, weightout, trace))
@@ -475,10 +514,13 @@ static int print_trace(PyObject *trace)
     return 0;
   Py_ssize_t i;
   for (i = 0; i < PyList_Size(trace); i++) {
-    const char *msg = MyText_AsString(PyList_GetItem(trace, i));
-    if (msg == NULL)
-      PyFile_WriteString("unexpected NULL pointer instead of message", f);
-    if (PyFile_WriteString(msg, f) != 0)
+    PyObject *record = PyList_GetItem(trace, i);
+    PyObject *message = PyNumber_Remainder(PyTuple_GET_ITEM(record, 0), PyTuple_GET_ITEM(record, 1));
+    if (message == NULL)
+      return 0;
+    int r = PyFile_WriteObject(message, f, Py_PRINT_RAW);
+    Py_DECREF(message);
+    if (r != 0)
       return 0;
     if (PyFile_WriteString("\n", f) != 0)
       return 0;
@@ -486,9 +528,27 @@ static int print_trace(PyObject *trace)
   return 1;
 }
 
+//
+// Print the trace, if any, once the traced call returned r. The
+// exception set by a failed call is preserved.
+//
+static void trace_end(PyObject *trace, int r)
+{
+  if (trace == NULL)
+    return;
+  PyObject *type, *value, *traceback;
+  PyErr_Fetch(&type, &value, &traceback);
+  if (!r && value != NULL)
+    TRACE(trace, "error %s", "O", value);
+  if (!print_trace(trace))
+    PyErr_Clear();
+  PyErr_Restore(type, value, traceback);
+  Py_DECREF(trace);
+}
+
 static int reweight(LibCrush *self, int root, PyObject *trace)
 {
-  append_trace(trace, PyUnicode_FromFormat("reweight bucket %d", root));
+  TRACE(trace, "reweight bucket %d", "i", root);
   if (root >= 0)
     return 1;
   int index = -1-root;
@@ -523,7 +583,7 @@ static int parse_step_choose(LibCrush *self, PyObject *step, int step_index, str
     return 0;
   }
 
-  append_trace(trace, PyUnicode_FromFormat("step choose* %S", step));
+  TRACE(trace, "step choose* %s", "O", step);
   PyObject *python_op = PyList_GetItem(step, 0);
   const char *k = MyText_AsString(python_op);
   if (k == NULL)
@@ -602,7 +662,7 @@ static int parse_step_choose(LibCrush *self, PyObject *step, int step_index, str
 
 static int parse_step_set(LibCrush *self, PyObject *step, int step_index, struct crush_rule *crule, PyObject *trace)
 {
-  append_trace(trace, PyUnicode_FromFormat("step set_* %S", step));
+  TRACE(trace, "step set_* %s", "O", step);
   Py_ssize_t len = PyList_Size(step);
   if (len != 2) {
     PyErr_Format(PyExc_RuntimeError, "must have exactly two elements, not %d", (int)len);
@@ -637,7 +697,7 @@ static int parse_step_set(LibCrush *self, PyObject *step, int step_index, struct
 
 static int parse_step_emit(LibCrush *self, PyObject *step, int step_index, struct crush_rule *crule, PyObject *trace)
 {
-  append_trace(trace, PyUnicode_FromFormat("step emit %S", step));
+  TRACE(trace, "step emit %s", "O", step);
   Py_ssize_t len = PyList_Size(step);
   if (len != 1) {
     PyErr_Format(PyExc_RuntimeError, "must have exactly one element, not %d", (int)len);
@@ -649,7 +709,7 @@ static int parse_step_emit(LibCrush *self, PyObject *step, int step_index, struc
 
 static int parse_step_take(LibCrush *self, PyObject *step, int step_index, struct crush_rule *crule, PyObject *trace)
 {
-  append_trace(trace, PyUnicode_FromFormat("step take %S", step));
+  TRACE(trace, "step take %s", "O", step);
   Py_ssize_t len = PyList_Size(step);
   if (len != 2) {
     PyErr_Format(PyExc_RuntimeError, "must have exactly two elements, not %d", (int)len);
@@ -703,7 +763,7 @@ static int parse_steps(LibCrush *self, PyObject *rule, struct crush_rule *crule,
   Py_ssize_t i;
   for (i = 0; i < PyList_Size(rule); i++) {
      PyObject *step = PyList_GetItem(rule, i);
-     append_trace(trace, PyUnicode_FromFormat("step %d %S", i, step));
+     TRACE(trace, "step %d %s", "nO", i, step);
      int r = parse_step(self, step, i, crule, trace);
      if (!r)
        return 0;
@@ -713,7 +773,7 @@ static int parse_steps(LibCrush *self, PyObject *rule, struct crush_rule *crule,
 
 static int parse_rule(LibCrush *self, PyObject *name, PyObject *rule, PyObject *trace)
 {
-  append_trace(trace, PyUnicode_FromFormat("rule content %S", rule));
+  TRACE(trace, "rule content %s", "O", rule);
   int steps_size = PyList_Size(rule);
 
   int minsize = 0;
@@ -748,7 +808,7 @@ static int parse_rules(LibCrush *self, PyObject *map, PyObject *trace)
   if (rules == NULL)
     return 1;
 
-  append_trace(trace, PyUnicode_FromFormat("rules %S", rules));
+  TRACE(trace, "rules %s", "O", rules);
 
   if (!PyDict_Check(rules)) {
     PyErr_Format(PyExc_RuntimeError, "must be a dict");
@@ -759,7 +819,7 @@ static int parse_rules(LibCrush *self, PyObject *map, PyObject *trace)
   PyObject *value;
   Py_ssize_t pos = 0;
   while (PyDict_Next(rules, &pos, &key, &value)) {
-    append_trace(trace, PyUnicode_FromFormat("rule name %S", key));
+    TRACE(trace, "rule name %s", "O", key);
     if (MyText_AsString(key) == NULL)
       return 0;
     int r = parse_rule(self, key, value, trace);
@@ -775,7 +835,7 @@ static int parse_trees(LibCrush *self, PyObject *map, PyObject *trace)
   if (trees == NULL)
     return 1;
 
-  append_trace(trace, PyUnicode_FromFormat("trees %S", trees));
+  TRACE(trace, "trees %s", "O", trees);
 
   if (!PyList_Check(trees)) {
     PyErr_Format(PyExc_RuntimeError, "must be a list");
@@ -789,7 +849,7 @@ static int parse_trees(LibCrush *self, PyObject *map, PyObject *trace)
   Py_ssize_t pos;
   for (pos = 0; pos < PyList_Size(trees); pos++) {
     PyObject *root = PyList_GetItem(trees, pos);
-    append_trace(trace, PyUnicode_FromFormat("root %S", root));
+    TRACE(trace, "root %s", "O", root);
 
     int id;
     int weight;
@@ -799,7 +859,6 @@ static int parse_trees(LibCrush *self, PyObject *map, PyObject *trace)
       return 0;
 
     if (!self->has_bucket_weights) {
-      append_trace(trace, PyUnicode_FromFormat("reweight"));
       r = reweight(self, id, trace);
       if (!r)
         return 0;
@@ -824,7 +883,7 @@ static int parse_tunables(LibCrush *self, PyObject *map, PyObject *trace)
   if (tunables == NULL)
     return 1;
 
-  append_trace(trace, PyUnicode_FromFormat("tunables %S", tunables));
+  TRACE(trace, "tunables %s", "O", tunables);
 
   if (!PyDict_Check(tunables)) {
     PyErr_Format(PyExc_RuntimeError, "must be a dict");
@@ -843,7 +902,7 @@ static int parse_tunables(LibCrush *self, PyObject *map, PyObject *trace)
   PyObject *python_value;
   Py_ssize_t pos = 0;
   while (PyDict_Next(tunables, &pos, &python_key, &python_value)) {
-    append_trace(trace, PyUnicode_FromFormat("tunable %S = %S", python_key, python_value));
+    TRACE(trace, "tunable %s = %s", "OO", python_key, python_value);
     const char *key = MyText_AsString(python_key);
     if (key == NULL)
       return 0;
@@ -888,7 +947,7 @@ static int parse_choose_args_bucket_id(LibCrush *self, PyObject *bucket, int *id
     PyErr_Format(PyExc_RuntimeError, "either bucket_id or bucket_name are required");
     return 0;
   }
-  append_trace(trace, PyUnicode_FromFormat("id %S", id));
+  TRACE(trace, "id %s", "O", id);
   *idout = MyInt_AsInt(id);
   if (PyErr_Occurred())
     return 0;
@@ -907,7 +966,7 @@ static int parse_choose_args_bucket_ids(LibCrush *self, struct crush_choose_arg
     return 1;
   }
 
-  append_trace(trace, PyUnicode_FromFormat("parse_choose_args_bucket_ids %S", python_bucket_ids));
+  TRACE(trace, "parse_choose_args_bucket_ids %s", "O", python_bucket_ids);
 
   if (!PyList_Check(python_bucket_ids)) {
     PyErr_Format(PyExc_RuntimeError, "must be a list");
@@ -940,7 +999,7 @@ static int parse_choose_args_bucket_weight_set(LibCrush *self, struct crush_choo
     return 1;
   }
 
-  append_trace(trace, PyUnicode_FromFormat("parse_choose_args_bucket_weight_set %S", python_bucket_weight_set));
+  TRACE(trace, "parse_choose_args_bucket_weight_set %s", "O", python_bucket_weight_set);
 
   if (!PyList_Check(python_bucket_weight_set)) {
     PyErr_Format(PyExc_RuntimeError, "must be a list");
@@ -952,7 +1011,7 @@ static int parse_choose_args_bucket_weight_set(LibCrush *self, struct crush_choo
   Py_ssize_t pos;
   for (pos = 0; pos < PyList_Size(python_bucket_weight_set); pos++) {
     PyObject *python_weights = PyList_GetItem(python_bucket_weight_set, pos);
-    append_trace(trace, PyUnicode_FromFormat("parse_choose_args_bucket_weight_set weight_set[%d] %S", pos, python_weights));
+    TRACE(trace, "parse_choose_args_bucket_weight_set weight_set[%d] %s", "nO", pos, python_weights);
 
     if (!PyList_Check(python_weights)) {
       PyErr_Format(PyExc_RuntimeError, "must be a list");
@@ -983,7 +1042,7 @@ static int parse_choose_args_bucket_weight_set(LibCrush *self, struct crush_choo
 
 static int parse_choose_args_bucket(LibCrush *self, struct crush_choose_arg_map *choose_arg_map, PyObject *bucket, PyObject *trace)
 {
-  append_trace(trace, PyUnicode_FromFormat("parse_choose_args_bucket %S", bucket));
+  TRACE(trace, "parse_choose_args_bucket %s", "O", bucket);
 
   int bucket_id;
   int r = parse_choose_args_bucket_id(self, bucket, &bucket_id, trace);
@@ -1014,9 +1073,30 @@ static int parse_choose_args_bucket(LibCrush *self, struct crush_choose_arg_map
   return 1;
 }
 
+//
+// The reciprocals of the weight_set are set by crush_make_choose_args()
+// from the weights of the buckets: update them to match the weights
+// that were parsed or disable them.
+//
+static void map_reciprocals_choose_args(LibCrush *self, struct crush_choose_arg_map *choose_arg_map)
+{
+  int b;
+  for (b = 0; b < choose_arg_map->size; b++) {
+    struct crush_choose_arg *arg = &choose_arg_map->args[b];
+    __u32 position;
+    for (position = 0; position < arg->weight_set_size; position++) {
+      struct crush_weight_set *weight_set = &arg->weight_set[position];
+      if (self->reciprocals)
+        crush_reciprocals_init(weight_set->reciprocals, weight_set->weights, weight_set->size);
+      else
+        weight_set->reciprocals = NULL;
+    }
+  }
+}
+
 static int parse_choose_arg_map(LibCrush *self, struct crush_choose_arg_map *choose_arg_map, PyObject *python_choose_arg_map, PyObject *trace)
 {
-  append_trace(trace, PyUnicode_FromFormat("parse_choose_arg_map %S", python_choose_arg_map));
+  TRACE(trace, "parse_choose_arg_map %s", "O", python_choose_arg_map);
 
   if (!PyList_Check(python_choose_arg_map)) {
     PyErr_Format(PyExc_RuntimeError, "must be a list");
@@ -1027,7 +1107,7 @@ static int parse_choose_arg_map(LibCrush *self, struct crush_choose_arg_map *cho
   Py_ssize_t pos;
   for (pos = 0; pos < PyList_Size(python_choose_arg_map); pos++) {
     PyObject *bucket = PyList_GetItem(python_choose_arg_map, pos);
-    append_trace(trace, PyUnicode_FromFormat("parse_choose_arg_map[%d] = %S", pos, bucket));
+    TRACE(trace, "parse_choose_arg_map[%d] = %s", "nO", pos, bucket);
     if (!PyDict_Check(bucket)) {
       PyErr_Format(PyExc_RuntimeError, "must be a dict");
       return 0;
@@ -1069,6 +1149,8 @@ static int parse_choose_arg_map(LibCrush *self, struct crush_choose_arg_map *cho
     if (known[i] == 0)
       memset(choose_arg_map->args + i, '\0', sizeof(struct crush_choose_arg));
 
+  map_reciprocals_choose_args(self, choose_arg_map);
+
   return 1;
 }
 
@@ -1086,7 +1168,7 @@ static int parse_choose_args(LibCrush *self, PyObject *map, PyObject *trace)
   if (choose_args == NULL)
     return 1;
 
-  append_trace(trace, PyUnicode_FromFormat("choose_args %S", choose_args));
+  TRACE(trace, "choose_args %s", "O", choose_args);
 
   if (!PyDict_Check(choose_args)) {
     PyErr_Format(PyExc_RuntimeError, "must be a dict");
@@ -1097,7 +1179,7 @@ static int parse_choose_args(LibCrush *self, PyObject *map, PyObject *trace)
   PyObject *python_value;
   Py_ssize_t pos = 0;
   while (PyDict_Next(choose_args, &pos, &python_key, &python_value)) {
-    append_trace(trace, PyUnicode_FromFormat("choose_args %S = %S", python_key, python_value));
+    TRACE(trace, "choose_args %s = %s", "OO", python_key, python_value);
 
     struct crush_choose_arg_map choose_arg_map;
     int r = parse_choose_arg_map(self, &choose_arg_map, python_value, trace);
@@ -1114,6 +1196,108 @@ static int parse_choose_args(LibCrush *self, PyObject *map, PyObject *trace)
   return 1;
 }
 
+static void copy_tunables(struct crush_map *map, struct crush_map *tunables)
+{
+  map->choose_local_tries = tunables->choose_local_tries;
+  map->choose_local_fallback_tries = tunables->choose_local_fallback_tries;
+  map->chooseleaf_descend_once = tunables->chooseleaf_descend_once;
+  map->chooseleaf_vary_r = tunables->chooseleaf_vary_r;
+  map->chooseleaf_stable = tunables->chooseleaf_stable;
+  map->straw_calc_version = tunables->straw_calc_version;
+  map->choose_total_tries = tunables->choose_total_tries;
+}
+
+static void map_tunables(LibCrush *self)
+{
+  copy_tunables(self->map, self->tunables);
+  self->map->straw2_block = self->straw2_block;
+
+  self->map->allowed_bucket_algs =
+    (1 << CRUSH_BUCKET_UNIFORM) |
+    (1 << CRUSH_BUCKET_LIST) |
+    (1 << CRUSH_BUCKET_STRAW2);
+
+  if (self->backward_compatibility) {
+    self->map->allowed_bucket_algs =
+      self->map->allowed_bucket_algs |
+      (1 << CRUSH_BUCKET_STRAW);
+  }
+}
+
+//
+// The workspace used by map() is allocated when the map is parsed and
+// initialized on the first call. crush_init_workspace() walks all
+// buckets but crush_do_rule() only touches the buckets it traverses and
+// checks that the permutation cached in each of them is for the value
+// being mapped. The workspace can therefore be reused as is from one
+// call to the next: only a larger replication_count requires
+// allocating and initializing it again.
+//
+#define MAP_WORKSPACE_RESULT_MAX 16
+
+static int map_workspace_alloc(LibCrush *self, int result_max)
+{
+  free(self->work);
+  self->work_initialized = 0;
+  self->work_result_max = 0;
+  self->work = malloc(crush_work_size(self->map, result_max));
+  if (self->work == NULL) {
+    PyErr_NoMemory();
+    return 0;
+  }
+  self->work_result_max = result_max;
+  return 1;
+}
+
+static void *map_workspace(LibCrush *self, int result_max)
+{
+  if (self->work == NULL || result_max > self->work_result_max)
+    if (!map_workspace_alloc(self, result_max))
+      return NULL;
+  if (!self->work_initialized) {
+    crush_init_workspace(self->map, self->work);
+    self->work_initialized = 1;
+  }
+  return self->work;
+}
+
+static int map_finalize(LibCrush *self)
+{
+  crush_finalize(self->map);
+
+  if (self->reciprocals) {
+    int b;
+    for (b = 0; b < self->map->max_buckets; b++) {
+      struct crush_bucket *bucket = self->map->buckets[b];
+      if (bucket == NULL || bucket->alg != CRUSH_BUCKET_STRAW2)
+        continue;
+      if (crush_bucket_straw2_reciprocals((struct crush_bucket_straw2 *)bucket) < 0) {
+        PyErr_NoMemory();
+        return 0;
+      }
+    }
+  }
+
+  return 1;
+}
+
+static int map_ready(LibCrush *self)
+{
+  map_tunables(self);
+
+  int weights_size = self->highest_device_id + 1;
+  self->default_weights = (__u32 *)malloc(sizeof(__u32) * (weights_size + 1));
+  if (self->default_weights == NULL) {
+    PyErr_NoMemory();
+    return 0;
+  }
+  int i;
+  for (i = 0; i < weights_size; i++)
+    self->default_weights[i] = 0x10000;
+
+  return map_workspace_alloc(self, MAP_WORKSPACE_RESULT_MAX);
+}
+
 static int parse(LibCrush *self, PyObject *map, PyObject *trace)
 {
   int r = parse_types(self, map, trace);
@@ -1132,25 +1316,39 @@ static int parse(LibCrush *self, PyObject *map, PyObject *trace)
   if (!r)
     return 0;
 
-  crush_finalize(self->map);
+  r = map_finalize(self);
+  if (!r)
+    return 0;
 
   r = parse_choose_args(self, map, trace);
   if (!r)
     return 0;
 
-  return 1;
+  return map_ready(self);
 }
 
-static PyObject *
-LibCrush_parse(LibCrush *self, PyObject *args)
+static unsigned long next_serial(void)
 {
-  PyObject *map;
+  static unsigned long serial = 0;
+  return ++serial;
+}
 
-  if (!PyArg_ParseTuple(args, "O!", &PyDict_Type, &map))
+static int map_reset(LibCrush *self, const char *caller)
+{
+  if (self->mapping > 0) {
+    PyErr_Format(PyExc_RuntimeError, "%s() called while map_batch() is running", caller);
     return 0;
+  }
 
   if (self->map != NULL)
     crush_destroy(self->map);
+  free(self->work);
+  self->work = NULL;
+  self->work_result_max = 0;
+  self->work_initialized = 0;
+  free(self->default_weights);
+  self->default_weights = NULL;
+  self->serial = 0;
   self->map = crush_create();
 
   if (self->map == NULL) {
@@ -1158,216 +1356,3279 @@ LibCrush_parse(LibCrush *self, PyObject *args)
     return 0;
   }
 
-  PyObject *trace = PyList_New(0);
+  return 1;
+}
+
+static PyObject *
+LibCrush_parse(LibCrush *self, PyObject *args)
+{
+  PyObject *map;
+
+  if (!PyArg_ParseTuple(args, "O!", &PyDict_Type, &map))
+    return 0;
+
+  if (!map_reset(self, "parse"))
+    return 0;
+
+  PyObject *trace = trace_new(self);
   int r = parse(self, map, trace);
-  if (!r || self->verbose)
-    print_trace(trace);
-  Py_DECREF(trace);
+  if (!r && trace == NULL) {
+    //
+    // parse again with a trace to show what led to the failure,
+    // parse() is only traced when it fails or verbose is set
+    //
+    PyObject *type, *value, *traceback;
+    PyErr_Fetch(&type, &value, &traceback);
+    trace = PyList_New(0);
+    if (trace != NULL && map_reset(self, "parse"))
+      parse(self, map, trace);
+    PyErr_Clear();
+    PyErr_Restore(type, value, traceback);
+  }
+  trace_end(trace, r);
 
   if (!r)
     return 0;
 
+  self->serial = next_serial();
+
   Py_RETURN_TRUE;
 }
 
-static int print_debug(PyObject *message)
+//
+// Binary encoding of the parsed map, its name tables and its
+// choose_args. Decoding rebuilds a map that is ready for mapping
+// without going through the crushmap dict again: it is what a
+// LibCrush object is pickled with, for instance to send it to
+// multiprocessing workers. The integers are in the byte order of the
+// host and the encoding is not meant to be stored: decoding refuses
+// an encoding made by another version or on a host with a different
+// byte order.
+//
+static int choose_arg_map_num_positions(struct crush_choose_arg_map *choose_arg_map);
+
+#define ENCODE_MAGIC 0x4c435553 /* LCUS */
+#define ENCODE_VERSION 1
+#define ENCODE_BYTE_ORDER 0x01020304
+#define ENCODE_TEXT 's'
+#define ENCODE_INT 'i'
+
+struct encoder {
+  char *data;
+  size_t size;
+  size_t capacity;
+};
+
+static int encode_bytes(struct encoder *e, const void *bytes, size_t size)
 {
-  if (message == NULL)
-    return 0;
-  PyObject *out = PySys_GetObject("stdout");
-  if (out == NULL)
-    return 0;
-  int r = PyFile_WriteString(MyText_AsString(message), out);
-  return r == 0;
+  if (e->size + size > e->capacity) {
+    size_t capacity = e->capacity > 0 ? e->capacity : 4096;
+    while (capacity < e->size + size)
+      capacity *= 2;
+    char *data = (char *)realloc(e->data, capacity);
+    if (data == NULL) {
+      PyErr_NoMemory();
+      return 0;
+    }
+    e->data = data;
+    e->capacity = capacity;
+  }
+  memcpy(e->data + e->size, bytes, size);
+  e->size += size;
+  return 1;
 }
 
-static int map_choose_args(LibCrush *self, PyObject *python_choose_args, struct crush_choose_arg_map *choose_arg_map, int *allocated, PyObject *trace)
+static int encode_int(struct encoder *e, int value)
 {
-  *allocated = 0;
-  choose_arg_map->args = NULL;
-  choose_arg_map->size = 0;
-
-  if (python_choose_args == NULL)
-    return 1;
+  __s32 v = value;
+  return encode_bytes(e, &v, sizeof(v));
+}
 
-  append_trace(trace, PyUnicode_FromFormat("map_choose_args %S", python_choose_args));
+static int encode_ints(struct encoder *e, const __s32 *values, int size)
+{
+  return encode_int(e, size) && encode_bytes(e, values, sizeof(__s32) * size);
+}
 
-  if (MyText_Check(python_choose_args)) {
-    PyObject *choose_args = PyDict_GetItem(self->choose_args, python_choose_args);
-    if (choose_args == NULL) {
-      PyErr_Format(PyExc_RuntimeError, "map choose_args %s is not found", MyText_AsString(python_choose_args));
+static int encode_object(struct encoder *e, PyObject *object)
+{
+  if (MyInt_Check(object)) {
+    int value = MyInt_AsInt(object);
+    if (PyErr_Occurred())
       return 0;
-    }
-    choose_arg_map->args = (struct crush_choose_arg *)PyCapsule_GetPointer(choose_args, NULL);
-    return 1;
-  } else if (PyList_Check(python_choose_args)) {
-    int r = parse_choose_arg_map(self, choose_arg_map, python_choose_args, trace);
-    if (!r)
+    return encode_int(e, ENCODE_INT) && encode_int(e, value);
+  }
+  if (MyText_Check(object)) {
+    const char *text = MyText_AsString(object);
+    if (text == NULL)
       return 0;
-    *allocated = 1;
-    return 1;
-  } else {
-    PyErr_Format(PyExc_RuntimeError, "choose_args must either be a string or a list");
-    return 0;
+    int size = strlen(text);
+    return encode_int(e, ENCODE_TEXT) && encode_int(e, size) && encode_bytes(e, text, size);
   }
+  PyErr_Format(PyExc_TypeError, "cannot encode %S, only str and int are supported", object);
+  return 0;
 }
 
-static PyObject *map(LibCrush *self, int ruleno, int value, int replication_count, __u32 *weights, int weights_size, struct crush_choose_arg *choose_args)
+static int encode_dict(struct encoder *e, PyObject *dict)
 {
-  int result[replication_count];
-  memset(result, '\0', sizeof(int) * replication_count);
-  int cwin_size = crush_work_size(self->map, replication_count);
-  char cwin[cwin_size];
-  crush_init_workspace(self->map, cwin);
+  if (!encode_int(e, PyDict_Size(dict)))
+    return 0;
+  PyObject *key;
+  PyObject *value;
+  Py_ssize_t pos = 0;
+  while (PyDict_Next(dict, &pos, &key, &value))
+    if (!encode_object(e, key) || !encode_object(e, value))
+      return 0;
+  return 1;
+}
 
-  int result_len = crush_do_rule(self->map,
-                                 ruleno,
-                                 value,
-                                 result, replication_count,
-                                 weights, weights_size,
-                                 cwin, choose_args);
-  if (result_len == 0) {
-    PyErr_Format(PyExc_RuntimeError, "crush_do_rule() was unable to map %d to any device", value);
+static int encode_bucket(struct encoder *e, struct crush_bucket *b)
+{
+  if (!encode_int(e, b->id) ||
+      !encode_int(e, b->alg) ||
+      !encode_int(e, b->hash) ||
+      !encode_int(e, b->type) ||
+      !encode_int(e, b->weight) ||
+      !encode_ints(e, b->items, b->size))
     return 0;
-  }
+  __u32 i;
+  for (i = 0; i < b->size; i++)
+    if (!encode_int(e, crush_get_bucket_item_weight(b, i)))
+      return 0;
+  // the straws depend on the straw_calc_version the bucket was
+  // created or modified with, they are kept as they are
+  if (b->alg == CRUSH_BUCKET_STRAW)
+    return encode_bytes(e, ((struct crush_bucket_straw *)b)->straws, sizeof(__u32) * b->size);
+  return 1;
+}
 
-  PyObject *python_results = PyList_New(result_len);
-  int i;
-  for (i = 0; i < result_len; i++) {
-    PyObject *python_result;
-    if (result[i] == CRUSH_ITEM_NONE) {
-      python_result = Py_None;
-    } else {
-      PyObject *python_id = MyInt_FromInt(result[i]);
-      if (PyErr_Occurred())
-        return 0;
-      python_result = PyDict_GetItem(self->ritems, python_id);
-      Py_DECREF(python_id);
-      if (python_result == NULL) {
-        PyErr_Format(PyExc_RuntimeError, "%d does not map to a device name", result[i]);
-        return 0;
-      }
-    }
-    Py_INCREF(python_result); // because SetItem steals a reference
-    int r = PyList_SetItem(python_results, i, python_result);
-    if (r == -1)
+static int encode_rule(struct encoder *e, struct crush_rule *rule)
+{
+  if (!encode_int(e, rule->len) ||
+      !encode_int(e, rule->mask.ruleset) ||
+      !encode_int(e, rule->mask.type) ||
+      !encode_int(e, rule->mask.min_size) ||
+      !encode_int(e, rule->mask.max_size))
+    return 0;
+  __u32 i;
+  for (i = 0; i < rule->len; i++)
+    if (!encode_int(e, rule->steps[i].op) ||
+        !encode_int(e, rule->steps[i].arg1) ||
+        !encode_int(e, rule->steps[i].arg2))
       return 0;
-  }
-  return python_results;
+  return 1;
 }
 
-static void copy_tunables(struct crush_map *map, struct crush_map *tunables)
+static int encode_choose_arg_map(struct encoder *e, struct crush_choose_arg_map *choose_arg_map)
 {
-  map->choose_local_tries = tunables->choose_local_tries;
-  map->choose_local_fallback_tries = tunables->choose_local_fallback_tries;
-  map->chooseleaf_descend_once = tunables->chooseleaf_descend_once;
-  map->chooseleaf_vary_r = tunables->chooseleaf_vary_r;
-  map->chooseleaf_stable = tunables->chooseleaf_stable;
-  map->straw_calc_version = tunables->straw_calc_version;
-  map->choose_total_tries = tunables->choose_total_tries;
+  if (!encode_int(e, choose_arg_map_num_positions(choose_arg_map)))
+    return 0;
+  int b;
+  for (b = 0; b < choose_arg_map->size; b++) {
+    struct crush_choose_arg *arg = &choose_arg_map->args[b];
+    int known = arg->ids != NULL || arg->weight_set != NULL;
+    if (!encode_int(e, known))
+      return 0;
+    if (!known)
+      continue;
+    if (!encode_ints(e, arg->ids, arg->ids_size) ||
+        !encode_int(e, arg->weight_set_size))
+      return 0;
+    __u32 position;
+    for (position = 0; position < arg->weight_set_size; position++) {
+      struct crush_weight_set *weight_set = &arg->weight_set[position];
+      if (!encode_ints(e, (__s32 *)weight_set->weights, weight_set->size))
+        return 0;
+    }
+  }
+  return 1;
 }
 
-static PyObject *
-LibCrush_map(LibCrush *self, PyObject *args, PyObject *kwds)
+static int encode(LibCrush *self, struct encoder *e)
 {
-  PyObject *rule;
-  int value;
-  int replication_count = -1;
-  PyObject *python_weights = NULL;
-  PyObject *python_choose_args = NULL;
-  static char *kwlist[] = {
-    "rule", "value", "replication_count", "weights", "choose_args", NULL
-  };
-  if (!PyArg_ParseTupleAndKeywords(args, kwds, "O!iI|O!O", kwlist,
-                                   &MyText_Type, &rule,
-                                   &value,
-                                   &replication_count,
-                                   &PyDict_Type, &python_weights,
-                                   &python_choose_args))
+  struct crush_map *map = self->map;
+
+  if (!encode_int(e, ENCODE_MAGIC) ||
+      !encode_int(e, ENCODE_VERSION) ||
+      !encode_int(e, ENCODE_BYTE_ORDER))
     return 0;
 
-  if (self->map == NULL) {
-    PyErr_Format(PyExc_RuntimeError, "call parse() before map()");
+  if (!encode_int(e, self->tunables->choose_local_tries) ||
+      !encode_int(e, self->tunables->choose_local_fallback_tries) ||
+      !encode_int(e, self->tunables->chooseleaf_descend_once) ||
+      !encode_int(e, self->tunables->chooseleaf_vary_r) ||
+      !encode_int(e, self->tunables->chooseleaf_stable) ||
+      !encode_int(e, self->tunables->straw_calc_version) ||
+      !encode_int(e, self->tunables->choose_total_tries) ||
+      !encode_int(e, self->highest_device_id) ||
+      !encode_int(e, self->has_bucket_weights))
     return 0;
-  }
-  if (replication_count < 1) {
-    PyErr_Format(PyExc_RuntimeError, "replication_count %d must be >= 1", replication_count);
+
+  if (!encode_int(e, map->max_buckets))
     return 0;
+  int b;
+  for (b = 0; b < map->max_buckets; b++) {
+    if (map->buckets[b] == NULL) {
+      if (!encode_int(e, 0))
+        return 0;
+    } else if (!encode_bucket(e, map->buckets[b])) {
+      return 0;
+    }
   }
-  PyObject *python_ruleno = PyDict_GetItem(self->rules, rule);
-  if (python_ruleno == NULL) {
-    PyErr_Format(PyExc_RuntimeError, "rule %s is not found", MyText_AsString(rule));
+
+  if (!encode_int(e, map->max_rules))
     return 0;
+  __u32 r;
+  for (r = 0; r < map->max_rules; r++) {
+    if (!encode_int(e, map->rules[r] != NULL))
+      return 0;
+    if (map->rules[r] != NULL && !encode_rule(e, map->rules[r]))
+      return 0;
   }
-  int ruleno = MyInt_AsInt(python_ruleno);
-  if (PyErr_Occurred())
+
+  if (!encode_dict(e, self->types) ||
+      !encode_dict(e, self->items) ||
+      !encode_dict(e, self->rules))
     return 0;
 
-  PyObject *trace = PyList_New(0);
-  struct crush_choose_arg_map choose_arg_map;
-  int allocated;
-  int r = map_choose_args(self, python_choose_args, &choose_arg_map, &allocated, trace);
-  if (!r || self->verbose)
-    print_trace(trace);
-  Py_DECREF(trace);
-  if (r < 0)
+  if (!encode_int(e, PyDict_Size(self->choose_args)))
     return 0;
+  PyObject *key;
+  PyObject *capsule;
+  Py_ssize_t pos = 0;
+  while (PyDict_Next(self->choose_args, &pos, &key, &capsule)) {
+    struct crush_choose_arg_map choose_arg_map;
+    choose_arg_map.args = (struct crush_choose_arg *)PyCapsule_GetPointer(capsule, NULL);
+    choose_arg_map.size = map->max_buckets;
+    if (!encode_object(e, key) || !encode_choose_arg_map(e, &choose_arg_map))
+      return 0;
+  }
 
-  if (self->verbose)
+  return 1;
+}
+
+static PyObject *
+LibCrush_encode(LibCrush *self)
+{
+  if (self->map == NULL) {
+    PyErr_Format(PyExc_RuntimeError, "call parse() before encode()");
+    return 0;
+  }
+
+  struct encoder e = { NULL, 0, 0 };
+  PyObject *result = NULL;
+  if (encode(self, &e))
+    result = PyBytes_FromStringAndSize(e.data, e.size);
+  free(e.data);
+  return result;
+}
+
+struct decoder {
+  const char *data;
+  size_t size;
+  size_t pos;
+};
+
+static int decode_bytes(struct decoder *d, void *bytes, size_t size)
+{
+  if (d->size - d->pos < size) {
+    PyErr_SetString(PyExc_RuntimeError, "the encoded map is truncated");
+    return 0;
+  }
+  memcpy(bytes, d->data + d->pos, size);
+  d->pos += size;
+  return 1;
+}
+
+static int decode_int(struct decoder *d, int *valueout)
+{
+  __s32 v;
+  if (!decode_bytes(d, &v, sizeof(v)))
+    return 0;
+  *valueout = v;
+  return 1;
+}
+
+//
+// A size is checked against the bytes left so that a corrupted
+// encoding cannot lead to an arbitrarily large allocation.
+//
+static int decode_size(struct decoder *d, size_t unit, int *sizeout)
+{
+  if (!decode_int(d, sizeout))
+    return 0;
+  if (*sizeout < 0 || (size_t)*sizeout * unit > d->size - d->pos) {
+    PyErr_Format(PyExc_RuntimeError, "the encoded map has an invalid size %d", *sizeout);
+    return 0;
+  }
+  return 1;
+}
+
+static int decode_ints(struct decoder *d, __s32 **valuesout, int *sizeout)
+{
+  if (!decode_size(d, sizeof(__s32), sizeout))
+    return 0;
+  *valuesout = (__s32 *)(d->data + d->pos);
+  d->pos += sizeof(__s32) * *sizeout;
+  return 1;
+}
+
+static PyObject *decode_object(struct decoder *d)
+{
+  int tag;
+  if (!decode_int(d, &tag))
+    return NULL;
+  if (tag == ENCODE_INT) {
+    int value;
+    if (!decode_int(d, &value))
+      return NULL;
+    return MyInt_FromInt(value);
+  }
+  if (tag == ENCODE_TEXT) {
+    int size;
+    if (!decode_size(d, 1, &size))
+      return NULL;
+    PyObject *text = MyText_FromStringAndSize(d->data + d->pos, size);
+    d->pos += size;
+    return text;
+  }
+  PyErr_Format(PyExc_RuntimeError, "the encoded map has an unknown tag %d", tag);
+  return NULL;
+}
+
+static int decode_dict(struct decoder *d, PyObject *dict, PyObject *rdict)
+{
+  PyDict_Clear(dict);
+  if (rdict != NULL)
+    PyDict_Clear(rdict);
+  int size;
+  if (!decode_size(d, 1, &size))
+    return 0;
+  int i;
+  for (i = 0; i < size; i++) {
+    PyObject *key = decode_object(d);
+    if (key == NULL)
+      return 0;
+    PyObject *value = decode_object(d);
+    if (value == NULL) {
+      Py_DECREF(key);
+      return 0;
+    }
+    int r = PyDict_SetItem(dict, key, value);
+    if (r == 0 && rdict != NULL)
+      r = PyDict_SetItem(rdict, value, key);
+    Py_DECREF(key);
+    Py_DECREF(value);
+    if (r != 0)
+      return 0;
+  }
+  return 1;
+}
+
+static int decode_bucket(LibCrush *self, struct decoder *d, int id)
+{
+  int alg, hash, type, weight;
+  if (!decode_int(d, &alg) ||
+      !decode_int(d, &hash) ||
+      !decode_int(d, &type) ||
+      !decode_int(d, &weight))
+    return 0;
+  int size;
+  if (!decode_size(d, 2 * sizeof(__s32), &size))
+    return 0;
+  int items[size > 0 ? size : 1];
+  int weights[size > 0 ? size : 1];
+  if (!decode_bytes(d, items, sizeof(__s32) * size) ||
+      !decode_bytes(d, weights, sizeof(__s32) * size))
+    return 0;
+
+  struct crush_bucket *b = crush_make_bucket(self->map, alg, hash, type, size, items, weights);
+  if (b == NULL) {
+    PyErr_Format(PyExc_RuntimeError, "crush_make_bucket(id=%d) returned NULL", id);
+    return 0;
+  }
+  int idout;
+  int r = crush_add_bucket(self->map, id, b, &idout);
+  if (r < 0) {
+    crush_destroy_bucket(b);
+    PyErr_Format(PyExc_RuntimeError, "crush_add_bucket(id=%d) returned %d %s", id, r, strerror(-r));
+    return 0;
+  }
+  b->weight = weight;
+  if (alg == CRUSH_BUCKET_STRAW)
+    return decode_bytes(d, ((struct crush_bucket_straw *)b)->straws, sizeof(__u32) * size);
+  return 1;
+}
+
+static int decode_rule(LibCrush *self, struct decoder *d, int ruleno)
+{
+  int len, ruleset, type, min_size, max_size;
+  if (!decode_size(d, 3 * sizeof(__s32), &len) ||
+      !decode_int(d, &ruleset) ||
+      !decode_int(d, &type) ||
+      !decode_int(d, &min_size) ||
+      !decode_int(d, &max_size))
+    return 0;
+  struct crush_rule *rule = crush_make_rule(len, ruleset, type, min_size, max_size);
+  if (rule == NULL) {
+    PyErr_SetString(PyExc_RuntimeError, "crush_make_rule() returned NULL");
+    return 0;
+  }
+  int r = crush_add_rule(self->map, rule, ruleno);
+  if (r < 0) {
+    free(rule);
+    PyErr_Format(PyExc_RuntimeError, "crush_add_rule(%d) failed %d %s", ruleno, r, strerror(-r));
+    return 0;
+  }
+  int i;
+  for (i = 0; i < len; i++) {
+    int op, arg1, arg2;
+    if (!decode_int(d, &op) || !decode_int(d, &arg1) || !decode_int(d, &arg2))
+      return 0;
+    crush_rule_set_step(rule, i, op, arg1, arg2);
+  }
+  return 1;
+}
+
+static int decode_choose_arg_map(LibCrush *self, struct decoder *d, struct crush_choose_arg_map *choose_arg_map)
+{
+  int num_positions;
+  if (!decode_size(d, 1, &num_positions))
+    return 0;
+  choose_arg_map->args = crush_make_choose_args(self->map, num_positions);
+  if (choose_arg_map->args == NULL) {
+    PyErr_NoMemory();
+    return 0;
+  }
+  choose_arg_map->size = self->map->max_buckets;
+
+  int b;
+  for (b = 0; b < choose_arg_map->size; b++) {
+    struct crush_choose_arg *arg = &choose_arg_map->args[b];
+    struct crush_bucket *bucket = self->map->buckets[b];
+    int known;
+    if (!decode_int(d, &known))
+      goto err;
+    if (!known) {
+      memset(arg, '\0', sizeof(struct crush_choose_arg));
+      continue;
+    }
+    __s32 *ids;
+    int ids_size;
+    int weight_set_size;
+    if (!decode_ints(d, &ids, &ids_size) ||
+        !decode_int(d, &weight_set_size))
+      goto err;
+    if (bucket == NULL ||
+        (ids_size > 0 && ids_size != (int)bucket->size) ||
+        weight_set_size < 0 || weight_set_size > num_positions) {
+      PyErr_Format(PyExc_RuntimeError, "the encoded choose_args of bucket %d are invalid", -1-b);
+      goto err;
+    }
+    memcpy(arg->ids, ids, sizeof(__s32) * ids_size);
+    arg->ids_size = ids_size;
+    arg->weight_set_size = weight_set_size;
+    int position;
+    for (position = 0; position < weight_set_size; position++) {
+      __s32 *weights;
+      int weights_size;
+      if (!decode_ints(d, &weights, &weights_size))
+        goto err;
+      if (weights_size != (int)bucket->size) {
+        PyErr_Format(PyExc_RuntimeError, "the encoded weight_set of bucket %d has %d weights instead of %d",
+                     -1-b, weights_size, bucket->size);
+        goto err;
+      }
+      memcpy(arg->weight_set[position].weights, weights, sizeof(__u32) * weights_size);
+    }
+  }
+
+  map_reciprocals_choose_args(self, choose_arg_map);
+
+  return 1;
+
+ err:
+  crush_destroy_choose_args(choose_arg_map->args);
+  return 0;
+}
+
+static int decode_choose_args(LibCrush *self, struct decoder *d)
+{
+  PyDict_Clear(self->choose_args);
+
+  int size;
+  if (!decode_size(d, 1, &size))
+    return 0;
+  int i;
+  for (i = 0; i < size; i++) {
+    PyObject *key = decode_object(d);
+    if (key == NULL)
+      return 0;
+    struct crush_choose_arg_map choose_arg_map;
+    if (!decode_choose_arg_map(self, d, &choose_arg_map)) {
+      Py_DECREF(key);
+      return 0;
+    }
+    PyObject *capsule = PyCapsule_New((void *)choose_arg_map.args, NULL, choose_args_destructor);
+    int r = PyDict_SetItem(self->choose_args, key, capsule);
+    Py_DECREF(key);
+    Py_DECREF(capsule);
+    if (r != 0)
+      return 0;
+  }
+  return 1;
+}
+
+static int decode(LibCrush *self, struct decoder *d)
+{
+  int magic, version, byte_order;
+  if (!decode_int(d, &magic) ||
+      !decode_int(d, &version) ||
+      !decode_int(d, &byte_order))
+    return 0;
+  if (magic != ENCODE_MAGIC || byte_order != ENCODE_BYTE_ORDER) {
+    PyErr_SetString(PyExc_RuntimeError, "not a map encoded by encode() on a host with the same byte order");
+    return 0;
+  }
+  if (version != ENCODE_VERSION) {
+    PyErr_Format(PyExc_RuntimeError, "the map is encoded with version %d instead of %d", version, ENCODE_VERSION);
+    return 0;
+  }
+
+  int tunables[7];
+  int i;
+  for (i = 0; i < 7; i++)
+    if (!decode_int(d, &tunables[i]))
+      return 0;
+  self->tunables->choose_local_tries = tunables[0];
+  self->tunables->choose_local_fallback_tries = tunables[1];
+  self->tunables->chooseleaf_descend_once = tunables[2];
+  self->tunables->chooseleaf_vary_r = tunables[3];
+  self->tunables->chooseleaf_stable = tunables[4];
+  self->tunables->straw_calc_version = tunables[5];
+  self->tunables->choose_total_tries = tunables[6];
+
+  if (!decode_int(d, &self->highest_device_id) ||
+      !decode_int(d, &self->has_bucket_weights))
+    return 0;
+
+  int max_buckets;
+  if (!decode_size(d, sizeof(__s32), &max_buckets))
+    return 0;
+  int b;
+  for (b = 0; b < max_buckets; b++) {
+    int id;
+    if (!decode_int(d, &id))
+      return 0;
+    if (id == 0)
+      continue;
+    if (id != -1-b) {
+      PyErr_Format(PyExc_RuntimeError, "the encoded map has bucket %d instead of %d", id, -1-b);
+      return 0;
+    }
+    if (!decode_bucket(self, d, id))
+      return 0;
+  }
+
+  int max_rules;
+  if (!decode_size(d, sizeof(__s32), &max_rules))
+    return 0;
+  int r;
+  for (r = 0; r < max_rules; r++) {
+    int present;
+    if (!decode_int(d, &present))
+      return 0;
+    if (present && !decode_rule(self, d, r))
+      return 0;
+  }
+
+  if (!decode_dict(d, self->types, NULL) ||
+      !decode_dict(d, self->items, self->ritems) ||
+      !decode_dict(d, self->rules, NULL))
+    return 0;
+
+  if (!map_finalize(self))
+    return 0;
+
+  if (!decode_choose_args(self, d))
+    return 0;
+
+  if (d->pos != d->size) {
+    PyErr_Format(PyExc_RuntimeError, "%zu bytes left after decoding the map", d->size - d->pos);
+    return 0;
+  }
+
+  return map_ready(self);
+}
+
+static PyObject *
+LibCrush_decode(LibCrush *self, PyObject *args)
+{
+  PyObject *encoded;
+  if (!PyArg_ParseTuple(args, "O", &encoded))
+    return 0;
+
+  if (!PyBytes_Check(encoded)) {
+    PyErr_SetString(PyExc_TypeError, "decode() expects the bytes returned by encode()");
+    return 0;
+  }
+
+  if (!map_reset(self, "decode"))
+    return 0;
+
+  struct decoder d = { MyBytes_AS_STRING(encoded), (size_t)MyBytes_GET_SIZE(encoded), 0 };
+  if (!decode(self, &d)) {
+    // do not leave a partially decoded map behind
+    crush_destroy(self->map);
+    self->map = NULL;
+    return 0;
+  }
+
+  self->serial = next_serial();
+
+  Py_RETURN_TRUE;
+}
+
+static PyObject *
+LibCrush_reduce(LibCrush *self)
+{
+  PyObject *state;
+  if (self->map == NULL) {
+    Py_INCREF(Py_None);
+    state = Py_None;
+  } else {
+    state = LibCrush_encode(self);
+    if (state == NULL)
+      return 0;
+  }
+  return Py_BuildValue("(O(iiiii)N)", Py_TYPE(self),
+                       self->verbose,
+                       self->backward_compatibility,
+                       self->reciprocals,
+                       self->straw2_block,
+                       self->interleave,
+                       state);
+}
+
+static PyObject *
+LibCrush_setstate(LibCrush *self, PyObject *state)
+{
+  if (state == Py_None)
+    Py_RETURN_NONE;
+  PyObject *args = Py_BuildValue("(O)", state);
+  if (args == NULL)
+    return 0;
+  PyObject *r = LibCrush_decode(self, args);
+  Py_DECREF(args);
+  if (r == NULL)
+    return 0;
+  Py_DECREF(r);
+  Py_RETURN_NONE;
+}
+
+//
+// Modify a bucket of the parsed map in place. The item, the bucket
+// and the tree are only checked as much as needed for the map to
+// remain usable: keeping it consistent with the crushmap it was
+// parsed from is the responsibility of the caller.
+//
+static int mutate_item_id(LibCrush *self, PyObject *python_item, int *idout)
+{
+  if (MyText_Check(python_item)) {
+    PyObject *id = PyDict_GetItem(self->items, python_item);
+    if (id == NULL) {
+      PyErr_Format(PyExc_RuntimeError, "%s is not a known item", MyText_AsString(python_item));
+      return 0;
+    }
+    python_item = id;
+  }
+  *idout = MyInt_AsInt(python_item);
+  return !PyErr_Occurred();
+}
+
+static struct crush_bucket *mutate_bucket(LibCrush *self, const char *caller, PyObject *python_bucket, int *idout)
+{
+  if (self->map == NULL) {
+    PyErr_Format(PyExc_RuntimeError, "call parse() before %s()", caller);
+    return NULL;
+  }
+  if (self->mapping > 0) {
+    PyErr_Format(PyExc_RuntimeError, "%s() called while map_batch() is running", caller);
+    return NULL;
+  }
+  if (!mutate_item_id(self, python_bucket, idout))
+    return NULL;
+  if (*idout >= 0 || -1-*idout >= self->map->max_buckets || self->map->buckets[-1-*idout] == NULL) {
+    PyErr_Format(PyExc_RuntimeError, "no bucket with id %d", *idout);
+    return NULL;
+  }
+  return self->map->buckets[-1-*idout];
+}
+
+static int mutate_item_index(struct crush_bucket *b, int item)
+{
+  __u32 i;
+  for (i = 0; i < b->size; i++)
+    if (b->items[i] == item)
+      return i;
+  return -1;
+}
+
+static int mutate_contains(struct crush_map *map, int root, int item)
+{
+  if (root == item)
+    return 1;
+  if (root >= 0)
+    return 0;
+  struct crush_bucket *b = map->buckets[-1-root];
+  __u32 i;
+  for (i = 0; i < b->size; i++)
+    if (mutate_contains(map, b->items[i], item))
+      return 1;
+  return 0;
+}
+
+//
+// The choose_args of the map are allocated for the size of each
+// bucket and must be parsed again when a bucket they modify (with a
+// weight_set or ids) changes size.
+//
+static int mutate_choose_args_use(LibCrush *self, int bucket_id)
+{
+  PyObject *key;
+  PyObject *capsule;
+  Py_ssize_t pos = 0;
+  while (PyDict_Next(self->choose_args, &pos, &key, &capsule)) {
+    struct crush_choose_arg *args = (struct crush_choose_arg *)PyCapsule_GetPointer(capsule, NULL);
+    if (args[-1-bucket_id].weight_set != NULL || args[-1-bucket_id].ids != NULL)
+      return 1;
+  }
+  return 0;
+}
+
+static int mutate_choose_args_arg(PyObject **python_choose_args)
+{
+  if (*python_choose_args == Py_None)
+    *python_choose_args = NULL;
+  if (*python_choose_args != NULL && !PyDict_Check(*python_choose_args)) {
+    PyErr_SetString(PyExc_TypeError, "choose_args must be a dict");
+    return 0;
+  }
+  return 1;
+}
+
+//
+// A copy of a bucket, to put it back if the choose_args given to
+// add_item() or remove_item() are not valid once it is modified.
+//
+static struct crush_bucket *mutate_copy_bucket(struct crush_map *map, struct crush_bucket *b)
+{
+  int *weights = (int *)malloc(sizeof(int) * (b->size + 1));
+  if (weights == NULL)
+    return NULL;
+  __u32 i;
+  for (i = 0; i < b->size; i++)
+    weights[i] = crush_get_bucket_item_weight(b, i);
+  struct crush_bucket *copy = crush_make_bucket(map, b->alg, b->hash, b->type, b->size, b->items, weights);
+  free(weights);
+  if (copy == NULL)
+    return NULL;
+  copy->id = b->id;
+  copy->weight = b->weight;
+  if (b->alg == CRUSH_BUCKET_UNIFORM)
+    ((struct crush_bucket_uniform *)copy)->item_weight = ((struct crush_bucket_uniform *)b)->item_weight;
+  return copy;
+}
+
+static void mutate_restore_bucket(struct crush_map *map, struct crush_bucket *copy)
+{
+  crush_destroy_bucket(map->buckets[-1-copy->id]);
+  map->buckets[-1-copy->id] = copy;
+}
+
+//
+// Parse the choose_args updated for a bucket that was just modified.
+// If they are not valid, the choose_args of the map are unchanged.
+//
+static int mutate_parse_choose_args(LibCrush *self, PyObject *python_choose_args)
+{
+  if (python_choose_args == NULL)
+    return 1;
+  PyObject *map = Py_BuildValue("{sO}", "choose_args", python_choose_args);
+  if (map == NULL)
+    return 0;
+  PyObject *previous = self->choose_args;
+  self->choose_args = PyDict_New();
+  int r = 0;
+  if (self->choose_args != NULL) {
+    PyObject *trace = trace_new(self);
+    r = parse_choose_args(self, map, trace);
+    trace_end(trace, r);
+  }
+  Py_DECREF(map);
+  if (r) {
+    Py_DECREF(previous);
+  } else {
+    Py_XDECREF(self->choose_args);
+    self->choose_args = previous;
+  }
+  return r;
+}
+
+//
+// Adding or removing an item changes the size of the bucket: the
+// workspace is allocated again and the serial changes so that
+// compiled choose_args, compiled weights and prepare() must be
+// called again.
+//
+static int mutate_resize(LibCrush *self)
+{
+  self->serial = next_serial();
+  return map_workspace_alloc(self, self->work_result_max > 0 ? self->work_result_max : MAP_WORKSPACE_RESULT_MAX);
+}
+
+static PyObject *
+LibCrush_adjust_item_weight(LibCrush *self, PyObject *args)
+{
+  PyObject *python_bucket;
+  PyObject *python_item;
+  int weight;
+  if (!PyArg_ParseTuple(args, "OOi", &python_bucket, &python_item, &weight))
+    return 0;
+
+  int bucket_id;
+  struct crush_bucket *b = mutate_bucket(self, "adjust_item_weight", python_bucket, &bucket_id);
+  if (b == NULL)
+    return 0;
+  int item;
+  if (!mutate_item_id(self, python_item, &item))
+    return 0;
+  if (mutate_item_index(b, item) < 0) {
+    PyErr_Format(PyExc_RuntimeError, "item %d is not in bucket %d", item, bucket_id);
+    return 0;
+  }
+  if (weight < 0) {
+    PyErr_Format(PyExc_RuntimeError, "weight must be a positive integer, not %d", weight);
+    return 0;
+  }
+
+  crush_bucket_adjust_item_weight(self->map, b, item, weight);
+
+  return MyInt_FromInt(b->weight);
+}
+
+static PyObject *
+LibCrush_add_item(LibCrush *self, PyObject *args, PyObject *kwds)
+{
+  PyObject *python_bucket;
+  PyObject *python_item;
+  int weight;
+  PyObject *name = NULL;
+  PyObject *python_choose_args = NULL;
+  static char *kwlist[] = {"bucket", "item", "weight", "name", "choose_args", NULL};
+  if (!PyArg_ParseTupleAndKeywords(args, kwds, "OOi|OO", kwlist,
+                                   &python_bucket, &python_item, &weight,
+                                   &name, &python_choose_args))
+    return 0;
+  if (name == Py_None)
+    name = NULL;
+  if (!mutate_choose_args_arg(&python_choose_args))
+    return 0;
+
+  int bucket_id;
+  struct crush_bucket *b = mutate_bucket(self, "add_item", python_bucket, &bucket_id);
+  if (b == NULL)
+    return 0;
+  int item;
+  if (!mutate_item_id(self, python_item, &item))
+    return 0;
+  if (mutate_item_index(b, item) >= 0) {
+    PyErr_Format(PyExc_RuntimeError, "item %d is already in bucket %d", item, bucket_id);
+    return 0;
+  }
+  if (weight < 0) {
+    PyErr_Format(PyExc_RuntimeError, "weight must be a positive integer, not %d", weight);
+    return 0;
+  }
+  if (item < 0) {
+    if (-1-item >= self->map->max_buckets || self->map->buckets[-1-item] == NULL) {
+      PyErr_Format(PyExc_RuntimeError, "no bucket with id %d", item);
+      return 0;
+    }
+    if (mutate_contains(self->map, item, bucket_id)) {
+      PyErr_Format(PyExc_RuntimeError, "bucket %d is in bucket %d and cannot contain it", bucket_id, item);
+      return 0;
+    }
+  } else {
+    PyObject *python_id = MyInt_FromInt(item);
+    PyObject *known = PyDict_GetItem(self->ritems, python_id);
+    Py_DECREF(python_id);
+    if (known == NULL && name == NULL) {
+      PyErr_Format(PyExc_RuntimeError, "device %d is not known and needs a name", item);
+      return 0;
+    }
+  }
+  if (python_choose_args == NULL && mutate_choose_args_use(self, bucket_id)) {
+    PyErr_Format(PyExc_RuntimeError, "bucket %d is in the choose_args of the map, "
+                 "the updated choose_args are required", bucket_id);
+    return 0;
+  }
+
+  struct crush_bucket *copy = NULL;
+  if (python_choose_args != NULL && (copy = mutate_copy_bucket(self->map, b)) == NULL)
+    return PyErr_NoMemory();
+  int highest_device_id = self->highest_device_id;
+  int max_devices = self->map->max_devices;
+  if (item >= 0 && item > self->highest_device_id) {
+    __u32 *default_weights = (__u32 *)realloc(self->default_weights, sizeof(__u32) * (item + 2));
+    if (default_weights == NULL) {
+      if (copy != NULL)
+        crush_destroy_bucket(copy);
+      return PyErr_NoMemory();
+    }
+    int i;
+    for (i = self->highest_device_id + 1; i <= item; i++)
+      default_weights[i] = 0x10000;
+    self->default_weights = default_weights;
+    self->highest_device_id = item;
+    if (item >= self->map->max_devices)
+      self->map->max_devices = item + 1;
+  }
+
+  int r = crush_bucket_add_item(self->map, b, item, weight);
+  if (r < 0) {
+    PyErr_Format(PyExc_RuntimeError, "crush_bucket_add_item returned %d %s", r, strerror(-r));
+  } else if (!mutate_parse_choose_args(self, python_choose_args)) {
+    mutate_restore_bucket(self->map, copy);
+    copy = NULL;
+    r = -EINVAL;
+  }
+  if (copy != NULL)
+    crush_destroy_bucket(copy);
+  if (r < 0) {
+    self->highest_device_id = highest_device_id;
+    self->map->max_devices = max_devices;
+    return 0;
+  }
+  if (name != NULL && !set_item_name(self, name, item))
+    return 0;
+  if (!mutate_resize(self))
+    return 0;
+
+  return MyInt_FromInt(b->weight);
+}
+
+static PyObject *
+LibCrush_remove_item(LibCrush *self, PyObject *args, PyObject *kwds)
+{
+  PyObject *python_bucket;
+  PyObject *python_item;
+  PyObject *python_choose_args = NULL;
+  static char *kwlist[] = {"bucket", "item", "choose_args", NULL};
+  if (!PyArg_ParseTupleAndKeywords(args, kwds, "OO|O", kwlist,
+                                   &python_bucket, &python_item, &python_choose_args))
+    return 0;
+  if (!mutate_choose_args_arg(&python_choose_args))
+    return 0;
+
+  int bucket_id;
+  struct crush_bucket *b = mutate_bucket(self, "remove_item", python_bucket, &bucket_id);
+  if (b == NULL)
+    return 0;
+  int item;
+  if (!mutate_item_id(self, python_item, &item))
+    return 0;
+  if (mutate_item_index(b, item) < 0) {
+    PyErr_Format(PyExc_RuntimeError, "item %d is not in bucket %d", item, bucket_id);
+    return 0;
+  }
+  if (python_choose_args == NULL && mutate_choose_args_use(self, bucket_id)) {
+    PyErr_Format(PyExc_RuntimeError, "bucket %d is in the choose_args of the map, "
+                 "the updated choose_args are required", bucket_id);
+    return 0;
+  }
+
+  struct crush_bucket *copy = NULL;
+  if (python_choose_args != NULL && (copy = mutate_copy_bucket(self->map, b)) == NULL)
+    return PyErr_NoMemory();
+  int r = crush_bucket_remove_item(self->map, b, item);
+  if (r < 0) {
+    PyErr_Format(PyExc_RuntimeError, "crush_bucket_remove_item returned %d %s", r, strerror(-r));
+  } else if (!mutate_parse_choose_args(self, python_choose_args)) {
+    mutate_restore_bucket(self->map, copy);
+    copy = NULL;
+    r = -EINVAL;
+  }
+  if (copy != NULL)
+    crush_destroy_bucket(copy);
+  if (r < 0)
+    return 0;
+  if (!mutate_resize(self))
+    return 0;
+
+  return MyInt_FromInt(b->weight);
+}
+
+static int print_debug(PyObject *message)
+{
+  if (message == NULL)
+    return 0;
+  PyObject *out = PySys_GetObject("stdout");
+  if (out == NULL)
+    return 0;
+  int r = PyFile_WriteString(MyText_AsString(message), out);
+  return r == 0;
+}
+
+//
+// A choose_args list compiled by compile_choose_args() is stored in a
+// capsule, together with the serial of the parse() it is compatible
+// with and the number of positions allocated for each bucket.
+//
+#define CHOOSE_ARGS_CAPSULE "crush.choose_args"
+
+struct compiled_choose_args {
+  unsigned long serial;
+  int num_positions;
+  struct crush_choose_arg_map choose_arg_map;
+};
+
+static void compiled_choose_args_destructor(PyObject *capsule)
+{
+  struct compiled_choose_args *compiled =
+    (struct compiled_choose_args *)PyCapsule_GetPointer(capsule, CHOOSE_ARGS_CAPSULE);
+  crush_destroy_choose_args(compiled->choose_arg_map.args);
+  free(compiled);
+}
+
+static struct compiled_choose_args *compiled_choose_args_get(LibCrush *self, PyObject *capsule)
+{
+  struct compiled_choose_args *compiled =
+    (struct compiled_choose_args *)PyCapsule_GetPointer(capsule, CHOOSE_ARGS_CAPSULE);
+  if (compiled == NULL)
+    return NULL;
+  if (compiled->serial != self->serial) {
+    PyErr_Format(PyExc_RuntimeError, "choose_args were compiled for another map, call compile_choose_args() again");
+    return NULL;
+  }
+  return compiled;
+}
+
+static int choose_arg_map_num_positions(struct crush_choose_arg_map *choose_arg_map)
+{
+  int num_positions = 0;
+  int b;
+  for (b = 0; b < choose_arg_map->size; b++) {
+    int weight_set_size = choose_arg_map->args[b].weight_set_size;
+    if (weight_set_size > num_positions)
+      num_positions = weight_set_size;
+  }
+  return num_positions;
+}
+
+static PyObject *
+LibCrush_compile_choose_args(LibCrush *self, PyObject *args)
+{
+  PyObject *python_choose_args;
+  if (!PyArg_ParseTuple(args, "O!", &PyList_Type, &python_choose_args))
+    return 0;
+
+  if (self->map == NULL) {
+    PyErr_Format(PyExc_RuntimeError, "call parse() before compile_choose_args()");
+    return 0;
+  }
+
+  struct compiled_choose_args *compiled =
+    (struct compiled_choose_args *)malloc(sizeof(struct compiled_choose_args));
+  if (compiled == NULL)
+    return PyErr_NoMemory();
+  compiled->serial = self->serial;
+
+  PyObject *trace = trace_new(self);
+  int r = parse_choose_arg_map(self, &compiled->choose_arg_map, python_choose_args, trace);
+  trace_end(trace, r);
+  if (!r) {
+    free(compiled);
+    return 0;
+  }
+
+  compiled->num_positions = choose_arg_map_num_positions(&compiled->choose_arg_map);
+
+  PyObject *capsule = PyCapsule_New((void *)compiled, CHOOSE_ARGS_CAPSULE, compiled_choose_args_destructor);
+  if (capsule == NULL) {
+    crush_destroy_choose_args(compiled->choose_arg_map.args);
+    free(compiled);
+  }
+  return capsule;
+}
+
+//
+// Replace the weight_set of a bucket in compiled choose_args or in
+// the choose_args of the map with the given name. The bucket must
+// already have a weight_set or ids and the new weight_set cannot have
+// more positions than the largest weight_set of the choose_args.
+//
+static PyObject *
+LibCrush_update_choose_args_weight_set(LibCrush *self, PyObject *args)
+{
+  PyObject *python_choose_args;
+  PyObject *bucket;
+  if (!PyArg_ParseTuple(args, "OO!", &python_choose_args, &PyDict_Type, &bucket))
+    return 0;
+
+  if (self->mapping > 0) {
+    PyErr_SetString(PyExc_RuntimeError, "update_choose_args_weight_set() called while map_batch() is running");
+    return 0;
+  }
+  struct crush_choose_arg_map choose_arg_map;
+  int num_positions;
+  if (PyCapsule_IsValid(python_choose_args, CHOOSE_ARGS_CAPSULE)) {
+    struct compiled_choose_args *compiled = compiled_choose_args_get(self, python_choose_args);
+    if (compiled == NULL)
+      return 0;
+    choose_arg_map = compiled->choose_arg_map;
+    num_positions = compiled->num_positions;
+  } else if (MyText_Check(python_choose_args)) {
+    PyObject *capsule = PyDict_GetItem(self->choose_args, python_choose_args);
+    if (capsule == NULL) {
+      PyErr_Format(PyExc_RuntimeError, "map choose_args %s is not found", MyText_AsString(python_choose_args));
+      return 0;
+    }
+    choose_arg_map.args = (struct crush_choose_arg *)PyCapsule_GetPointer(capsule, NULL);
+    choose_arg_map.size = self->map->max_buckets;
+    num_positions = choose_arg_map_num_positions(&choose_arg_map);
+  } else {
+    PyErr_Format(PyExc_TypeError, "choose_args must either be a string or the result of compile_choose_args()");
+    return 0;
+  }
+
+  PyObject *trace = trace_new(self);
+  int r = 0;
+  int bucket_id;
+  PyObject *weight_set = PyDict_GetItemString(bucket, "weight_set");
+  if (!parse_choose_args_bucket_id(self, bucket, &bucket_id, trace)) {
+    // parse_choose_args_bucket_id set the error
+  } else if (-1-bucket_id >= choose_arg_map.size ||
+             choose_arg_map.args[-1-bucket_id].weight_set == NULL) {
+    if (MyText_Check(python_choose_args))
+      PyErr_Format(PyExc_RuntimeError, "bucket %d is not in the choose_args %s",
+                   bucket_id, MyText_AsString(python_choose_args));
+    else
+      PyErr_Format(PyExc_RuntimeError, "bucket %d is not in the compiled choose_args", bucket_id);
+  } else if (weight_set == NULL || !PyList_Check(weight_set)) {
+    PyErr_Format(PyExc_RuntimeError, "weight_set must be a list");
+  } else if (PyList_Size(weight_set) < 1 || PyList_Size(weight_set) > num_positions) {
+    PyErr_Format(PyExc_RuntimeError, "weight_set must have between 1 and %d positions, not %zd",
+                 num_positions, PyList_Size(weight_set));
+  } else {
+    struct crush_choose_arg *choose_args = &choose_arg_map.args[-1-bucket_id];
+    //
+    // parse in a copy so that the choose_args are not modified if
+    // the weight_set is invalid
+    //
+    int size = self->map->buckets[-1-bucket_id]->size;
+    struct crush_weight_set weight_sets[num_positions];
+    __u32 weights[num_positions * size + 1];
+    int position;
+    for (position = 0; position < num_positions; position++) {
+      weight_sets[position].weights = weights + position * size;
+      weight_sets[position].size = size;
+      weight_sets[position].reciprocals = NULL;
+    }
+    struct crush_choose_arg copy = *choose_args;
+    copy.weight_set = weight_sets;
+    r = parse_choose_args_bucket_weight_set(self, &copy, bucket, trace);
+    if (r) {
+      for (position = 0; position < copy.weight_set_size; position++) {
+        struct crush_weight_set *weight_set = &choose_args->weight_set[position];
+        memcpy(weight_set->weights, weight_sets[position].weights, sizeof(__u32) * size);
+        if (weight_set->reciprocals != NULL)
+          crush_reciprocals_init(weight_set->reciprocals, weight_set->weights, size);
+      }
+      choose_args->weight_set_size = copy.weight_set_size;
+    }
+  }
+  trace_end(trace, r);
+  if (!r)
+    return 0;
+
+  Py_RETURN_TRUE;
+}
+
+static int map_choose_args(LibCrush *self, PyObject *python_choose_args, struct crush_choose_arg_map *choose_arg_map, int *allocated, PyObject *trace)
+{
+  *allocated = 0;
+  choose_arg_map->args = NULL;
+  choose_arg_map->size = 0;
+
+  if (python_choose_args == NULL)
+    return 1;
+
+  TRACE(trace, "map_choose_args %s", "O", python_choose_args);
+
+  if (PyCapsule_IsValid(python_choose_args, CHOOSE_ARGS_CAPSULE)) {
+    struct compiled_choose_args *compiled = compiled_choose_args_get(self, python_choose_args);
+    if (compiled == NULL)
+      return 0;
+    *choose_arg_map = compiled->choose_arg_map;
+    return 1;
+  } else if (MyText_Check(python_choose_args)) {
+    PyObject *choose_args = PyDict_GetItem(self->choose_args, python_choose_args);
+    if (choose_args == NULL) {
+      PyErr_Format(PyExc_RuntimeError, "map choose_args %s is not found", MyText_AsString(python_choose_args));
+      return 0;
+    }
+    choose_arg_map->args = (struct crush_choose_arg *)PyCapsule_GetPointer(choose_args, NULL);
+    return 1;
+  } else if (PyList_Check(python_choose_args)) {
+    int r = parse_choose_arg_map(self, choose_arg_map, python_choose_args, trace);
+    if (!r)
+      return 0;
+    *allocated = 1;
+    return 1;
+  } else {
+    PyErr_Format(PyExc_RuntimeError, "choose_args must either be a string, a list or the result of compile_choose_args()");
+    return 0;
+  }
+}
+
+static PyObject *map(LibCrush *self, int ruleno, int value, int replication_count, __u32 *weights, int weights_size, struct crush_choose_arg *choose_args, int ids)
+{
+  int result[replication_count];
+  memset(result, '\0', sizeof(int) * replication_count);
+  void *cwin = map_workspace(self, replication_count);
+  if (cwin == NULL)
+    return 0;
+
+  int result_len = crush_do_rule(self->map,
+                                 ruleno,
+                                 value,
+                                 result, replication_count,
+                                 weights, weights_size,
+                                 cwin, choose_args);
+  if (result_len == 0) {
+    PyErr_Format(PyExc_RuntimeError, "crush_do_rule() was unable to map %d to any device", value);
+    return 0;
+  }
+
+  PyObject *python_results = PyList_New(result_len);
+  int i;
+  if (ids) {
+    for (i = 0; i < result_len; i++) {
+      PyObject *python_result = MyInt_FromInt(result[i]);
+      if (python_result == NULL || PyList_SetItem(python_results, i, python_result) == -1) {
+        Py_DECREF(python_results);
+        return 0;
+      }
+    }
+    return python_results;
+  }
+  for (i = 0; i < result_len; i++) {
+    PyObject *python_result;
+    if (result[i] == CRUSH_ITEM_NONE) {
+      python_result = Py_None;
+    } else {
+      PyObject *python_id = MyInt_FromInt(result[i]);
+      if (PyErr_Occurred())
+        return 0;
+      python_result = PyDict_GetItem(self->ritems, python_id);
+      Py_DECREF(python_id);
+      if (python_result == NULL) {
+        PyErr_Format(PyExc_RuntimeError, "%d does not map to a device name", result[i]);
+        return 0;
+      }
+    }
+    Py_INCREF(python_result); // because SetItem steals a reference
+    int r = PyList_SetItem(python_results, i, python_result);
+    if (r == -1)
+      return 0;
+  }
+  return python_results;
+}
+
+static int map_rule(LibCrush *self, PyObject *rule, int *rulenoout)
+{
+  PyObject *python_ruleno = PyDict_GetItem(self->rules, rule);
+  if (python_ruleno == NULL) {
+    PyErr_Format(PyExc_RuntimeError, "rule %s is not found", MyText_AsString(rule));
+    return 0;
+  }
+  *rulenoout = MyInt_AsInt(python_ruleno);
+  if (PyErr_Occurred())
+    return 0;
+  return 1;
+}
+
+static int map_weights(LibCrush *self, PyObject *python_weights, __u32 *weights, int weights_size)
+{
+  int i;
+  for (i = 0; i < weights_size; i++)
+    weights[i] = 0x10000;
+
+  if (python_weights == NULL)
+    return 1;
+
+  PyObject *device;
+  PyObject *new_weight;
+  Py_ssize_t pos = 0;
+  while (PyDict_Next(python_weights, &pos, &device, &new_weight)) {
+    PyObject *python_id = PyDict_GetItem(self->items, device);
+    if (python_id == NULL) {
+      PyErr_Format(PyExc_RuntimeError, "%s is not a known device", MyText_AsString(device));
+      return 0;
+    }
+    int id = MyInt_AsInt(python_id);
+    if (PyErr_Occurred())
+      return 0;
+    if (id >= weights_size) {
+      PyErr_Format(PyExc_RuntimeError, "%s id %d is greater than weights_size %d", MyText_AsString(device), id, weights_size);
+      return 0;
+    }
+    double weightf = PyFloat_AsDouble(new_weight);
+    if (PyErr_Occurred())
+      return 0;
+    int weight = (int)(weightf * (double)0x10000);
+    weights[id] = weight;
+  }
+  return 1;
+}
+
+//
+// Weights compiled by compile_weights() are stored in a capsule,
+// together with the serial of the parse() they are compatible with.
+//
+#define WEIGHTS_CAPSULE "crush.weights"
+
+struct compiled_weights {
+  unsigned long serial;
+  int size;
+  __u32 weights[];
+};
+
+static void compiled_weights_destructor(PyObject *capsule)
+{
+  free(PyCapsule_GetPointer(capsule, WEIGHTS_CAPSULE));
+}
+
+static int map_weights_buffer(PyObject *python_weights, __u32 *weights, int weights_size)
+{
+  Py_buffer view;
+  if (PyObject_GetBuffer(python_weights, &view, PyBUF_FORMAT|PyBUF_C_CONTIGUOUS) < 0)
+    return 0;
+  int r = 0;
+  const char *format = view.format ? view.format : "B";
+  if (*format == '@' || *format == '=' || *format == '<')
+    format++;
+  int is_double = !strcmp(format, "d") && view.itemsize == sizeof(double);
+  int is_float = !strcmp(format, "f") && view.itemsize == sizeof(float);
+  Py_ssize_t size = view.len / view.itemsize;
+  if (!is_double && !is_float) {
+    PyErr_Format(PyExc_RuntimeError, "weights buffer must contain float32 or float64, not %s", format);
+  } else if (size > weights_size) {
+    PyErr_Format(PyExc_RuntimeError, "weights buffer has %zd elements, more than the %d devices", size, weights_size);
+  } else {
+    Py_ssize_t i;
+    for (i = 0; i < size; i++) {
+      double weightf = is_double ? ((double *)view.buf)[i] : ((float *)view.buf)[i];
+      weights[i] = (int)(weightf * (double)0x10000);
+    }
+    r = 1;
+  }
+  PyBuffer_Release(&view);
+  return r;
+}
+
+//
+// Return the weights that can be used as they are: the default weights
+// if python_weights is NULL or the compiled weights. Return NULL without
+// setting an error if python_weights is a dict that must be converted
+// by map_weights().
+//
+static __u32 *map_weights_compiled(LibCrush *self, PyObject *python_weights)
+{
+  if (python_weights == NULL)
+    return self->default_weights;
+  if (PyDict_Check(python_weights))
+    return NULL;
+  if (!PyCapsule_IsValid(python_weights, WEIGHTS_CAPSULE)) {
+    PyErr_Format(PyExc_TypeError, "weights must be a dict or the result of compile_weights()");
+    return NULL;
+  }
+  struct compiled_weights *compiled = (struct compiled_weights *)PyCapsule_GetPointer(python_weights, WEIGHTS_CAPSULE);
+  if (compiled->serial != self->serial || compiled->size != self->highest_device_id + 1) {
+    PyErr_Format(PyExc_RuntimeError, "weights were compiled for another map, call compile_weights() again");
+    return NULL;
+  }
+  return compiled->weights;
+}
+
+static PyObject *
+LibCrush_compile_weights(LibCrush *self, PyObject *args)
+{
+  PyObject *python_weights;
+  if (!PyArg_ParseTuple(args, "O", &python_weights))
+    return 0;
+
+  if (self->map == NULL) {
+    PyErr_Format(PyExc_RuntimeError, "call parse() before compile_weights()");
+    return 0;
+  }
+
+  int weights_size = self->highest_device_id + 1;
+  struct compiled_weights *compiled =
+    (struct compiled_weights *)malloc(sizeof(struct compiled_weights) + sizeof(__u32) * (weights_size + 1));
+  if (compiled == NULL)
+    return PyErr_NoMemory();
+  compiled->serial = self->serial;
+  compiled->size = weights_size;
+  int r;
+  if (PyDict_Check(python_weights)) {
+    r = map_weights(self, python_weights, compiled->weights, weights_size);
+  } else if (PyObject_CheckBuffer(python_weights)) {
+    memcpy(compiled->weights, self->default_weights, sizeof(__u32) * weights_size);
+    r = map_weights_buffer(python_weights, compiled->weights, weights_size);
+  } else {
+    PyErr_Format(PyExc_TypeError, "weights must be a dict or a buffer of floats");
+    r = 0;
+  }
+  if (!r) {
+    free(compiled);
+    return 0;
+  }
+
+  PyObject *capsule = PyCapsule_New((void *)compiled, WEIGHTS_CAPSULE, compiled_weights_destructor);
+  if (capsule == NULL)
+    free(compiled);
+  return capsule;
+}
+
+static PyObject *
+LibCrush_map(LibCrush *self, PyObject *args, PyObject *kwds)
+{
+  PyObject *rule;
+  int value;
+  int replication_count = -1;
+  PyObject *python_weights = NULL;
+  PyObject *python_choose_args = NULL;
+  int ids = 0;
+  static char *kwlist[] = {
+    "rule", "value", "replication_count", "weights", "choose_args", "ids", NULL
+  };
+  if (!PyArg_ParseTupleAndKeywords(args, kwds, "O!iI|OOi", kwlist,
+                                   &MyText_Type, &rule,
+                                   &value,
+                                   &replication_count,
+                                   &python_weights,
+                                   &python_choose_args,
+                                   &ids))
+    return 0;
+
+  if (self->map == NULL) {
+    PyErr_Format(PyExc_RuntimeError, "call parse() before map()");
+    return 0;
+  }
+  if (replication_count < 1) {
+    PyErr_Format(PyExc_RuntimeError, "replication_count %d must be >= 1", replication_count);
+    return 0;
+  }
+  int ruleno;
+  if (!map_rule(self, rule, &ruleno))
+    return 0;
+
+  PyObject *trace = trace_new(self);
+  struct crush_choose_arg_map choose_arg_map;
+  int allocated;
+  int r = map_choose_args(self, python_choose_args, &choose_arg_map, &allocated, trace);
+  trace_end(trace, r);
+  if (!r)
+    return 0;
+
+  if (self->verbose)
     print_debug(PyUnicode_FromFormat("map(rule=%S=%d, value=%d, replication_count=%d)\n",
                                      rule,
                                      ruleno,
                                      value,
                                      replication_count));
 
-  copy_tunables(self->map, self->tunables);
+  int weights_size = self->highest_device_id + 1;
+  __u32 *weights = map_weights_compiled(self, python_weights);
+  if (PyErr_Occurred()) {
+    if (allocated)
+      crush_destroy_choose_args(choose_arg_map.args);
+    return 0;
+  }
+  __u32 weights_buffer[weights != NULL ? 1 : weights_size + 1];
+  if (weights == NULL) {
+    weights = weights_buffer;
+    if (!map_weights(self, python_weights, weights, weights_size)) {
+      if (allocated)
+        crush_destroy_choose_args(choose_arg_map.args);
+      return 0;
+    }
+  }
+
+  PyObject *python_results = map(self, ruleno, value, replication_count, weights, weights_size, choose_arg_map.args, ids);
+  if (allocated)
+    crush_destroy_choose_args(choose_arg_map.args);
+  return python_results;
+}
+
+static int map_batch_values(PyObject *python_values, int **valuesout, Py_ssize_t *sizeout)
+{
+  *valuesout = NULL;
+  *sizeout = 0;
+
+  if (PyObject_CheckBuffer(python_values)) {
+    Py_buffer view;
+    if (PyObject_GetBuffer(python_values, &view, PyBUF_FORMAT|PyBUF_C_CONTIGUOUS) < 0)
+      return 0;
+    const char *format = view.format == NULL ? "B" : view.format;
+    char code = format[strlen(format) - 1];
+    if (view.itemsize != sizeof(int) || (code != 'i' && code != 'I' && code != 'l' && code != 'L')) {
+      PyErr_Format(PyExc_RuntimeError, "values buffer must contain int32, not format %s with itemsize %d",
+                   format, (int)view.itemsize);
+      PyBuffer_Release(&view);
+      return 0;
+    }
+    *sizeout = view.len / view.itemsize;
+    *valuesout = (int *)malloc(sizeof(int) * (*sizeout + 1));
+    if (*valuesout == NULL) {
+      PyBuffer_Release(&view);
+      PyErr_NoMemory();
+      return 0;
+    }
+    memcpy(*valuesout, view.buf, sizeof(int) * *sizeout);
+    PyBuffer_Release(&view);
+    return 1;
+  }
+
+#if PY_MAJOR_VERSION >= 3
+  if (PyRange_Check(python_values)) {
+    PyObject *python_start = PyObject_GetAttrString(python_values, "start");
+    PyObject *python_step = PyObject_GetAttrString(python_values, "step");
+    long start = python_start ? PyLong_AsLong(python_start) : -1;
+    long step = python_step ? PyLong_AsLong(python_step) : -1;
+    Py_XDECREF(python_start);
+    Py_XDECREF(python_step);
+    if (PyErr_Occurred())
+      return 0;
+    *sizeout = PyObject_Length(python_values);
+    if (*sizeout < 0)
+      return 0;
+    *valuesout = (int *)malloc(sizeof(int) * (*sizeout + 1));
+    if (*valuesout == NULL) {
+      PyErr_NoMemory();
+      return 0;
+    }
+    Py_ssize_t i;
+    for (i = 0; i < *sizeout; i++)
+      (*valuesout)[i] = (int)(start + i * step);
+    return 1;
+  }
+#endif
+
+  PyObject *sequence = PySequence_Fast(python_values, "values must be a range, a sequence or an int32 buffer");
+  if (sequence == NULL)
+    return 0;
+  *sizeout = PySequence_Fast_GET_SIZE(sequence);
+  *valuesout = (int *)malloc(sizeof(int) * (*sizeout + 1));
+  if (*valuesout == NULL) {
+    Py_DECREF(sequence);
+    PyErr_NoMemory();
+    return 0;
+  }
+  Py_ssize_t i;
+  for (i = 0; i < *sizeout; i++) {
+    (*valuesout)[i] = MyInt_AsInt(PySequence_Fast_GET_ITEM(sequence, i));
+    if (PyErr_Occurred()) {
+      Py_DECREF(sequence);
+      free(*valuesout);
+      *valuesout = NULL;
+      return 0;
+    }
+  }
+  Py_DECREF(sequence);
+  return 1;
+}
+
+//
+// Return a rows x columns array of int32 that can be given to
+// numpy.asarray (Python 3) or numpy.frombuffer (Python 2 and 3).
+//
+static PyObject *new_int_array(Py_ssize_t rows, Py_ssize_t columns, int **dataout)
+{
+  PyObject *bytes = PyByteArray_FromStringAndSize(NULL, rows * columns * sizeof(int));
+  if (bytes == NULL)
+    return 0;
+  *dataout = (int *)PyByteArray_AS_STRING(bytes);
+#if PY_MAJOR_VERSION >= 3
+  PyObject *view = PyMemoryView_FromObject(bytes);
+  Py_DECREF(bytes);
+  if (view == NULL)
+    return 0;
+  PyObject *array;
+  if (rows > 0)
+    array = PyObject_CallMethod(view, "cast", "s(nn)", "i", rows, columns);
+  else /* memoryview refuses a shape with a zero dimension */
+    array = PyObject_CallMethod(view, "cast", "s", "i");
+  Py_DECREF(view);
+  return array;
+#else
+  return bytes;
+#endif
+}
+
+static PyObject *new_vector(const char *format, Py_ssize_t size, Py_ssize_t itemsize, void **dataout)
+{
+  PyObject *bytes = PyByteArray_FromStringAndSize(NULL, size * itemsize);
+  if (bytes == NULL)
+    return 0;
+  *dataout = (void *)PyByteArray_AS_STRING(bytes);
+#if PY_MAJOR_VERSION >= 3
+  PyObject *view = PyMemoryView_FromObject(bytes);
+  Py_DECREF(bytes);
+  if (view == NULL)
+    return 0;
+  PyObject *array = PyObject_CallMethod(view, "cast", "s", format);
+  Py_DECREF(view);
+  return array;
+#else
+  return bytes;
+#endif
+}
+
+static PyObject *new_int_vector(Py_ssize_t size, int **dataout)
+{
+  return new_vector("i", size, sizeof(int), (void **)dataout);
+}
+
+//
+// The ids recorded by crush_do_rule for each value (see
+// crush_use_record), without duplicates. The ids of value i are
+// ids[offsets[i]] to ids[offsets[i + 1] - 1]. If overflow[i] is set,
+// some ids of value i were not recorded and it depends on anything.
+//
+#define MAP_RECORD_MAX 256
+
+struct map_records {
+  Py_ssize_t size;
+  Py_ssize_t *offsets;
+  int *ids;
+  Py_ssize_t ids_size;
+  Py_ssize_t ids_capacity;
+  unsigned char *overflow;
+};
+
+static void map_records_release(struct map_records *records)
+{
+  free(records->offsets);
+  free(records->ids);
+  free(records->overflow);
+  memset(records, '\0', sizeof(struct map_records));
+}
+
+static int map_records_init(struct map_records *records, Py_ssize_t size)
+{
+  memset(records, '\0', sizeof(struct map_records));
+  records->offsets = (Py_ssize_t *)malloc(sizeof(Py_ssize_t) * (size + 1));
+  records->overflow = (unsigned char *)calloc(size + 1, 1);
+  if (records->offsets == NULL || records->overflow == NULL) {
+    map_records_release(records);
+    return 0;
+  }
+  records->offsets[0] = 0;
+  return 1;
+}
+
+static int map_records_reserve(struct map_records *records, Py_ssize_t size)
+{
+  if (records->ids_size + size <= records->ids_capacity)
+    return 1;
+  Py_ssize_t capacity = records->ids_capacity * 2;
+  if (capacity < records->ids_size + size)
+    capacity = records->ids_size + size + 1024;
+  int *ids = (int *)realloc(records->ids, sizeof(int) * capacity);
+  if (ids == NULL)
+    return 0;
+  records->ids = ids;
+  records->ids_capacity = capacity;
+  return 1;
+}
+
+//
+// Append the ids of value i of from as the next value of records.
+//
+static int map_records_append(struct map_records *records, const struct map_records *from, Py_ssize_t i)
+{
+  Py_ssize_t size = from->offsets[i + 1] - from->offsets[i];
+  if (!map_records_reserve(records, size))
+    return 0;
+  memcpy(records->ids + records->ids_size, from->ids + from->offsets[i], sizeof(int) * size);
+  records->ids_size += size;
+  records->overflow[records->size] = from->overflow[i];
+  records->size++;
+  records->offsets[records->size] = records->ids_size;
+  return 1;
+}
+
+struct map_batch_thread {
+  pthread_t thread;
+  struct crush_map *map;
+  int ruleno;
+  const int *values;
+  Py_ssize_t values_size;
+  int *results;
+  int *scratch; /* replication_count ints to map a value when results is NULL */
+  int replication_count;
+  const __u32 *weights;
+  int weights_size;
+  const struct crush_choose_arg *choose_args;
+  void *cwin;
+  long long *counts;
+  int max_buckets;
+  Py_ssize_t failed;
+  int take; /* straw2 bucket taken by the rule or 0 */
+  int *choices; /* MAP_BATCH_CHUNK * replication_count ints if take */
+  Py_ssize_t offset; /* index of values[0] in all the values */
+  const int *positions; /* if not NULL, the index of values[i] is positions[i] */
+  int index; /* index of the value being mapped, for the straw2 cache */
+  int *record; /* if not NULL, crush_do_rule records the ids in it */
+  int *seen; /* seen[id - seen_min] is 1 + the last value which recorded id */
+  int seen_min;
+  int seen_size;
+  struct map_records records; /* the ids recorded for each value */
+  int records_failed;
+};
+
+//
+// Append the ids recorded for the value i of the thread to its records,
+// without duplicates.
+//
+static void map_batch_record(struct map_batch_thread *t, Py_ssize_t i)
+{
+  struct map_records *records = &t->records;
+  int recorded = crush_recorded(t->cwin);
+  int size = recorded < MAP_RECORD_MAX ? recorded : MAP_RECORD_MAX;
+  if (t->records_failed || !map_records_reserve(records, size)) {
+    t->records_failed = 1;
+    return;
+  }
+  int j;
+  for (j = 0; j < size; j++) {
+    int id = t->record[j];
+    if (id < t->seen_min || id >= t->seen_min + t->seen_size || t->seen[id - t->seen_min] == i + 1)
+      continue;
+    t->seen[id - t->seen_min] = i + 1;
+    records->ids[records->ids_size++] = id;
+  }
+  records->overflow[records->size] = recorded > MAP_RECORD_MAX;
+  records->size++;
+  records->offsets[records->size] = records->ids_size;
+}
+
+//
+// Store the mapping of each value in results or, if results is NULL,
+// count how many times each item is mapped. counts[max_buckets + id] is
+// the count for item id and failed is the number of values that
+// mapped to less than replication_count items.
+//
+#define MAP_BATCH_CHUNK 64
+
+static void *map_batch(void *arg)
+{
+  struct map_batch_thread *t = (struct map_batch_thread *)arg;
+  Py_ssize_t i;
+  for (i = 0; i < t->values_size; i++) {
+    Py_ssize_t chunk = i % MAP_BATCH_CHUNK;
+    if (t->take && chunk == 0) {
+      Py_ssize_t n = t->values_size - i;
+      if (n > MAP_BATCH_CHUNK)
+        n = MAP_BATCH_CHUNK;
+      crush_prepare_choices(t->map, t->choose_args, t->take, t->values + i, n,
+                            t->replication_count, t->choices);
+    }
+    if (t->take)
+      crush_use_choices(t->map, t->cwin, t->take, t->values[i],
+                        t->choices + chunk * t->replication_count, t->replication_count);
+    t->index = t->positions ? t->positions[i] : (int)(t->offset + i);
+    if (t->record)
+      crush_use_record(t->cwin, t->record, MAP_RECORD_MAX);
+    int *result = t->results ? t->results + i * t->replication_count : t->scratch;
+    int result_len = crush_do_rule(t->map,
+                                   t->ruleno,
+                                   t->values[i],
+                                   result, t->replication_count,
+                                   t->weights, t->weights_size,
+                                   t->cwin, t->choose_args);
+    if (t->record)
+      map_batch_record(t, i);
+    if (t->results) {
+      for (; result_len < t->replication_count; result_len++)
+        result[result_len] = CRUSH_ITEM_NONE;
+      continue;
+    }
+    int complete = result_len == t->replication_count;
+    int j;
+    for (j = 0; j < result_len; j++) {
+      if (result[j] == CRUSH_ITEM_NONE) {
+        complete = 0;
+        continue;
+      }
+      t->counts[t->max_buckets + result[j]]++;
+    }
+    if (!complete)
+      t->failed++;
+  }
+  if (t->take)
+    crush_use_choices(t->map, t->cwin, t->take, 0, NULL, 0);
+  return NULL;
+}
+
+//
+// Return the straw2 bucket of the first take step of the rule, or 0 if
+// there is none, for map_batch() to prepare the choices of many values
+// at once.
+//
+static int map_batch_take(struct crush_map *map, int ruleno)
+{
+  struct crush_rule *rule = map->rules[ruleno];
+  __u32 step;
+  for (step = 0; step < rule->len; step++) {
+    if (rule->steps[step].op != CRUSH_RULE_TAKE)
+      continue;
+    int id = rule->steps[step].arg1;
+    if (id < 0 && -1-id < map->max_buckets && map->buckets[-1-id] != NULL &&
+        map->buckets[-1-id]->alg == CRUSH_BUCKET_STRAW2 && map->buckets[-1-id]->size > 0)
+      return id;
+    return 0;
+  }
+  return 0;
+}
+
+//
+// The number of failed descents before an item is chosen is less than
+// the largest number of tries of the choose steps of the rule.
+//
+static int map_stats_choose_tries_size(struct crush_map *map, int ruleno)
+{
+  struct crush_rule *rule = map->rules[ruleno];
+  int size = map->choose_total_tries + 1;
+  __u32 step;
+  for (step = 0; step < rule->len; step++)
+    if ((rule->steps[step].op == CRUSH_RULE_SET_CHOOSE_TRIES ||
+         rule->steps[step].op == CRUSH_RULE_SET_CHOOSELEAF_TRIES) &&
+        rule->steps[step].arg1 > size)
+      size = rule->steps[step].arg1;
+  return size;
+}
+
+static void map_stats_add(struct crush_stats *to, const struct crush_stats *from, int max_buckets)
+{
+  to->tries += from->tries;
+  to->local_retries += from->local_retries;
+  to->rejects += from->rejects;
+  to->collisions += from->collisions;
+  int i;
+  for (i = 0; i < to->choose_tries_size; i++)
+    to->choose_tries[i] += from->choose_tries[i];
+  for (i = 0; i < max_buckets; i++)
+    to->bucket_collisions[i] += from->bucket_collisions[i];
+}
+
+static int map_stats_set_vector(PyObject *dict, const char *key, const __u64 *counters, int size)
+{
+  long long *vector;
+  PyObject *python_vector = new_vector("q", size, sizeof(long long), (void **)&vector);
+  if (python_vector == NULL)
+    return 0;
+  int i;
+  for (i = 0; i < size; i++)
+    vector[i] = (long long)counters[i];
+  int r = PyDict_SetItemString(dict, key, python_vector) == 0;
+  Py_DECREF(python_vector);
+  return r;
+}
+
+static int map_stats_set_counter(PyObject *dict, const char *key, __u64 counter)
+{
+  PyObject *python_counter = PyLong_FromUnsignedLongLong(counter);
+  if (python_counter == NULL)
+    return 0;
+  int r = PyDict_SetItemString(dict, key, python_counter) == 0;
+  Py_DECREF(python_counter);
+  return r;
+}
+
+//
+// Set the counters of stats in the dict given to map_batch(),
+// histogram(), map_record() or remap(). bucket_collisions[-1-id] is
+// the count of bucket id, as in the histogram() buckets.
+//
+static int map_stats_result(PyObject *dict, struct crush_stats *stats, struct crush_map *map)
+{
+  int buckets_size = 0;
+  int b;
+  for (b = 0; b < map->max_buckets; b++)
+    if (map->buckets[b] != NULL)
+      buckets_size = b + 1;
+  return map_stats_set_counter(dict, "tries", stats->tries) &&
+    map_stats_set_counter(dict, "local_retries", stats->local_retries) &&
+    map_stats_set_counter(dict, "rejects", stats->rejects) &&
+    map_stats_set_counter(dict, "collisions", stats->collisions) &&
+    map_stats_set_vector(dict, "choose_tries", stats->choose_tries, stats->choose_tries_size) &&
+    map_stats_set_vector(dict, "bucket_collisions", stats->bucket_collisions, buckets_size);
+}
+
+//
+// A straw2 cache compiled by compile_straw2_cache() keeps, for a fixed
+// set of values, the ln(hash) terms of the straw2 buckets (see
+// crush_use_lns). They only depend on the value, r and the ids of the
+// bucket items so that the mappings can be computed again with other
+// weights or weight_set, or after parse() is called again, without
+// hashing. A table is kept for each straw2 bucket, as long as the
+// tables fit in the budget, and is dropped when the size or the ids
+// of the bucket change.
+//
+#define STRAW2_CACHE_CAPSULE "crush.straw2_cache"
+#define STRAW2_CACHE_MIN_SIZE 8 /* hashing fewer items is faster than reading the cache */
+
+struct straw2_cache_table {
+  int size;
+  int hash;
+  int *ids; /* the ids the lns were computed with */
+  __s64 *lns;
+  unsigned char *filled;
+  size_t allocated;
+  unsigned long used; /* the last run that used the table */
+};
+
+struct straw2_cache {
+  int *values;
+  Py_ssize_t values_size;
+  int r_max;
+  size_t budget;
+  size_t allocated;
+  unsigned long runs;
+  int busy;
+  int tables_size;
+  struct straw2_cache_table *tables; /* indexed by -1-bucket id */
+};
+
+static void straw2_cache_table_free(struct straw2_cache *cache, struct straw2_cache_table *table)
+{
+  cache->allocated -= table->allocated;
+  free(table->ids);
+  free(table->lns);
+  free(table->filled);
+  memset(table, '\0', sizeof(struct straw2_cache_table));
+}
+
+static void straw2_cache_destructor(PyObject *capsule)
+{
+  struct straw2_cache *cache = (struct straw2_cache *)PyCapsule_GetPointer(capsule, STRAW2_CACHE_CAPSULE);
+  int i;
+  for (i = 0; i < cache->tables_size; i++)
+    straw2_cache_table_free(cache, &cache->tables[i]);
+  free(cache->tables);
+  free(cache->values);
+  free(cache);
+}
+
+//
+// Drop the table of the least recently used bucket that is not used
+// by the current run. Return 0 if there is none.
+//
+static int straw2_cache_evict(struct straw2_cache *cache)
+{
+  struct straw2_cache_table *lru = NULL;
+  int i;
+  for (i = 0; i < cache->tables_size; i++) {
+    struct straw2_cache_table *table = &cache->tables[i];
+    if (table->lns != NULL && table->used < cache->runs && (lru == NULL || table->used < lru->used))
+      lru = table;
+  }
+  if (lru == NULL)
+    return 0;
+  straw2_cache_table_free(cache, lru);
+  return 1;
+}
+
+static void straw2_cache_table_alloc(struct straw2_cache *cache, struct straw2_cache_table *table,
+                                     const struct crush_bucket *bucket, const int *ids)
+{
+  size_t rows = (size_t)cache->values_size * cache->r_max;
+  size_t allocated = rows * (sizeof(__s64) * bucket->size + 1) + sizeof(int) * bucket->size;
+  while (cache->allocated + allocated > cache->budget)
+    if (!straw2_cache_evict(cache))
+      return;
+  table->ids = (int *)malloc(sizeof(int) * bucket->size);
+  table->lns = (__s64 *)malloc(sizeof(__s64) * bucket->size * rows);
+  table->filled = (unsigned char *)calloc(rows, 1);
+  if (table->ids == NULL || table->lns == NULL || table->filled == NULL) {
+    straw2_cache_table_free(cache, table);
+    return;
+  }
+  memcpy(table->ids, ids, sizeof(int) * bucket->size);
+  table->size = bucket->size;
+  table->hash = bucket->hash;
+  table->allocated = allocated;
+  cache->allocated += allocated;
+}
+
+//
+// Update the tables of the cache for the buckets that may be used by
+// the rule, starting with the buckets closest to the take steps
+// because they are used by more values. Return 0 on ENOMEM.
+//
+static int straw2_cache_prepare(struct straw2_cache *cache, struct crush_map *map, int ruleno,
+                                const struct crush_choose_arg *choose_args)
+{
+  int i;
+  if (cache->tables_size < map->max_buckets) {
+    struct straw2_cache_table *tables = (struct straw2_cache_table *)
+      realloc(cache->tables, sizeof(struct straw2_cache_table) * map->max_buckets);
+    if (tables == NULL)
+      return 0;
+    memset(tables + cache->tables_size, '\0',
+           sizeof(struct straw2_cache_table) * (map->max_buckets - cache->tables_size));
+    cache->tables = tables;
+    cache->tables_size = map->max_buckets;
+  }
+  cache->runs++;
+
+  for (i = 0; i < cache->tables_size; i++) {
+    struct straw2_cache_table *table = &cache->tables[i];
+    if (table->lns == NULL)
+      continue;
+    struct crush_bucket *bucket = i < map->max_buckets ? map->buckets[i] : NULL;
+    const int *ids = NULL;
+    if (bucket != NULL)
+      ids = choose_args && choose_args[i].ids ? choose_args[i].ids : bucket->items;
+    if (bucket == NULL || bucket->alg != CRUSH_BUCKET_STRAW2 ||
+        bucket->size != table->size || bucket->hash != table->hash ||
+        memcmp(ids, table->ids, sizeof(int) * table->size))
+      straw2_cache_table_free(cache, table);
+  }
+
+  int *queue = (int *)malloc(sizeof(int) * map->max_buckets);
+  char *queued = (char *)calloc(map->max_buckets, 1);
+  if (queue == NULL || queued == NULL) {
+    free(queue);
+    free(queued);
+    return 0;
+  }
+  int queue_size = 0;
+  struct crush_rule *rule = map->rules[ruleno];
+  __u32 step;
+  for (step = 0; step < rule->len; step++) {
+    int id = rule->steps[step].arg1;
+    if (rule->steps[step].op == CRUSH_RULE_TAKE && id < 0 && -1-id < map->max_buckets &&
+        map->buckets[-1-id] != NULL && !queued[-1-id]) {
+      queued[-1-id] = 1;
+      queue[queue_size++] = -1-id;
+    }
+  }
+  int head;
+  for (head = 0; head < queue_size; head++) {
+    int b = queue[head];
+    struct crush_bucket *bucket = map->buckets[b];
+    __u32 j;
+    for (j = 0; j < bucket->size; j++) {
+      int item = bucket->items[j];
+      if (item < 0 && -1-item < map->max_buckets && map->buckets[-1-item] != NULL &&
+          !queued[-1-item]) {
+        queued[-1-item] = 1;
+        queue[queue_size++] = -1-item;
+      }
+    }
+    if (bucket->alg != CRUSH_BUCKET_STRAW2 || bucket->size < STRAW2_CACHE_MIN_SIZE)
+      continue;
+    struct straw2_cache_table *table = &cache->tables[b];
+    if (table->lns == NULL)
+      straw2_cache_table_alloc(cache, table, bucket,
+                               choose_args && choose_args[b].ids ? choose_args[b].ids : bucket->items);
+    if (table->lns != NULL)
+      table->used = cache->runs;
+  }
+  free(queue);
+  free(queued);
+  return 1;
+}
+
+static int straw2_cache_has(struct straw2_cache *cache, int bucket_id)
+{
+  struct straw2_cache_table *table = &cache->tables[-1-bucket_id];
+  return table->lns != NULL && table->used == cache->runs;
+}
+
+static void straw2_cache_use(struct straw2_cache *cache, struct map_batch_thread *t)
+{
+  int i;
+  for (i = 0; i < cache->tables_size; i++) {
+    struct straw2_cache_table *table = &cache->tables[i];
+    if (straw2_cache_has(cache, -1-i))
+      crush_use_lns(t->map, t->cwin, -1-i, table->lns, table->filled, cache->r_max, &t->index);
+  }
+}
+
+//
+// Split values in threads_count slices of consecutive values, each
+// mapped by a thread with its own workspace. The map, the weights and
+// the choose_args are shared and only read by crush_do_rule. The
+// first slice is mapped by the calling thread. Must be called without
+// the GIL. Return 0 and set errno if a thread cannot be created.
+//
+static int map_batch_threads(struct map_batch_thread *threads, int threads_count)
+{
+  int i;
+  int created;
+  int err = 0;
+  for (created = 1; created < threads_count; created++) {
+    err = pthread_create(&threads[created].thread, NULL, map_batch, &threads[created]);
+    if (err)
+      break;
+  }
+  if (!err)
+    map_batch(&threads[0]);
+  for (i = 1; i < created; i++)
+    pthread_join(threads[i].thread, NULL);
+  if (err) {
+    errno = err;
+    return 0;
+  }
+  return 1;
+}
+
+//
+// The arguments shared by map_batch() and histogram(), converted
+// for crush_do_rule.
+//
+struct map_batch_context {
+  PyObject *rule;
+  int ruleno;
+  int *values;
+  Py_ssize_t values_size;
+  int replication_count;
+  __u32 *weights;
+  __u32 *weights_buffer;
+  int weights_size;
+  struct crush_choose_arg_map choose_arg_map;
+  int allocated;
+  int threads_count;
+  struct straw2_cache *straw2_cache;
+  const int *positions; /* if not NULL, the index of values[i] for the straw2_cache */
+  struct map_records *records; /* if not NULL, record the ids each value depends on */
+  PyObject *stats; /* if not NULL, the dict in which the choices are counted */
+};
+
+static void map_batch_context_release(struct map_batch_context *ctx)
+{
+  if (ctx->allocated)
+    crush_destroy_choose_args(ctx->choose_arg_map.args);
+  free(ctx->weights_buffer);
+  free(ctx->values);
+}
+
+//
+// Convert the weights, choose_args, straw2_cache and stats of a context
+// which rule, replication_count, threads_count and values are set. The
+// straw2_cache must have been compiled for cache_values.
+//
+static int map_batch_context_convert(LibCrush *self, const char *caller, struct map_batch_context *ctx,
+                                     PyObject *python_weights, PyObject *python_choose_args,
+                                     PyObject *python_straw2_cache, PyObject *python_stats,
+                                     const int *cache_values, Py_ssize_t cache_values_size)
+{
+  if (python_stats != NULL && python_stats != Py_None) {
+    if (!PyDict_Check(python_stats)) {
+      map_batch_context_release(ctx);
+      PyErr_Format(PyExc_TypeError, "stats must be a dict");
+      return 0;
+    }
+    ctx->stats = python_stats;
+  }
+  if (python_straw2_cache != NULL && python_straw2_cache != Py_None) {
+    if (!PyCapsule_IsValid(python_straw2_cache, STRAW2_CACHE_CAPSULE)) {
+      map_batch_context_release(ctx);
+      PyErr_Format(PyExc_TypeError, "straw2_cache must be the result of compile_straw2_cache()");
+      return 0;
+    }
+    ctx->straw2_cache = (struct straw2_cache *)PyCapsule_GetPointer(python_straw2_cache, STRAW2_CACHE_CAPSULE);
+    if (ctx->straw2_cache->values_size != cache_values_size ||
+        memcmp(ctx->straw2_cache->values, cache_values, sizeof(int) * cache_values_size)) {
+      map_batch_context_release(ctx);
+      PyErr_Format(PyExc_RuntimeError, "straw2_cache was compiled for other values");
+      return 0;
+    }
+    if (ctx->straw2_cache->busy) {
+      map_batch_context_release(ctx);
+      PyErr_Format(PyExc_RuntimeError, "straw2_cache is used by another %s()", caller);
+      return 0;
+    }
+  }
+
+  ctx->weights_size = self->highest_device_id + 1;
+  ctx->weights = map_weights_compiled(self, python_weights);
+  if (PyErr_Occurred()) {
+    map_batch_context_release(ctx);
+    return 0;
+  }
+  if (ctx->weights == NULL) {
+    ctx->weights = ctx->weights_buffer = (__u32 *)malloc(sizeof(__u32) * (ctx->weights_size + 1));
+    if (ctx->weights == NULL) {
+      map_batch_context_release(ctx);
+      PyErr_NoMemory();
+      return 0;
+    }
+    if (!map_weights(self, python_weights, ctx->weights, ctx->weights_size)) {
+      map_batch_context_release(ctx);
+      return 0;
+    }
+  }
+
+  PyObject *trace = trace_new(self);
+  int r = map_choose_args(self, python_choose_args, &ctx->choose_arg_map, &ctx->allocated, trace);
+  trace_end(trace, r);
+  if (!r) {
+    map_batch_context_release(ctx);
+    return 0;
+  }
+
+  if (self->verbose)
+    print_debug(PyUnicode_FromFormat("%s(rule=%S=%d, values_size=%zd, replication_count=%d, threads=%d)\n",
+                                     caller,
+                                     ctx->rule,
+                                     ctx->ruleno,
+                                     ctx->values_size,
+                                     ctx->replication_count,
+                                     ctx->threads_count));
+
+  if (ctx->threads_count > ctx->values_size)
+    ctx->threads_count = ctx->values_size > 0 ? ctx->values_size : 1;
+
+  return 1;
+}
+
+static int map_batch_context_init(LibCrush *self, const char *caller, PyObject *args, PyObject *kwds,
+                                  struct map_batch_context *ctx)
+{
+  PyObject *python_values;
+  PyObject *python_weights = NULL;
+  PyObject *python_choose_args = NULL;
+  PyObject *python_straw2_cache = NULL;
+  PyObject *python_stats = NULL;
+  memset(ctx, '\0', sizeof(struct map_batch_context));
+  ctx->replication_count = -1;
+  ctx->threads_count = 1;
+  static char *kwlist[] = {
+    "rule", "values", "replication_count", "weights", "choose_args", "threads", "straw2_cache",
+    "stats", NULL
+  };
+  if (!PyArg_ParseTupleAndKeywords(args, kwds, "O!OI|OOiOO", kwlist,
+                                   &MyText_Type, &ctx->rule,
+                                   &python_values,
+                                   &ctx->replication_count,
+                                   &python_weights,
+                                   &python_choose_args,
+                                   &ctx->threads_count,
+                                   &python_straw2_cache,
+                                   &python_stats))
+    return 0;
+
+  if (self->map == NULL) {
+    PyErr_Format(PyExc_RuntimeError, "call parse() before %s()", caller);
+    return 0;
+  }
+  if (ctx->replication_count < 1) {
+    PyErr_Format(PyExc_RuntimeError, "replication_count %d must be >= 1", ctx->replication_count);
+    return 0;
+  }
+  if (ctx->threads_count < 1) {
+    PyErr_Format(PyExc_RuntimeError, "threads %d must be >= 1", ctx->threads_count);
+    return 0;
+  }
+  if (!map_rule(self, ctx->rule, &ctx->ruleno))
+    return 0;
+
+  if (!map_batch_values(python_values, &ctx->values, &ctx->values_size))
+    return 0;
+
+  return map_batch_context_convert(self, caller, ctx, python_weights, python_choose_args,
+                                   python_straw2_cache, python_stats, ctx->values, ctx->values_size);
+}
+
+//
+// Map all values, storing the result in results or, if it is NULL,
+// adding the number of times each item is mapped to counts (see
+// map_batch). The GIL is released while mapping.
+//
+static int map_batch_run(LibCrush *self, struct map_batch_context *ctx,
+                         int *results, long long *counts, Py_ssize_t *failed)
+{
+  int threads_count = ctx->threads_count;
+  int counts_size = self->map->max_buckets + ctx->weights_size;
+  struct map_batch_thread *threads = NULL;
+  int cwin_size = crush_work_size(self->map, ctx->replication_count);
+  char *cwin = NULL;
+  long long *thread_counts = NULL;
+  int *scratch = NULL;
+  int *choices = NULL;
+  if (ctx->straw2_cache != NULL &&
+      !straw2_cache_prepare(ctx->straw2_cache, self->map, ctx->ruleno, ctx->choose_arg_map.args)) {
+    PyErr_NoMemory();
+    return 0;
+  }
+  int take = self->interleave ? map_batch_take(self->map, ctx->ruleno) : 0;
+  if (take && ctx->straw2_cache != NULL && straw2_cache_has(ctx->straw2_cache, take))
+    take = 0;
+  int seen_size = self->map->max_buckets + self->map->max_devices;
+  int *record = NULL;
+  int *seen = NULL;
+  threads = (struct map_batch_thread *)calloc(threads_count, sizeof(struct map_batch_thread));
+  cwin = (char *)malloc((size_t)cwin_size * threads_count);
+  if (results == NULL) {
+    thread_counts = (long long *)calloc((size_t)counts_size * (threads_count - 1) + 1, sizeof(long long));
+    scratch = (int *)malloc(sizeof(int) * ctx->replication_count * threads_count);
+  }
+  if (take)
+    choices = (int *)malloc(sizeof(int) * MAP_BATCH_CHUNK * ctx->replication_count * threads_count);
+  if (ctx->records != NULL) {
+    record = (int *)malloc(sizeof(int) * MAP_RECORD_MAX * threads_count);
+    seen = (int *)calloc((size_t)seen_size * threads_count + 1, sizeof(int));
+  }
+  //
+  // stats[threads_count] is the sum of the stats of each thread
+  //
+  struct crush_stats *stats = NULL;
+  __u64 *stats_counters = NULL;
+  int choose_tries_size = map_stats_choose_tries_size(self->map, ctx->ruleno);
+  int stats_counters_size = choose_tries_size + self->map->max_buckets;
+  if (ctx->stats != NULL) {
+    stats = (struct crush_stats *)calloc(threads_count + 1, sizeof(struct crush_stats));
+    stats_counters = (__u64 *)calloc((size_t)stats_counters_size * (threads_count + 1), sizeof(__u64));
+  }
+  if (threads == NULL || cwin == NULL ||
+      (results == NULL && (thread_counts == NULL || scratch == NULL)) ||
+      (take && choices == NULL) ||
+      (ctx->records != NULL && (record == NULL || seen == NULL)) ||
+      (ctx->stats != NULL && (stats == NULL || stats_counters == NULL))) {
+    free(threads);
+    free(cwin);
+    free(thread_counts);
+    free(scratch);
+    free(choices);
+    free(record);
+    free(seen);
+    free(stats);
+    free(stats_counters);
+    PyErr_NoMemory();
+    return 0;
+  }
+  int i;
+  if (ctx->stats != NULL)
+    for (i = 0; i <= threads_count; i++) {
+      stats[i].choose_tries = stats_counters + (size_t)stats_counters_size * i;
+      stats[i].choose_tries_size = choose_tries_size;
+      stats[i].bucket_collisions = stats[i].choose_tries + choose_tries_size;
+    }
+
+  Py_ssize_t slice = ctx->values_size / threads_count;
+  Py_ssize_t remainder = ctx->values_size % threads_count;
+  Py_ssize_t offset = 0;
+  for (i = 0; i < threads_count; i++) {
+    struct map_batch_thread *t = &threads[i];
+    t->map = self->map;
+    t->ruleno = ctx->ruleno;
+    t->values = ctx->values + offset;
+    t->values_size = slice + (i < remainder ? 1 : 0);
+    t->results = results ? results + offset * ctx->replication_count : NULL;
+    t->scratch = results ? NULL : scratch + (size_t)ctx->replication_count * i;
+    t->replication_count = ctx->replication_count;
+    t->weights = ctx->weights;
+    t->weights_size = ctx->weights_size;
+    t->choose_args = ctx->choose_arg_map.args;
+    t->cwin = cwin + (size_t)cwin_size * i;
+    t->counts = i == 0 ? counts : thread_counts + (size_t)counts_size * (i - 1);
+    t->max_buckets = self->map->max_buckets;
+    t->failed = 0;
+    t->take = take;
+    t->choices = take ? choices + (size_t)MAP_BATCH_CHUNK * ctx->replication_count * i : NULL;
+    t->offset = offset;
+    t->positions = ctx->positions ? ctx->positions + offset : NULL;
+    if (ctx->records != NULL) {
+      t->record = record + MAP_RECORD_MAX * i;
+      t->seen = seen + (size_t)seen_size * i;
+      t->seen_min = -self->map->max_buckets;
+      t->seen_size = seen_size;
+      t->records_failed = !map_records_init(&t->records, t->values_size);
+    }
+    crush_init_workspace(self->map, t->cwin);
+    if (ctx->stats != NULL)
+      crush_use_stats(t->cwin, &stats[i]);
+    if (ctx->straw2_cache != NULL)
+      straw2_cache_use(ctx->straw2_cache, t);
+    offset += t->values_size;
+  }
+  int r;
+  self->mapping++;
+  if (ctx->straw2_cache != NULL)
+    ctx->straw2_cache->busy = 1;
+  Py_BEGIN_ALLOW_THREADS
+  r = map_batch_threads(threads, threads_count);
+  Py_END_ALLOW_THREADS
+  if (ctx->straw2_cache != NULL)
+    ctx->straw2_cache->busy = 0;
+  self->mapping--;
+  if (!r)
+    PyErr_SetFromErrno(PyExc_RuntimeError);
+
+  if (r && results == NULL) {
+    for (i = 0; i < threads_count; i++) {
+      *failed += threads[i].failed;
+      if (i == 0)
+        continue;
+      int j;
+      for (j = 0; j < counts_size; j++)
+        counts[j] += threads[i].counts[j];
+    }
+  }
+
+  if (r && ctx->records != NULL) {
+    r = map_records_init(ctx->records, ctx->values_size);
+    for (i = 0; r && i < threads_count; i++) {
+      struct map_batch_thread *t = &threads[i];
+      Py_ssize_t j;
+      r = !t->records_failed;
+      for (j = 0; r && j < t->values_size; j++)
+        r = map_records_append(ctx->records, &t->records, j);
+    }
+    if (!r) {
+      map_records_release(ctx->records);
+      PyErr_NoMemory();
+    }
+  }
+
+  if (r && ctx->stats != NULL) {
+    for (i = 0; i < threads_count; i++)
+      map_stats_add(&stats[threads_count], &stats[i], self->map->max_buckets);
+    r = map_stats_result(ctx->stats, &stats[threads_count], self->map);
+  }
+
+  if (ctx->records != NULL)
+    for (i = 0; i < threads_count; i++)
+      map_records_release(&threads[i].records);
+  free(threads);
+  free(cwin);
+  free(thread_counts);
+  free(scratch);
+  free(choices);
+  free(record);
+  free(seen);
+  free(stats);
+  free(stats_counters);
+  return r;
+}
+
+static PyObject *
+LibCrush_map_batch(LibCrush *self, PyObject *args, PyObject *kwds)
+{
+  struct map_batch_context ctx;
+  if (!map_batch_context_init(self, "map_batch", args, kwds, &ctx))
+    return 0;
+
+  int *results;
+  PyObject *python_results = new_int_array(ctx.values_size, ctx.replication_count, &results);
+  if (python_results != NULL &&
+      !map_batch_run(self, &ctx, results, NULL, NULL))
+    Py_CLEAR(python_results);
+
+  map_batch_context_release(&ctx);
+  return python_results;
+}
+
+//
+// The count of a bucket is the sum of the counts of its items, in
+// addition to the number of times it was mapped, if the rule emits
+// buckets. counts[max_buckets + id] is the count of item id.
+//
+static long long histogram_rollup(struct crush_map *map, long long *counts, char *done, int b)
+{
+  long long *count = &counts[map->max_buckets - 1 - b];
+  if (done[b])
+    return *count;
+  done[b] = 1;
+  struct crush_bucket *bucket = map->buckets[b];
+  __u32 i;
+  for (i = 0; i < bucket->size; i++) {
+    int item = bucket->items[i];
+    if (item >= 0)
+      *count += counts[map->max_buckets + item];
+    else if (-1-item < map->max_buckets && map->buckets[-1-item] != NULL)
+      *count += histogram_rollup(map, counts, done, -1-item);
+  }
+  return *count;
+}
+
+//
+// Return the (devices, buckets, failed) tuple of histogram() after
+// adding the counts of the items of each bucket to its count.
+//
+static PyObject *histogram_result(LibCrush *self, long long *counts, char *done, int weights_size,
+                                  Py_ssize_t failed)
+{
+  int max_buckets = self->map->max_buckets;
+  int b;
+  int buckets_size = 0;
+  for (b = 0; b < max_buckets; b++)
+    if (self->map->buckets[b] != NULL) {
+      histogram_rollup(self->map, counts, done, b);
+      buckets_size = b + 1;
+    }
+
+  PyObject *result = NULL;
+  long long *devices;
+  PyObject *python_devices = new_vector("q", weights_size, sizeof(long long), (void **)&devices);
+  long long *buckets;
+  PyObject *python_buckets = new_vector("q", buckets_size, sizeof(long long), (void **)&buckets);
+  if (python_devices != NULL && python_buckets != NULL) {
+    memcpy(devices, counts + max_buckets, sizeof(long long) * weights_size);
+    // buckets[-1-id] is the count of bucket id
+    for (b = 0; b < buckets_size; b++)
+      buckets[b] = counts[max_buckets - 1 - b];
+    result = Py_BuildValue("(OOn)", python_devices, python_buckets, failed);
+  }
+  Py_XDECREF(python_devices);
+  Py_XDECREF(python_buckets);
+  return result;
+}
+
+static PyObject *
+LibCrush_histogram(LibCrush *self, PyObject *args, PyObject *kwds)
+{
+  struct map_batch_context ctx;
+  if (!map_batch_context_init(self, "histogram", args, kwds, &ctx))
+    return 0;
+
+  int max_buckets = self->map->max_buckets;
+  long long *counts = (long long *)calloc((size_t)max_buckets + ctx.weights_size + 1, sizeof(long long));
+  char *done = (char *)calloc((size_t)max_buckets + 1, 1);
+  Py_ssize_t failed = 0;
+  PyObject *result = NULL;
+  if (counts == NULL || done == NULL) {
+    PyErr_NoMemory();
+  } else if (map_batch_run(self, &ctx, NULL, counts, &failed)) {
+    result = histogram_result(self, counts, done, ctx.weights_size, failed);
+  }
+
+  free(done);
+  free(counts);
+  map_batch_context_release(&ctx);
+  return result;
+}
+
+//
+// A mapping recorded by map_record() is stored in a capsule with the
+// ids each value depends on and an index of the values that depend on
+// each id. It is not bound to a map: remap() can be called with
+// another map, as long as the ids of the buckets and devices are the
+// same.
+//
+#define MAPPING_CAPSULE "crush.mapping"
+
+struct mapping {
+  PyObject *rule;
+  int replication_count;
+  Py_ssize_t values_size;
+  int *values;
+  int *results;
+  struct map_records records;
+  int index_min; /* the values depending on id are in index_values */
+  int index_size; /* from index_offsets[id - index_min] */
+  Py_ssize_t *index_offsets;
+  int *index_values;
+  Py_ssize_t remapped; /* the number of values remap() mapped again */
+};
+
+static void mapping_release(struct mapping *mapping)
+{
+  Py_XDECREF(mapping->rule);
+  free(mapping->values);
+  free(mapping->results);
+  map_records_release(&mapping->records);
+  free(mapping->index_offsets);
+  free(mapping->index_values);
+  free(mapping);
+}
+
+static void mapping_destructor(PyObject *capsule)
+{
+  mapping_release((struct mapping *)PyCapsule_GetPointer(capsule, MAPPING_CAPSULE));
+}
+
+//
+// Build the index of the values that depend on each id from the records.
+//
+static int mapping_index(struct mapping *mapping)
+{
+  const struct map_records *records = &mapping->records;
+  int min = 0;
+  int max = -1;
+  Py_ssize_t i;
+  for (i = 0; i < records->ids_size; i++) {
+    if (records->ids[i] < min)
+      min = records->ids[i];
+    if (records->ids[i] > max)
+      max = records->ids[i];
+  }
+  mapping->index_min = min;
+  mapping->index_size = max - min + 1;
+  mapping->index_offsets = (Py_ssize_t *)calloc((size_t)mapping->index_size + 1, sizeof(Py_ssize_t));
+  mapping->index_values = (int *)malloc(sizeof(int) * (records->ids_size + 1));
+  if (mapping->index_offsets == NULL || mapping->index_values == NULL)
+    return 0;
+  for (i = 0; i < records->ids_size; i++)
+    mapping->index_offsets[records->ids[i] - min + 1]++;
+  int id;
+  for (id = 0; id < mapping->index_size; id++)
+    mapping->index_offsets[id + 1] += mapping->index_offsets[id];
+  Py_ssize_t *next = (Py_ssize_t *)malloc(sizeof(Py_ssize_t) * mapping->index_size);
+  if (next == NULL)
+    return 0;
+  memcpy(next, mapping->index_offsets, sizeof(Py_ssize_t) * mapping->index_size);
+  for (i = 0; i < mapping->values_size; i++) {
+    Py_ssize_t j;
+    for (j = records->offsets[i]; j < records->offsets[i + 1]; j++)
+      mapping->index_values[next[records->ids[j] - min]++] = (int)i;
+  }
+  free(next);
+  return 1;
+}
+
+static struct mapping *mapping_get(PyObject *capsule)
+{
+  if (!PyCapsule_IsValid(capsule, MAPPING_CAPSULE)) {
+    PyErr_Format(PyExc_TypeError, "mapping must be the result of map_record() or remap()");
+    return NULL;
+  }
+  return (struct mapping *)PyCapsule_GetPointer(capsule, MAPPING_CAPSULE);
+}
+
+static PyObject *mapping_capsule(struct mapping *mapping)
+{
+  if (!mapping_index(mapping)) {
+    mapping_release(mapping);
+    return PyErr_NoMemory();
+  }
+  PyObject *capsule = PyCapsule_New((void *)mapping, MAPPING_CAPSULE, mapping_destructor);
+  if (capsule == NULL)
+    mapping_release(mapping);
+  return capsule;
+}
+
+static PyObject *
+LibCrush_map_record(LibCrush *self, PyObject *args, PyObject *kwds)
+{
+  struct map_batch_context ctx;
+  if (!map_batch_context_init(self, "map_record", args, kwds, &ctx))
+    return 0;
+
+  struct mapping *mapping = (struct mapping *)calloc(1, sizeof(struct mapping));
+  if (mapping == NULL) {
+    map_batch_context_release(&ctx);
+    return PyErr_NoMemory();
+  }
+  mapping->rule = ctx.rule;
+  Py_INCREF(mapping->rule);
+  mapping->replication_count = ctx.replication_count;
+  mapping->values_size = ctx.values_size;
+  mapping->results = (int *)malloc(sizeof(int) * (ctx.values_size * ctx.replication_count + 1));
+  ctx.records = &mapping->records;
+  int r = 0;
+  if (ctx.values_size > INT_MAX)
+    PyErr_Format(PyExc_RuntimeError, "%zd values are too many to record", ctx.values_size);
+  else if (mapping->results == NULL)
+    PyErr_NoMemory();
+  else
+    r = map_batch_run(self, &ctx, mapping->results, NULL, NULL);
+  // the mapping keeps the values, they are not released with the context
+  mapping->values = ctx.values;
+  ctx.values = NULL;
+  map_batch_context_release(&ctx);
+  if (!r) {
+    mapping_release(mapping);
+    return 0;
+  }
+  return mapping_capsule(mapping);
+}
+
+static PyObject *
+LibCrush_remap(LibCrush *self, PyObject *args, PyObject *kwds)
+{
+  PyObject *python_mapping;
+  PyObject *python_changed;
+  PyObject *python_weights = NULL;
+  PyObject *python_choose_args = NULL;
+  PyObject *python_straw2_cache = NULL;
+  PyObject *python_stats = NULL;
+  struct map_batch_context ctx;
+  memset(&ctx, '\0', sizeof(struct map_batch_context));
+  ctx.threads_count = 1;
+  static char *kwlist[] = {
+    "mapping", "changed", "weights", "choose_args", "threads", "straw2_cache", "stats", NULL
+  };
+  if (!PyArg_ParseTupleAndKeywords(args, kwds, "OO|OOiOO", kwlist,
+                                   &python_mapping,
+                                   &python_changed,
+                                   &python_weights,
+                                   &python_choose_args,
+                                   &ctx.threads_count,
+                                   &python_straw2_cache,
+                                   &python_stats))
+    return 0;
+
+  struct mapping *origin = mapping_get(python_mapping);
+  if (origin == NULL)
+    return 0;
+  if (self->map == NULL) {
+    PyErr_Format(PyExc_RuntimeError, "call parse() before remap()");
+    return 0;
+  }
+  if (ctx.threads_count < 1) {
+    PyErr_Format(PyExc_RuntimeError, "threads %d must be >= 1", ctx.threads_count);
+    return 0;
+  }
+  ctx.rule = origin->rule;
+  ctx.replication_count = origin->replication_count;
+  if (!map_rule(self, ctx.rule, &ctx.ruleno))
+    return 0;
+
+  //
+  // The values that depend on a changed id, or which ids were not all
+  // recorded, are mapped again.
+  //
+  unsigned char *affected = (unsigned char *)calloc(origin->values_size + 1, 1);
+  if (affected == NULL)
+    return PyErr_NoMemory();
+  PyObject *changed = PySequence_Fast(python_changed, "changed must be a sequence of ids");
+  if (changed == NULL) {
+    free(affected);
+    return 0;
+  }
+  Py_ssize_t i;
+  for (i = 0; i < PySequence_Fast_GET_SIZE(changed); i++) {
+    int id = MyInt_AsInt(PySequence_Fast_GET_ITEM(changed, i));
+    if (PyErr_Occurred()) {
+      Py_DECREF(changed);
+      free(affected);
+      return 0;
+    }
+    if (id < origin->index_min || id >= origin->index_min + origin->index_size)
+      continue;
+    Py_ssize_t j;
+    for (j = origin->index_offsets[id - origin->index_min];
+         j < origin->index_offsets[id - origin->index_min + 1]; j++)
+      affected[origin->index_values[j]] = 1;
+  }
+  Py_DECREF(changed);
+  for (i = 0; i < origin->values_size; i++)
+    if (origin->records.overflow[i])
+      affected[i] = 1;
+
+  int *positions = (int *)malloc(sizeof(int) * (origin->values_size + 1));
+  ctx.values = (int *)malloc(sizeof(int) * (origin->values_size + 1));
+  if (positions == NULL || ctx.values == NULL) {
+    free(positions);
+    free(affected);
+    map_batch_context_release(&ctx);
+    return PyErr_NoMemory();
+  }
+  for (i = 0; i < origin->values_size; i++)
+    if (affected[i]) {
+      positions[ctx.values_size] = (int)i;
+      ctx.values[ctx.values_size++] = origin->values[i];
+    }
+  ctx.positions = positions;
+  if (!map_batch_context_convert(self, "remap", &ctx, python_weights, python_choose_args,
+                                 python_straw2_cache, python_stats,
+                                 origin->values, origin->values_size)) {
+    free(positions);
+    free(affected);
+    return 0;
+  }
+
+  struct mapping *mapping = (struct mapping *)calloc(1, sizeof(struct mapping));
+  struct map_records records;
+  memset(&records, '\0', sizeof(struct map_records));
+  int *results = NULL;
+  int r = 0;
+  if (mapping != NULL) {
+    mapping->rule = origin->rule;
+    Py_INCREF(mapping->rule);
+    mapping->replication_count = origin->replication_count;
+    mapping->values_size = origin->values_size;
+    mapping->remapped = ctx.values_size;
+    mapping->values = (int *)malloc(sizeof(int) * (origin->values_size + 1));
+    mapping->results = (int *)malloc(sizeof(int) * (origin->values_size * origin->replication_count + 1));
+    results = (int *)malloc(sizeof(int) * (ctx.values_size * ctx.replication_count + 1));
+  }
+  if (mapping == NULL || mapping->values == NULL || mapping->results == NULL || results == NULL ||
+      !map_records_init(&mapping->records, origin->values_size)) {
+    PyErr_NoMemory();
+  } else {
+    ctx.records = &records;
+    r = map_batch_run(self, &ctx, results, NULL, NULL);
+  }
+  if (r) {
+    memcpy(mapping->values, origin->values, sizeof(int) * origin->values_size);
+    memcpy(mapping->results, origin->results,
+           sizeof(int) * origin->values_size * origin->replication_count);
+    Py_ssize_t k = 0;
+    for (i = 0; r && i < origin->values_size; i++) {
+      if (affected[i]) {
+        memcpy(mapping->results + i * mapping->replication_count,
+               results + k * mapping->replication_count,
+               sizeof(int) * mapping->replication_count);
+        r = map_records_append(&mapping->records, &records, k++);
+      } else {
+        r = map_records_append(&mapping->records, &origin->records, i);
+      }
+    }
+    if (!r)
+      PyErr_NoMemory();
+  }
+
+  map_records_release(&records);
+  free(results);
+  free(positions);
+  free(affected);
+  map_batch_context_release(&ctx);
+  if (!r) {
+    if (mapping != NULL)
+      mapping_release(mapping);
+    return 0;
+  }
+  return mapping_capsule(mapping);
+}
+
+static PyObject *
+LibCrush_mapping_results(LibCrush *self, PyObject *args)
+{
+  PyObject *python_mapping;
+  if (!PyArg_ParseTuple(args, "O", &python_mapping))
+    return 0;
+  struct mapping *mapping = mapping_get(python_mapping);
+  if (mapping == NULL)
+    return 0;
+  int *results;
+  PyObject *python_results = new_int_array(mapping->values_size, mapping->replication_count, &results);
+  if (python_results != NULL)
+    memcpy(results, mapping->results, sizeof(int) * mapping->values_size * mapping->replication_count);
+  return python_results;
+}
+
+static PyObject *
+LibCrush_mapping_histogram(LibCrush *self, PyObject *args)
+{
+  PyObject *python_mapping;
+  if (!PyArg_ParseTuple(args, "O", &python_mapping))
+    return 0;
+  struct mapping *mapping = mapping_get(python_mapping);
+  if (mapping == NULL)
+    return 0;
+  if (self->map == NULL) {
+    PyErr_Format(PyExc_RuntimeError, "call parse() before mapping_histogram()");
+    return 0;
+  }
+
+  int max_buckets = self->map->max_buckets;
+  int weights_size = self->highest_device_id + 1;
+  long long *counts = (long long *)calloc((size_t)max_buckets + weights_size + 1, sizeof(long long));
+  char *done = (char *)calloc((size_t)max_buckets + 1, 1);
+  PyObject *result = NULL;
+  if (counts == NULL || done == NULL) {
+    PyErr_NoMemory();
+  } else {
+    Py_ssize_t failed = 0;
+    Py_ssize_t i;
+    for (i = 0; i < mapping->values_size; i++) {
+      const int *row = mapping->results + i * mapping->replication_count;
+      int complete = 1;
+      int j;
+      for (j = 0; j < mapping->replication_count; j++) {
+        if (row[j] == CRUSH_ITEM_NONE || row[j] < -max_buckets || row[j] >= weights_size) {
+          complete = 0;
+          continue;
+        }
+        counts[max_buckets + row[j]]++;
+      }
+      if (!complete)
+        failed++;
+    }
+    result = histogram_result(self, counts, done, weights_size, failed);
+  }
+
+  free(done);
+  free(counts);
+  return result;
+}
+
+static PyObject *
+LibCrush_mapping_info(LibCrush *self, PyObject *args)
+{
+  PyObject *python_mapping;
+  if (!PyArg_ParseTuple(args, "O", &python_mapping))
+    return 0;
+  struct mapping *mapping = mapping_get(python_mapping);
+  if (mapping == NULL)
+    return 0;
+  Py_ssize_t overflow = 0;
+  Py_ssize_t i;
+  for (i = 0; i < mapping->values_size; i++)
+    overflow += mapping->records.overflow[i];
+  return Py_BuildValue("{s:O,s:i,s:n,s:n,s:n,s:n}",
+                       "rule", mapping->rule,
+                       "replication_count", mapping->replication_count,
+                       "values", mapping->values_size,
+                       "ids", mapping->records.ids_size,
+                       "overflow", overflow,
+                       "remapped", mapping->remapped);
+}
+
+static PyObject *
+LibCrush_compile_straw2_cache(LibCrush *self, PyObject *args)
+{
+  PyObject *python_values;
+  int replication_count;
+  Py_ssize_t budget;
+  if (!PyArg_ParseTuple(args, "Oin", &python_values, &replication_count, &budget))
+    return 0;
+
+  if (replication_count < 1) {
+    PyErr_Format(PyExc_RuntimeError, "replication_count %d must be >= 1", replication_count);
+    return 0;
+  }
+  if (budget < 0) {
+    PyErr_Format(PyExc_RuntimeError, "budget %zd must be >= 0", budget);
+    return 0;
+  }
+  struct straw2_cache *cache = (struct straw2_cache *)calloc(1, sizeof(struct straw2_cache));
+  if (cache == NULL)
+    return PyErr_NoMemory();
+  if (!map_batch_values(python_values, &cache->values, &cache->values_size)) {
+    free(cache);
+    return 0;
+  }
+  if (cache->values_size > INT_MAX / replication_count) {
+    PyErr_Format(PyExc_RuntimeError, "%zd values are too many for a straw2 cache", cache->values_size);
+    free(cache->values);
+    free(cache);
+    return 0;
+  }
+  cache->r_max = replication_count;
+  cache->budget = budget;
+
+  PyObject *capsule = PyCapsule_New((void *)cache, STRAW2_CACHE_CAPSULE, straw2_cache_destructor);
+  if (capsule == NULL) {
+    free(cache->values);
+    free(cache);
+  }
+  return capsule;
+}
+
+static PyObject *
+LibCrush_straw2_cache_info(LibCrush *self, PyObject *args)
+{
+  PyObject *capsule;
+  if (!PyArg_ParseTuple(args, "O", &capsule))
+    return 0;
+
+  if (!PyCapsule_IsValid(capsule, STRAW2_CACHE_CAPSULE)) {
+    PyErr_Format(PyExc_TypeError, "straw2_cache must be the result of compile_straw2_cache()");
+    return 0;
+  }
+  struct straw2_cache *cache = (struct straw2_cache *)PyCapsule_GetPointer(capsule, STRAW2_CACHE_CAPSULE);
+  PyObject *buckets = PyList_New(0);
+  if (buckets == NULL)
+    return 0;
+  int i;
+  for (i = 0; i < cache->tables_size; i++) {
+    if (cache->tables[i].lns == NULL)
+      continue;
+    PyObject *id = MyInt_FromInt(-1-i);
+    int r = id == NULL ? -1 : PyList_Append(buckets, id);
+    Py_XDECREF(id);
+    if (r < 0) {
+      Py_DECREF(buckets);
+      return 0;
+    }
+  }
+  return Py_BuildValue("{s:n,s:n,s:N}",
+                       "budget", (Py_ssize_t)cache->budget,
+                       "allocated", (Py_ssize_t)cache->allocated,
+                       "buckets", buckets);
+}
+
+//
+// Sparse from -> to counts, in an open addressing hash table keyed by
+// the (from, to) pair.
+//
+struct movement_entry {
+  int from;
+  int to;
+  long long count;
+};
 
-  self->map->allowed_bucket_algs =
-    (1 << CRUSH_BUCKET_UNIFORM) |
-    (1 << CRUSH_BUCKET_LIST) |
-    (1 << CRUSH_BUCKET_STRAW2);
+struct movement_table {
+  struct movement_entry *entries;
+  char *used;
+  size_t capacity;
+  size_t size;
+};
 
-  if (self->backward_compatibility) {
-    self->map->allowed_bucket_algs =
-      self->map->allowed_bucket_algs |
-      (1 << CRUSH_BUCKET_STRAW);
+static size_t movement_hash(int from, int to, size_t capacity)
+{
+  __u64 key = ((__u64)(__u32)from << 32) | (__u32)to;
+  key ^= key >> 33;
+  key *= 0xff51afd7ed558ccdULL;
+  key ^= key >> 33;
+  return (size_t)key & (capacity - 1);
+}
+
+static int movement_table_init(struct movement_table *table, size_t capacity)
+{
+  table->capacity = capacity;
+  table->size = 0;
+  table->entries = (struct movement_entry *)malloc(sizeof(struct movement_entry) * capacity);
+  table->used = (char *)calloc(capacity, 1);
+  if (table->entries == NULL || table->used == NULL) {
+    free(table->entries);
+    free(table->used);
+    return 0;
   }
+  return 1;
+}
 
-  int weights_size = self->highest_device_id + 1;
-  __u32 weights[weights_size];
+static void movement_table_release(struct movement_table *table)
+{
+  free(table->entries);
+  free(table->used);
+}
+
+static int movement_table_add(struct movement_table *table, int from, int to, long long count)
+{
+  if (2 * (table->size + 1) > table->capacity) {
+    struct movement_table larger;
+    if (!movement_table_init(&larger, table->capacity * 2))
+      return 0;
+    size_t i;
+    for (i = 0; i < table->capacity; i++)
+      if (table->used[i])
+        movement_table_add(&larger, table->entries[i].from, table->entries[i].to, table->entries[i].count);
+    movement_table_release(table);
+    *table = larger;
+  }
+  size_t i = movement_hash(from, to, table->capacity);
+  while (table->used[i]) {
+    if (table->entries[i].from == from && table->entries[i].to == to) {
+      table->entries[i].count += count;
+      return 1;
+    }
+    i = (i + 1) & (table->capacity - 1);
+  }
+  table->used[i] = 1;
+  table->entries[i].from = from;
+  table->entries[i].to = to;
+  table->entries[i].count = count;
+  table->size++;
+  return 1;
+}
+
+static int movement_entry_compare(const void *a, const void *b)
+{
+  const struct movement_entry *entry_a = (const struct movement_entry *)a;
+  const struct movement_entry *entry_b = (const struct movement_entry *)b;
+  if (entry_a->from != entry_b->from)
+    return entry_a->from < entry_b->from ? -1 : 1;
+  return entry_a->to < entry_b->to ? -1 : entry_a->to > entry_b->to;
+}
+
+static int movement_contains(const int *mapped, int replication_count, int item)
+{
   int i;
-  for (i = 0; i < weights_size; i++)
-    weights[i] = 0x10000;
+  for (i = 0; i < replication_count; i++)
+    if (mapped[i] == item)
+      return 1;
+  return 0;
+}
 
-  if (python_weights != NULL) {
-    PyObject *device;
-    PyObject *new_weight;
-    Py_ssize_t pos = 0;
-    while (PyDict_Next(python_weights, &pos, &device, &new_weight)) {
-      PyObject *python_id = PyDict_GetItem(self->items, device);
-      if (python_id == NULL) {
-        PyErr_Format(PyExc_RuntimeError, "%s is not a known device", MyText_AsString(device));
-        return 0;
-      }
-      int id = MyInt_AsInt(python_id);
-      if (PyErr_Occurred())
-        return 0;
-      if (id >= weights_size) {
-        PyErr_Format(PyExc_RuntimeError, "%s id %d is greater than weights_size %d", MyText_AsString(device), id, weights_size);
+//
+// If order matters, the item at a given position in the origin
+// mapping moves to the item at the same position in the destination
+// mapping. Otherwise the items that are only in the origin mapping
+// move to the items that are only in the destination mapping, paired
+// in the order in which they are mapped.
+//
+static int movement_count(struct movement_table *table, const int *origin, const int *destination,
+                          Py_ssize_t values_size, int replication_count, int order_matters)
+{
+  Py_ssize_t v;
+  for (v = 0; v < values_size; v++) {
+    const int *a = origin + v * replication_count;
+    const int *b = destination + v * replication_count;
+    int i;
+    if (order_matters) {
+      for (i = 0; i < replication_count; i++)
+        if (a[i] != b[i] && !movement_table_add(table, a[i], b[i], 1))
+          return 0;
+      continue;
+    }
+    int j = 0;
+    for (i = 0; i < replication_count; i++) {
+      if (movement_contains(b, replication_count, a[i]))
+        continue;
+      for (; j < replication_count; j++)
+        if (!movement_contains(a, replication_count, b[j]))
+          break;
+      if (j >= replication_count)
+        break;
+      if (!movement_table_add(table, a[i], b[j], 1))
         return 0;
+      j++;
+    }
+  }
+  return 1;
+}
+
+static PyObject *
+LibCrush_movement(LibCrush *self, PyObject *args, PyObject *kwds)
+{
+  PyObject *python_origin;
+  PyObject *python_destination;
+  int replication_count;
+  int order_matters = 0;
+  static char *kwlist[] = {
+    "origin", "destination", "replication_count", "order_matters", NULL
+  };
+  if (!PyArg_ParseTupleAndKeywords(args, kwds, "OOI|i", kwlist,
+                                   &python_origin,
+                                   &python_destination,
+                                   &replication_count,
+                                   &order_matters))
+    return 0;
+
+  if (replication_count < 1) {
+    PyErr_Format(PyExc_RuntimeError, "replication_count %d must be >= 1", replication_count);
+    return 0;
+  }
+
+  int *origin;
+  Py_ssize_t origin_size;
+  if (!map_batch_values(python_origin, &origin, &origin_size))
+    return 0;
+  int *destination;
+  Py_ssize_t destination_size;
+  if (!map_batch_values(python_destination, &destination, &destination_size)) {
+    free(origin);
+    return 0;
+  }
+
+  PyObject *result = NULL;
+  struct movement_table table;
+  if (origin_size != destination_size || origin_size % replication_count) {
+    PyErr_Format(PyExc_RuntimeError, "origin and destination must have the same size, "
+                 "a multiple of replication_count %d, not %zd and %zd",
+                 replication_count, origin_size, destination_size);
+  } else if (!movement_table_init(&table, 1024)) {
+    PyErr_NoMemory();
+  } else {
+    if (!movement_count(&table, origin, destination, origin_size / replication_count,
+                        replication_count, order_matters)) {
+      PyErr_NoMemory();
+    } else {
+      size_t i, j = 0;
+      for (i = 0; i < table.capacity; i++)
+        if (table.used[i])
+          table.entries[j++] = table.entries[i];
+      qsort(table.entries, table.size, sizeof(struct movement_entry), movement_entry_compare);
+
+      int *from;
+      PyObject *python_from = new_int_vector(table.size, &from);
+      int *to;
+      PyObject *python_to = new_int_vector(table.size, &to);
+      long long *count;
+      PyObject *python_count = new_vector("q", table.size, sizeof(long long), (void **)&count);
+      if (python_from != NULL && python_to != NULL && python_count != NULL) {
+        for (i = 0; i < table.size; i++) {
+          from[i] = table.entries[i].from;
+          to[i] = table.entries[i].to;
+          count[i] = table.entries[i].count;
+        }
+        result = Py_BuildValue("(OOO)", python_from, python_to, python_count);
       }
-      double weightf = PyFloat_AsDouble(new_weight);
-      if (PyErr_Occurred())
-        return 0;
-      int weight = (int)(weightf * (double)0x10000);
-      weights[id] = weight;
+      Py_XDECREF(python_from);
+      Py_XDECREF(python_to);
+      Py_XDECREF(python_count);
     }
+    movement_table_release(&table);
   }
 
-  PyObject *python_results = map(self, ruleno, value, replication_count, weights, weights_size, choose_arg_map.args);
-  if (allocated)
-    crush_destroy_choose_args(choose_arg_map.args);
-  return python_results;
+  free(origin);
+  free(destination);
+  return result;
+}
+
+static int items_table_compare(const void *a, const void *b)
+{
+  int id_a = *(const int *)a;
+  int id_b = *(const int *)b;
+  return id_a < id_b ? -1 : id_a > id_b;
+}
+
+static PyObject *
+LibCrush_items_table(LibCrush *self)
+{
+  if (self->map == NULL) {
+    PyErr_Format(PyExc_RuntimeError, "call parse() before items_table()");
+    return 0;
+  }
+
+  Py_ssize_t size = PyDict_Size(self->ritems);
+  int *ids;
+  PyObject *python_ids = new_int_vector(size, &ids);
+  if (python_ids == NULL)
+    return 0;
+
+  PyObject *python_id;
+  PyObject *name;
+  Py_ssize_t pos = 0;
+  Py_ssize_t i = 0;
+  while (PyDict_Next(self->ritems, &pos, &python_id, &name)) {
+    ids[i++] = MyInt_AsInt(python_id);
+    if (PyErr_Occurred()) {
+      Py_DECREF(python_ids);
+      return 0;
+    }
+  }
+  qsort(ids, size, sizeof(int), items_table_compare);
+
+  PyObject *names = PyList_New(size);
+  if (names == NULL) {
+    Py_DECREF(python_ids);
+    return 0;
+  }
+  for (i = 0; i < size; i++) {
+    python_id = MyInt_FromInt(ids[i]);
+    name = python_id ? PyDict_GetItem(self->ritems, python_id) : NULL;
+    Py_XDECREF(python_id);
+    if (name == NULL) {
+      Py_DECREF(python_ids);
+      Py_DECREF(names);
+      return 0;
+    }
+    Py_INCREF(name); // because SetItem steals a reference
+    PyList_SET_ITEM(names, i, name);
+  }
+
+  return Py_BuildValue("(NN)", python_ids, names);
 }
 
 #include "ceph_read_write.h"
@@ -1385,6 +4646,8 @@ LibCrush_ceph_write(LibCrush *self, PyObject *args)
 
   int r;
   r = ceph_write(self, path, format, info);
+  // ceph_write() sets allowed_bucket_algs from info, restore the mapping tunables
+  map_tunables(self);
   if (r < 0)
     return 0;
   Py_RETURN_TRUE;
@@ -1431,6 +4694,79 @@ LibCrush_ceph_read(LibCrush *self, PyObject *args)
   return result;
 }
 
+static PyObject *
+LibCrush_ceph_read_binary(LibCrush *self, PyObject *args)
+{
+  PyObject *data;
+  if (!PyArg_ParseTuple(args, "O", &data))
+    return 0;
+
+  if (!PyBytes_Check(data)) {
+    PyErr_SetString(PyExc_TypeError, "ceph_read_binary() expects the bytes of a binary Ceph crushmap");
+    return 0;
+  }
+
+  char *out = NULL;
+  int r = ceph_read_binary_data_to_json(MyBytes_AS_STRING(data), (size_t)MyBytes_GET_SIZE(data), &out);
+  if (r < 0) {
+    PyErr_SetString(PyExc_RuntimeError, "not a binary Ceph crushmap");
+    return 0;
+  }
+  PyObject *result = Py_BuildValue("s", out);
+  free(out);
+  return result;
+}
+
+static PyObject *
+LibCrush_ceph_load(LibCrush *self, PyObject *args)
+{
+  PyObject *data;
+  if (!PyArg_ParseTuple(args, "O", &data))
+    return 0;
+
+  if (!PyBytes_Check(data)) {
+    PyErr_SetString(PyExc_TypeError, "ceph_load() expects the bytes of a binary Ceph crushmap");
+    return 0;
+  }
+
+  //
+  // The tunables of a Ceph crushmap can only be parsed with
+  // backward_compatibility, let parse() explain why
+  //
+  if (!self->backward_compatibility)
+    Py_RETURN_FALSE;
+
+  if (!map_reset(self, "ceph_load"))
+    return 0;
+
+  int r = ceph_load(self, MyBytes_AS_STRING(data), (size_t)MyBytes_GET_SIZE(data), choose_args_destructor);
+  if (r == 0 && map_finalize(self)) {
+    PyObject *key;
+    PyObject *capsule;
+    Py_ssize_t pos = 0;
+    while (PyDict_Next(self->choose_args, &pos, &key, &capsule)) {
+      struct crush_choose_arg_map choose_arg_map;
+      choose_arg_map.args = (struct crush_choose_arg *)PyCapsule_GetPointer(capsule, NULL);
+      choose_arg_map.size = self->map->max_buckets;
+      map_reciprocals_choose_args(self, &choose_arg_map);
+    }
+    if (map_ready(self)) {
+      self->serial = next_serial();
+      Py_RETURN_TRUE;
+    }
+  }
+
+  // do not leave a partially loaded map behind
+  crush_destroy(self->map);
+  self->map = NULL;
+  PyDict_Clear(self->choose_args);
+  if (r == -ENOTSUP)
+    Py_RETURN_FALSE;
+  if (r < 0 && !PyErr_Occurred())
+    PyErr_SetString(PyExc_RuntimeError, "not a binary Ceph crushmap");
+  return 0;
+}
+
 // copy/pasted from src/include/rados.h
 // from http://github.com/ceph/ceph
 // at 2c319033558a23b06d4a06903f6cfe44f685a59b
@@ -1474,6 +4810,319 @@ LibCrush_ceph_pool_pps(LibCrush *self, PyObject *args)
   return results;
 }
 
+static PyObject *
+LibCrush_ceph_pools_pps(LibCrush *self, PyObject *args)
+{
+  PyObject *python_pools;
+  if (!PyArg_ParseTuple(args, "O", &python_pools))
+    return 0;
+
+  PyObject *sequence = PySequence_Fast(python_pools, "pools must be a sequence of (pool, pg_num, pgp_num)");
+  if (sequence == NULL)
+    return 0;
+  Py_ssize_t pools_size = PySequence_Fast_GET_SIZE(sequence);
+  int (*pools)[3] = malloc(sizeof(int[3]) * (pools_size + 1));
+  if (pools == NULL) {
+    Py_DECREF(sequence);
+    return PyErr_NoMemory();
+  }
+  Py_ssize_t size = 0;
+  Py_ssize_t i;
+  for (i = 0; i < pools_size; i++) {
+    if (!PyArg_ParseTuple(PySequence_Fast_GET_ITEM(sequence, i), "iii",
+                          &pools[i][0], &pools[i][1], &pools[i][2])) {
+      free(pools);
+      Py_DECREF(sequence);
+      return 0;
+    }
+    if (pools[i][1] < 0 || pools[i][2] < 1) {
+      PyErr_Format(PyExc_RuntimeError, "pool %d pg_num %d must be >= 0 and pgp_num %d must be >= 1",
+                   pools[i][0], pools[i][1], pools[i][2]);
+      free(pools);
+      Py_DECREF(sequence);
+      return 0;
+    }
+    size += pools[i][1];
+  }
+  Py_DECREF(sequence);
+
+  int *pool_ids;
+  PyObject *python_pool_ids = new_int_vector(size, &pool_ids);
+  int *pss;
+  PyObject *python_pss = new_int_vector(size, &pss);
+  int *ppss;
+  PyObject *python_ppss = new_int_vector(size, &ppss);
+  PyObject *results = NULL;
+  if (python_pool_ids != NULL && python_pss != NULL && python_ppss != NULL) {
+    Py_ssize_t offset = 0;
+    for (i = 0; i < pools_size; i++) {
+      int pool = pools[i][0];
+      int pg_num = pools[i][1];
+      int pgp_num = pools[i][2];
+      // see LibCrush_ceph_pool_pps
+      int pgp_num_mask = (1 << cbits(pgp_num-1)) - 1;
+      int ps;
+      for (ps = 0; ps < pg_num; ps++, offset++) {
+        pool_ids[offset] = pool;
+        pss[offset] = ps;
+        ppss[offset] = crush_hash32_2(CRUSH_HASH_RJENKINS1,
+                                      ceph_stable_mod(ps, pgp_num, pgp_num_mask),
+                                      pool);
+      }
+    }
+    results = Py_BuildValue("(OOO)", python_pool_ids, python_pss, python_ppss);
+  }
+  free(pools);
+  Py_XDECREF(python_pool_ids);
+  Py_XDECREF(python_pss);
+  Py_XDECREF(python_ppss);
+  return results;
+}
+
+//
+// A mapper returned by prepare() holds a rule, a replication count,
+// compiled weights and choose_args so that mapping a value does not
+// parse keywords or resolve anything. It is only valid for the parse()
+// it was prepared with.
+//
+#if PY_VERSION_HEX >= 0x03090000
+#define MAPPER_VECTORCALL 1
+#endif
+
+typedef struct LibCrushMapper {
+  PyObject_HEAD
+  LibCrush *crush;
+  unsigned long serial;
+  int ruleno;
+  int replication_count;
+  int ids;
+  PyObject *weights; /* compiled weights or NULL */
+  PyObject *choose_args; /* compiled choose_args, a choose_args name or NULL */
+  struct crush_choose_arg *choose_arg_map;
+#ifdef MAPPER_VECTORCALL
+  vectorcallfunc vectorcall;
+#endif
+} LibCrushMapper;
+
+static PyObject *mapper_map(LibCrushMapper *self, int value)
+{
+  LibCrush *crush = self->crush;
+  if (self->serial != crush->serial) {
+    PyErr_Format(PyExc_RuntimeError, "the map was parsed again, call prepare() again");
+    return 0;
+  }
+  int weights_size = crush->highest_device_id + 1;
+  __u32 *weights = crush->default_weights;
+  if (self->weights != NULL)
+    weights = ((struct compiled_weights *)PyCapsule_GetPointer(self->weights, WEIGHTS_CAPSULE))->weights;
+  return map(crush, self->ruleno, value, self->replication_count, weights, weights_size,
+             self->choose_arg_map, self->ids);
+}
+
+#ifndef MAPPER_VECTORCALL
+static PyObject *
+LibCrushMapper_call(LibCrushMapper *self, PyObject *args, PyObject *kwds)
+{
+  int value;
+  static char *kwlist[] = { "value", NULL };
+  if (!PyArg_ParseTupleAndKeywords(args, kwds, "i", kwlist, &value))
+    return 0;
+  return mapper_map(self, value);
+}
+#else
+static PyObject *
+LibCrushMapper_vectorcall(PyObject *callable, PyObject *const *args, size_t nargsf, PyObject *kwnames)
+{
+  Py_ssize_t nargs = PyVectorcall_NARGS(nargsf);
+  if (nargs != 1 || (kwnames != NULL && PyTuple_GET_SIZE(kwnames) > 0)) {
+    PyErr_Format(PyExc_TypeError, "a mapper takes exactly one positional argument, the value");
+    return 0;
+  }
+  long value = PyLong_AsLong(args[0]);
+  if (value == -1 && PyErr_Occurred())
+    return 0;
+  if (value > INT_MAX || value < INT_MIN) {
+    PyErr_Format(PyExc_OverflowError, "value %ld does not fit in an int", value);
+    return 0;
+  }
+  return mapper_map((LibCrushMapper *)callable, (int)value);
+}
+#endif
+
+static void
+LibCrushMapper_dealloc(LibCrushMapper *self)
+{
+  Py_XDECREF(self->crush);
+  Py_XDECREF(self->weights);
+  Py_XDECREF(self->choose_args);
+  Py_TYPE(self)->tp_free((PyObject*)self);
+}
+
+static PyObject *
+LibCrush_prepare(LibCrush *self, PyObject *args, PyObject *kwds)
+{
+  PyObject *rule;
+  int replication_count = -1;
+  PyObject *python_weights = NULL;
+  PyObject *python_choose_args = NULL;
+  int ids = 0;
+  static char *kwlist[] = {
+    "rule", "replication_count", "weights", "choose_args", "ids", NULL
+  };
+  if (!PyArg_ParseTupleAndKeywords(args, kwds, "O!I|OOi", kwlist,
+                                   &MyText_Type, &rule,
+                                   &replication_count,
+                                   &python_weights,
+                                   &python_choose_args,
+                                   &ids))
+    return 0;
+
+  if (self->map == NULL) {
+    PyErr_Format(PyExc_RuntimeError, "call parse() before prepare()");
+    return 0;
+  }
+  if (replication_count < 1) {
+    PyErr_Format(PyExc_RuntimeError, "replication_count %d must be >= 1", replication_count);
+    return 0;
+  }
+  int ruleno;
+  if (!map_rule(self, rule, &ruleno))
+    return 0;
+
+  LibCrushMapper *mapper = PyObject_New(LibCrushMapper, &LibCrushMapperType);
+  if (mapper == NULL)
+    return 0;
+  Py_INCREF(self);
+  mapper->crush = self;
+  mapper->serial = self->serial;
+  mapper->ruleno = ruleno;
+  mapper->replication_count = replication_count;
+  mapper->ids = ids;
+  mapper->weights = NULL;
+  mapper->choose_args = NULL;
+  mapper->choose_arg_map = NULL;
+#ifdef MAPPER_VECTORCALL
+  mapper->vectorcall = LibCrushMapper_vectorcall;
+#endif
+
+  if (python_weights != NULL && python_weights != Py_None) {
+    if (PyCapsule_IsValid(python_weights, WEIGHTS_CAPSULE)) {
+      if (map_weights_compiled(self, python_weights) == NULL)
+        goto error;
+      Py_INCREF(python_weights);
+      mapper->weights = python_weights;
+    } else {
+      PyObject *compile_args = Py_BuildValue("(O)", python_weights);
+      if (compile_args == NULL)
+        goto error;
+      mapper->weights = LibCrush_compile_weights(self, compile_args);
+      Py_DECREF(compile_args);
+      if (mapper->weights == NULL)
+        goto error;
+    }
+  }
+
+  if (python_choose_args != NULL && python_choose_args != Py_None) {
+    if (PyList_Check(python_choose_args)) {
+      PyObject *compile_args = Py_BuildValue("(O)", python_choose_args);
+      if (compile_args == NULL)
+        goto error;
+      mapper->choose_args = LibCrush_compile_choose_args(self, compile_args);
+      Py_DECREF(compile_args);
+      if (mapper->choose_args == NULL)
+        goto error;
+    } else {
+      Py_INCREF(python_choose_args);
+      mapper->choose_args = python_choose_args;
+    }
+    struct crush_choose_arg_map choose_arg_map;
+    int allocated;
+    PyObject *trace = trace_new(self);
+    int r = map_choose_args(self, mapper->choose_args, &choose_arg_map, &allocated, trace);
+    trace_end(trace, r);
+    if (!r)
+      goto error;
+    mapper->choose_arg_map = choose_arg_map.args;
+  }
+
+  if (self->verbose)
+    print_debug(PyUnicode_FromFormat("prepare(rule=%S=%d, replication_count=%d)\n",
+                                     rule,
+                                     ruleno,
+                                     replication_count));
+
+  return (PyObject *)mapper;
+
+ error:
+  Py_DECREF(mapper);
+  return 0;
+}
+
+PyTypeObject
+LibCrushMapperType = {
+    MyType_HEAD_INIT
+    "crush.LibCrushMapper",    /*tp_name*/
+    sizeof(LibCrushMapper),    /*tp_basicsize*/
+    0,                         /*tp_itemsize*/
+    (destructor)LibCrushMapper_dealloc, /*tp_dealloc*/
+#ifdef MAPPER_VECTORCALL
+    offsetof(LibCrushMapper, vectorcall), /*tp_vectorcall_offset*/
+#else
+    0,                         /*tp_print*/
+#endif
+    0,                         /*tp_getattr*/
+    0,                         /*tp_setattr*/
+    0,                         /*tp_compare*/
+    0,                         /*tp_repr*/
+    0,                         /*tp_as_number*/
+    0,                         /*tp_as_sequence*/
+    0,                         /*tp_as_mapping*/
+    0,                         /*tp_hash */
+#ifdef MAPPER_VECTORCALL
+    PyVectorcall_Call,         /*tp_call*/
+#else
+    (ternaryfunc)LibCrushMapper_call, /*tp_call*/
+#endif
+    0,                         /*tp_str*/
+    0,                         /*tp_getattro*/
+    0,                         /*tp_setattro*/
+    0,                         /*tp_as_buffer*/
+#ifdef MAPPER_VECTORCALL
+    Py_TPFLAGS_DEFAULT | Py_TPFLAGS_HAVE_VECTORCALL, /*tp_flags*/
+#else
+    Py_TPFLAGS_DEFAULT,        /*tp_flags*/
+#endif
+    "mapper returned by LibCrush.prepare(), call it with a value", /* tp_doc */
+};
+
+static PyObject *
+LibCrush_check_reciprocals(LibCrush *self, PyObject *args)
+{
+  PyObject *python_weights;
+  if (!PyArg_ParseTuple(args, "O", &python_weights))
+    return 0;
+
+  int *weights;
+  Py_ssize_t size;
+  if (!map_batch_values(python_weights, &weights, &size))
+    return 0;
+  Py_ssize_t i;
+  for (i = 0; i < size; i++) {
+    if (weights[i] == 0) {
+      PyErr_Format(PyExc_RuntimeError, "weight %zd must not be 0", i);
+      free(weights);
+      return 0;
+    }
+  }
+  long long mismatches = 0;
+  Py_BEGIN_ALLOW_THREADS
+  for (i = 0; i < size; i++)
+    mismatches += crush_reciprocal_check((__u32)weights[i]);
+  Py_END_ALLOW_THREADS
+  free(weights);
+  return PyLong_FromLongLong(mismatches);
+}
+
 static PyMemberDef
 LibCrush_members[] = {
     { NULL }
@@ -1483,16 +5132,68 @@ static PyMethodDef
 LibCrush_methods[] = {
     { "parse",      (PyCFunction) LibCrush_parse,    METH_VARARGS,
             PyDoc_STR("parse the crush map") },
+    { "encode",      (PyCFunction) LibCrush_encode,    METH_NOARGS,
+            PyDoc_STR("binary encoding of the parsed map for decode") },
+    { "decode",      (PyCFunction) LibCrush_decode,    METH_VARARGS,
+            PyDoc_STR("rebuild the map from the binary encoding of encode") },
+    { "__reduce__",      (PyCFunction) LibCrush_reduce,    METH_NOARGS,
+            PyDoc_STR("pickle with the binary encoding of the parsed map") },
+    { "__setstate__",      (PyCFunction) LibCrush_setstate,    METH_O,
+            PyDoc_STR("unpickle from the binary encoding of the parsed map") },
+    { "adjust_item_weight",      (PyCFunction) LibCrush_adjust_item_weight,    METH_VARARGS,
+            PyDoc_STR("change the weight of an item of a bucket in place") },
+    { "add_item",      (PyCFunction) LibCrush_add_item,    METH_VARARGS|METH_KEYWORDS,
+            PyDoc_STR("add an item to a bucket in place") },
+    { "remove_item",      (PyCFunction) LibCrush_remove_item,    METH_VARARGS|METH_KEYWORDS,
+            PyDoc_STR("remove an item from a bucket in place") },
     { "map",      (PyCFunction) LibCrush_map,        METH_VARARGS|METH_KEYWORDS,
             PyDoc_STR("map a value to items") },
+    { "prepare",      (PyCFunction) LibCrush_prepare,        METH_VARARGS|METH_KEYWORDS,
+            PyDoc_STR("return a callable mapping a value with a rule resolved once") },
+    { "map_batch",      (PyCFunction) LibCrush_map_batch,        METH_VARARGS|METH_KEYWORDS,
+            PyDoc_STR("map values to item ids") },
+    { "histogram",      (PyCFunction) LibCrush_histogram,        METH_VARARGS|METH_KEYWORDS,
+            PyDoc_STR("count how many times values are mapped to each item") },
+    { "map_record",      (PyCFunction) LibCrush_map_record,        METH_VARARGS|METH_KEYWORDS,
+            PyDoc_STR("map values and record the buckets and items each mapping depends on") },
+    { "remap",      (PyCFunction) LibCrush_remap,        METH_VARARGS|METH_KEYWORDS,
+            PyDoc_STR("map again the values of a recorded mapping that depend on changed ids") },
+    { "mapping_results",      (PyCFunction) LibCrush_mapping_results,        METH_VARARGS,
+            PyDoc_STR("item ids of a recorded mapping") },
+    { "mapping_histogram",      (PyCFunction) LibCrush_mapping_histogram,        METH_VARARGS,
+            PyDoc_STR("count how many times the values of a recorded mapping are mapped to each item") },
+    { "mapping_info",      (PyCFunction) LibCrush_mapping_info,        METH_VARARGS,
+            PyDoc_STR("size of a recorded mapping and number of values remapped") },
+    { "compile_straw2_cache",      (PyCFunction) LibCrush_compile_straw2_cache,        METH_VARARGS,
+            PyDoc_STR("cache the straw2 ln(hash) of values for histogram and map_batch") },
+    { "straw2_cache_info",      (PyCFunction) LibCrush_straw2_cache_info,        METH_VARARGS,
+            PyDoc_STR("budget, allocated bytes and buckets of a straw2 cache") },
+    { "movement",      (PyCFunction) LibCrush_movement,        METH_VARARGS|METH_KEYWORDS,
+            PyDoc_STR("count items moving from an origin mapping to a destination mapping") },
+    { "items_table",      (PyCFunction) LibCrush_items_table,        METH_NOARGS,
+            PyDoc_STR("ids of all items, sorted, and their names") },
+    { "compile_weights",      (PyCFunction) LibCrush_compile_weights,        METH_VARARGS,
+            PyDoc_STR("convert weights once for map and map_batch") },
+    { "compile_choose_args",      (PyCFunction) LibCrush_compile_choose_args,        METH_VARARGS,
+            PyDoc_STR("convert a choose_args list once for map and map_batch") },
+    { "update_choose_args_weight_set",      (PyCFunction) LibCrush_update_choose_args_weight_set,        METH_VARARGS,
+            PyDoc_STR("replace the weight_set of a bucket in compiled or named choose_args") },
+    { "check_reciprocals",      (PyCFunction) LibCrush_check_reciprocals,        METH_VARARGS,
+            PyDoc_STR("count straw2 draws that differ when the weight reciprocal replaces the division") },
     { "ceph_incompat",  (PyCFunction) LibCrush_ceph_incompat,    METH_NOARGS,
             PyDoc_STR("TRUE if the crushmap requires >= luminous") },
     { "ceph_read",  (PyCFunction) LibCrush_ceph_read,    METH_VARARGS,
             PyDoc_STR("read from Ceph txt/bin crushmap") },
+    { "ceph_read_binary",  (PyCFunction) LibCrush_ceph_read_binary,    METH_VARARGS,
+            PyDoc_STR("convert the bytes of a Ceph binary crushmap to Ceph json") },
+    { "ceph_load",  (PyCFunction) LibCrush_ceph_load,    METH_VARARGS,
+            PyDoc_STR("load the bytes of a Ceph binary crushmap without converting it, FALSE if parse() must be used instead") },
     { "ceph_write",  (PyCFunction) LibCrush_ceph_write,    METH_VARARGS,
             PyDoc_STR("write to Ceph txt/bin/json crushmap") },
     { "ceph_pool_pps",  (PyCFunction) LibCrush_ceph_pool_pps,  METH_VARARGS,
             PyDoc_STR("list of all pps for a Ceph pool") },
+    { "ceph_pools_pps",  (PyCFunction) LibCrush_ceph_pools_pps,  METH_VARARGS,
+            PyDoc_STR("arrays of pool, ps and pps for all PGs of Ceph pools") },
     { NULL }
 };
 
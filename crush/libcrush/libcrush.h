@@ -34,6 +34,7 @@
 #define MyBytes_GET_SIZE(o)             PyBytes_GET_SIZE(o)
 #define MyBytes_AS_STRING(o)            PyBytes_AS_STRING(o)
 #define MyText_AsString(o)              PyUnicode_AsUTF8(o)
+#define MyText_FromStringAndSize(s, n)  PyUnicode_FromStringAndSize(s, n)
 #define MyText_FromFormat               PyUnicode_FromFormat
 #define MyInt_FromInt(i)                PyLong_FromLong((long)i)
 #define MyInt_AsInt(o)                  (int)PyLong_AsLong(o)
@@ -50,6 +51,7 @@
 #define MyBytes_GET_SIZE(o)             PyString_GET_SIZE(o)
 #define MyBytes_AS_STRING(o)            PyString_AS_STRING(o)
 #define MyText_AsString(o)              PyString_AsString(o)
+#define MyText_FromStringAndSize(s, n)  PyString_FromStringAndSize(s, n)
 #define MyText_FromFormat               PyUnicode_FromFormat
 #define MyInt_FromInt(i)                PyInt_FromLong((long)i)
 #define MyInt_AsInt(o)                  (int)PyInt_AsLong(o)
@@ -68,6 +70,9 @@ typedef struct LibCrush {
 
   int verbose;
   int backward_compatibility;
+  int reciprocals; /* straw2 divides by multiplying with the weight reciprocals */
+  int straw2_block; /* straw2 buckets are evaluated by blocks of items */
+  int interleave; /* map_batch hashes the values of a chunk together */
   struct crush_map *tunables;
 
   int has_bucket_weights;
@@ -78,8 +83,15 @@ typedef struct LibCrush {
   int highest_device_id;
   PyObject *rules;
   PyObject *choose_args;
+  int mapping; /* number of map_batch() calls running without the GIL */
+  void *work; /* crush_do_rule workspace reused by map() */
+  int work_result_max; /* largest replication_count work can hold */
+  int work_initialized;
+  __u32 *default_weights; /* highest_device_id + 1 weights of 0x10000 */
+  unsigned long serial; /* unique to each successful parse() */
 } LibCrush;
 
 extern PyTypeObject LibCrushType;
+extern PyTypeObject LibCrushMapperType;
 
 #endif /* _LIBCRUSH_H */
@@ -61,6 +61,17 @@ PyInit_libcrush(void)
         return NULL;
     }
 
+    /* Initialize the mappers returned by LibCrush.prepare() */
+    if (PyType_Ready(&LibCrushMapperType) < 0) {
+        Py_DECREF(mod);
+        return NULL;
+    }
+
+    if (PyModule_AddIntConstant(mod, "ITEM_NONE", CRUSH_ITEM_NONE) < 0) {
+        Py_DECREF(mod);
+        return NULL;
+    }
+
     return mod;
 }
 
@@ -85,6 +96,13 @@ initlibcrush(void)
     Py_INCREF(&LibCrushType);
     PyModule_AddObject(mod, "LibCrush", (PyObject *)&LibCrushType);
 
+    /* Initialize the mappers returned by LibCrush.prepare() */
+    if (PyType_Ready(&LibCrushMapperType) < 0) {
+        return;
+    }
+
+    PyModule_AddIntConstant(mod, "ITEM_NONE", CRUSH_ITEM_NONE);
+
 }
 
 #endif /* Py3k */
@@ -20,18 +20,24 @@
 import argparse
 import collections
 import logging
+import os
 import textwrap
+import numpy as np
 
 from crush import Crush
 from crush import analyze
+from crush import cache
 from crush import compare
 from crush import optimize
+from crush import profile
 
 log = logging.getLogger('crush')
 
 
 class Main(object):
 
+    DEFAULT_CACHE_SIZE = 1024
+
     def __init__(self):
         self.create_parser()
 
@@ -50,6 +56,19 @@ class Main(object):
             help='debugging output, very verbose',
         )
 
+        self.parser.add_argument(
+            '--cache-dir',
+            help=('directory where the crushmaps converted from a file are '
+                  'cached (default: no cache)'),
+        )
+
+        self.parser.add_argument(
+            '--cache-size',
+            type=int, default=Main.DEFAULT_CACHE_SIZE,
+            help=('the least recently used crushmaps are removed from --cache-dir '
+                  'when it is larger than this many MB (default: %d)' % Main.DEFAULT_CACHE_SIZE),
+        )
+
         self.subparsers = self.parser.add_subparsers(
             title='subcommands',
             description='valid subcommands',
@@ -59,6 +78,7 @@ class Main(object):
         analyze.Analyze.set_parser(self.subparsers, self.hook_analyze_args)
         compare.Compare.set_parser(self.subparsers, self.hook_compare_args)
         optimize.Optimize.set_parser(self.subparsers, self.hook_optimize_args)
+        profile.Profile.set_parser(self.subparsers, self.hook_profile_args)
 
     def create_parser(self):
         self.parser = argparse.ArgumentParser(
@@ -174,14 +194,54 @@ class Main(object):
         if not self.args.choose_args:
             raise Exception("missing --choose-args")
 
+    def hook_profile_args(self, parser):
+        pass
+
+    def hook_profile_pre_sanity_check_args(self, args):
+        if not args.crushmap:
+            raise Exception("missing --crushmap")
+        for tunables in args.tunables or []:
+            if tunables != 'crushmap' and not args.backward_compatibility:
+                raise Exception("--tunables " + tunables + " requires backward compatibility")
+
+    def hook_profile_post_sanity_check_args(self, args):
+        pass
+
     def hook_create_values(self):
         values = range(0, self.args.values_count)
         return dict(zip(values, values))
 
+    def hook_create_value_array(self):
+        values = self.hook_create_values()
+        return np.fromiter(values.values(), dtype=np.int32, count=len(values))
+
     def value_name(self):
         return 'objects'
 
+    def cached_crushmap(self, crushmap, convert):
+        """Return convert(crushmap), from the --cache-dir when crushmap is
+        the path of a file that was converted before. The cached crushmap
+        is a new object every time and can be modified by the caller.
+
+        """
+        if (not self.args.cache_dir or
+                type(crushmap) in (dict, collections.OrderedDict) or
+                not os.path.isfile(crushmap)):
+            return convert(crushmap)
+        with open(crushmap, 'rb') as f:
+            content = f.read()
+        c = cache.Cache(self.args.cache_dir, self.args.cache_size * 1024 * 1024)
+        key = c.key(content, type(self).__name__, bool(self.args.backward_compatibility))
+        converted = c.get(key)
+        if converted is None:
+            converted = convert(crushmap)
+            c.put(key, converted)
+        return converted
+
     def convert_to_crushmap(self, crushmap):
+        return self.cached_crushmap(crushmap, self._convert_to_crushmap)
+
+    def _convert_to_crushmap(self, crushmap):
         c = Crush(verbose=self.args.debug,
                   backward_compatibility=self.args.backward_compatibility)
         c.parse(crushmap)
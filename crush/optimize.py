@@ -23,6 +23,10 @@ import argparse
 import collections
 import copy
 import logging
+import mmap
+import os
+import pickle
+import tempfile
 import textwrap
 
 from crush import Crush
@@ -32,10 +36,55 @@ from crush.analyze import Analyze
 
 log = logging.getLogger(__name__)
 
+#
+# With --multithread the buckets of each level of the hierarchy are
+# optimized by the workers of a multiprocessing Pool. Each worker is
+# given the Optimize instance once, when it starts. The parsed
+# crushmap of a level is pickled once in a file that the workers map
+# read-only and unpickle once, instead of receiving a copy of the
+# crushmap with each bucket. Unpickling a Crush does not parse the
+# crushmap again, see the **Pickling** section of its documentation.
+#
+worker = {}
+
+
+def worker_init(optimize):
+    worker['optimize'] = optimize
+
+
+def worker_attach(path):
+    if worker.get('path') != path:
+        worker.pop('crush', None)
+        with open(path, 'rb') as f:
+            m = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+            try:
+                worker['crush'] = pickle.load(m)
+            finally:
+                m.close()
+        worker['path'] = path
+    return worker['crush']
+
 
 def top_optimize(args):
-    self = args[0]
-    return self.optimize_bucket(*args[1:])
+    (p, path, bucket_id) = args
+    if bucket_id is None:  # a reference has no children to optimize
+        return None
+    origin = worker_attach(path)
+    return worker['optimize'].optimize_bucket(p, origin.get_crushmap(),
+                                              origin.get_item_by_id(bucket_id))
+
+
+class SharedCrush(object):
+
+    def __init__(self, c):
+        shm = '/dev/shm'
+        (fd, self.path) = tempfile.mkstemp(prefix='crush-optimize-',
+                                           dir=shm if os.path.isdir(shm) else None)
+        with os.fdopen(fd, 'wb') as f:
+            pickle.dump(c, f, pickle.HIGHEST_PROTOCOL)
+
+    def close(self):
+        os.unlink(self.path)
 
 
 class Optimize(object):
@@ -193,7 +242,11 @@ class Optimize(object):
             raise ValueError(bucket['name'] + ' algorithm is ' + bucket['algorithm'] +
                              ', only straw2 can be optimized')
         log.warning(bucket['name'] + " optimizing")
-        crushmap = copy.deepcopy(origin_crushmap)
+        #
+        # optimize_replica() only modifies the choose_args
+        #
+        crushmap = copy.copy(origin_crushmap)
+        crushmap['choose_args'] = copy.deepcopy(origin_crushmap.get('choose_args', {}))
         if self.args.with_positions:
             for replication_count in range(1, self.args.replication_count + 1):
                 log.debug(bucket['name'] + " improving replica " + str(replication_count))
@@ -236,13 +289,26 @@ class Optimize(object):
         log.debug(bucket['name'] + " optimizing replica " + str(replication_count) + " " +
                   str(dict(id2weight)))
         c = Crush(backward_compatibility=self.args.backward_compatibility)
-        c.parse(crushmap)
+        c.parse(crushmap, copy_crushmap=False)
 
         (take, failure_domain) = c.rule_get_take_failure_domain(a.args.rule)
         #
+        # the same values are mapped at each iteration, only the weights change
+        #
+        straw2_cache = c.compile_straw2_cache(a.main.hook_create_value_array(),
+                                              replication_count)
+        #
+        # only the values that chose from the bucket are mapped again
+        # when its weight_set changes
+        #
+        weights = a.simulation_weights(c)
+        mapping = c.map_record(a.args.rule, a.main.hook_create_value_array(),
+                               replication_count, weights,
+                               choose_args=a.args.choose_args, straw2_cache=straw2_cache)
+        #
         # initial simulation
         #
-        i = a.run_simulation(c, take, failure_domain)
+        i = a.run_simulation(c, take, failure_domain, mapping=mapping)
         i = i.reset_index()
         s = i['~name~'] == 'KKKK'  # init to False, there must be a better way
         for item in bucket['children']:
@@ -257,8 +323,13 @@ class Optimize(object):
         n = self.main.value_name()
         for iterations in range(max_iterations):
             choose_arg['weight_set'][choose_arg_position] = list(id2weight.values())
-            c.parse(crushmap)
-            z = a.run_simulation(c, take, failure_domain)
+            c.update_choose_args_weight_set(a.args.choose_args, {
+                'bucket_id': bucket['id'],
+                'weight_set': choose_arg['weight_set'],
+            })
+            mapping = c.remap(mapping, [bucket['id']], weights,
+                              choose_args=a.args.choose_args, straw2_cache=straw2_cache)
+            z = a.run_simulation(c, take, failure_domain, mapping=mapping)
             z = z.reset_index()
             d = z[s].copy()
             d['~delta~'] = d['~' + n + '~'] - d['~expected~']
@@ -312,7 +383,10 @@ class Optimize(object):
             id2weight[d.iloc[-1]['~id~']] += shift
 
         choose_arg['weight_set'][choose_arg_position] = best_weights
-        c.parse(crushmap)
+        c.update_choose_args_weight_set(a.args.choose_args, {
+            'bucket_id': bucket['id'],
+            'weight_set': choose_arg['weight_set'],
+        })
         compare_instance.set_destination(c)
         (from_to, in_out) = compare_instance.compare_bucket(bucket)
         from_to_count = sum(map(lambda x: sum(x.values()), from_to.values()))
@@ -329,30 +403,32 @@ class Optimize(object):
         crushmap = c.get_crushmap()
         if 'choose_args' not in crushmap:
             crushmap['choose_args'] = {}
-            c.parse(crushmap)
         if self.args.choose_args not in crushmap['choose_args']:
             crushmap['choose_args'][self.args.choose_args] = []
-            c.parse(crushmap)
+            c.parse(crushmap, copy_crushmap=False)
         (take, failure_domain) = c.rule_get_take_failure_domain(self.args.rule)
 
         parser = analyze.Analyze.get_parser()
         self.main.hook_analyze_args(parser)
         p = self.main.get_trimmed_argv(parser, self.args)
-        a = self.main.clone().constructor(['analyze'] + p)
 
         if self.args.multithread:
             from multiprocessing import Pool
-            pool = Pool()
+            pool = Pool(initializer=worker_init, initargs=(self,))
         children = [c.find_bucket(take)]
         total_count = 0
         over_step = False
         n = self.main.value_name()
         while not over_step and len(children) > 0:
-            a = [(self, p, c.get_crushmap(), item) for item in children]
             if self.args.multithread:
-                r = list(pool.map(top_optimize, a))
+                shared = SharedCrush(c)
+                try:
+                    r = pool.map(top_optimize, [(p, shared.path, item.get('id'))
+                                                for item in children])
+                finally:
+                    shared.close()
             else:
-                r = list(map(top_optimize, a))
+                r = [self.optimize_bucket(p, c.get_crushmap(), item) for item in children]
             for i in range(len(children)):
                 if r[i] is None:
                     continue
@@ -371,6 +447,9 @@ class Optimize(object):
                 nc.extend(item.get('children', []))
             # fail if all children are not of the same type
             children = nc
+        if self.args.multithread:
+            pool.close()
+            pool.join()
         return (total_count, c.get_crushmap())
 
     def run(self):
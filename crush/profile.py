@@ -0,0 +1,345 @@
+# -*- mode: python; coding: utf-8 -*-
+#
+# Copyright (C) 2017 <contact@redhat.com>
+#
+# Author: Loic Dachary <loic@dachary.org>
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+#
+from __future__ import division
+
+import argparse
+import collections
+import logging
+import textwrap
+import timeit
+import pandas as pd
+import numpy as np
+
+from crush import Crush, ITEM_NONE
+from crush.analyze import Analyze
+
+log = logging.getLogger(__name__)
+
+
+class Profile(object):
+
+    DEFAULT_REPLICATION_COUNTS = [1, 2, 3]
+    DEFAULT_REPEAT = 3
+    DEFAULT_OUTLIER_FACTOR = 2.0
+
+    #
+    # The tunables of the Ceph profiles with the same name
+    #
+    TUNABLES = collections.OrderedDict([
+        ('argonaut', {
+            'choose_local_tries': 2,
+            'choose_local_fallback_tries': 5,
+            'choose_total_tries': 19,
+            'chooseleaf_descend_once': 0,
+            'chooseleaf_vary_r': 0,
+            'chooseleaf_stable': 0,
+            'straw_calc_version': 0,
+        }),
+        ('bobtail', {
+            'choose_local_tries': 0,
+            'choose_local_fallback_tries': 0,
+            'choose_total_tries': 50,
+            'chooseleaf_descend_once': 1,
+            'chooseleaf_vary_r': 0,
+            'chooseleaf_stable': 0,
+            'straw_calc_version': 0,
+        }),
+        ('firefly', {
+            'choose_local_tries': 0,
+            'choose_local_fallback_tries': 0,
+            'choose_total_tries': 50,
+            'chooseleaf_descend_once': 1,
+            'chooseleaf_vary_r': 1,
+            'chooseleaf_stable': 0,
+            'straw_calc_version': 1,
+        }),
+        ('jewel', {
+            'choose_local_tries': 0,
+            'choose_local_fallback_tries': 0,
+            'choose_total_tries': 50,
+            'chooseleaf_descend_once': 1,
+            'chooseleaf_vary_r': 1,
+            'chooseleaf_stable': 1,
+            'straw_calc_version': 1,
+        }),
+    ])
+
+    def __init__(self, args, main):
+        self.args = args
+        self.main = main
+
+    @staticmethod
+    def get_parser():
+        parser = Analyze.get_parser_base()
+        parser.add_argument(
+            '--replication-count',
+            help=('number of devices to map, may be repeated (default: %s)' %
+                  ", ".join(map(str, Profile.DEFAULT_REPLICATION_COUNTS))),
+            type=int,
+            action='append')
+        parser.add_argument(
+            '--rule',
+            help='the name of rule, may be repeated (default: all rules)',
+            action='append')
+        parser.add_argument(
+            '--tunables',
+            help=('map with the tunables of the crushmap or of a Ceph profile, '
+                  'may be repeated (default: crushmap)'),
+            choices=['crushmap'] + list(Profile.TUNABLES.keys()),
+            action='append')
+        parser.add_argument(
+            '--crushmap',
+            help='path to the crushmap file')
+        parser.add_argument(
+            '-w', '--weights',
+            help='path to the weights file')
+        parser.add_argument(
+            '--baseline',
+            metavar='PATH',
+            help='PATH to a crushmap file to compare the mapping cost with')
+        parser.add_argument(
+            '--repeat',
+            help=('time the mapping of the values N times and keep the fastest '
+                  '(default: %d)' % Profile.DEFAULT_REPEAT),
+            metavar='N',
+            type=int,
+            default=Profile.DEFAULT_REPEAT)
+        parser.add_argument(
+            '--outlier-factor',
+            help=('a mapping is an outlier if it is more than F times slower '
+                  'than the median or than the baseline (default: %.1f)' %
+                  Profile.DEFAULT_OUTLIER_FACTOR),
+            metavar='F',
+            type=float,
+            default=Profile.DEFAULT_OUTLIER_FACTOR)
+        return parser
+
+    @staticmethod
+    def set_parser(subparsers, arguments):
+        parser = Profile.get_parser()
+        arguments(parser)
+        subparsers.add_parser(
+            'profile',
+            formatter_class=argparse.RawDescriptionHelpFormatter,
+            description=textwrap.dedent("""\
+            Profile the cost of the rules of a crushmap
+
+            Map a number of objects (--values-count) with each rule
+            of a crushmap (--crushmap or --rule if specified), for
+            each replication count (1, 2 and 3 by default or
+            --replication-count if specified) and each set of
+            tunables (those of the crushmap by default or --tunables
+            if specified). Display the time it takes to map an object
+            and what makes it more expensive.
+
+            The tunables of the Ceph profiles (argonaut, bobtail,
+            firefly and jewel) include tunables that only exist for
+            backward compatibility: --tunables with a Ceph profile is
+            an error if backward compatibility is not allowed (see
+            crush ceph --no-backward-compatibility).
+
+            The format of the crushmap file specified with --crushmap
+            can either be:
+
+            - a JSON representation of a crushmap as documented in the
+              Crush.parse_crushmap() method
+
+            - a Ceph binary, text or JSON crushmap compatible with
+              Luminuous and below
+
+            The columns of the report are:
+
+            - ns/mapping: the nanoseconds it takes to map an object,
+              the fastest of --repeat runs
+
+            - ns/replica: ns/mapping divided by the replication count
+
+            - tries/mapping: the number of descents in the hierarchy
+              to map an object, including those that are retried
+
+            - retried %: the percentage of the items that were chosen
+              after at least one failed descent
+
+            - rejects: the number of devices rejected because they
+              are out
+
+            - collisions: the number of items rejected because they
+              were already chosen
+
+            - failed: the number of objects mapped to less than
+              replication count devices
+
+            - algorithms: the algorithms of the buckets the rule
+              descends into and how many buckets use them
+
+            - outlier: True if ns/replica is more than
+              --outlier-factor times the median of all rows
+
+            The report is followed by the retry distribution: the
+            number of items chosen after N failed descents, for each
+            N.
+
+            If a --baseline crushmap is specified, it is profiled in
+            the same way and the ratio between the ns/mapping of the
+            --crushmap and of the --baseline is displayed. If it is
+            more than --outlier-factor for a row, the row is flagged
+            as slower and the exit status is 1, for instance to
+            verify a crushmap does not make mapping much more
+            expensive before it is used.
+
+            """),
+            epilog=textwrap.dedent("""
+            Examples:
+
+            Profile the data rule with the tunables of the crushmap
+            and with the jewel tunables:
+
+            $ crush profile --values-count 10000 --rule data \\
+                            --tunables crushmap --tunables jewel \\
+                            --crushmap crushmap.txt
+
+            Fail if mapping with the rules of a new crushmap is more
+            than twice slower than with the current crushmap:
+
+            $ crush profile --crushmap new.txt --baseline current.txt
+            """),
+            help='Profile the cost of crushmap rules',
+            parents=[parser],
+        ).set_defaults(
+            func=Profile,
+        )
+
+    def pre_sanity_check_args(self):
+        self.main.hook_profile_pre_sanity_check_args(self.args)
+
+    def post_sanity_check_args(self):
+        self.main.hook_profile_post_sanity_check_args(self.args)
+
+    def parse(self, crushmap, tunables):
+        if tunables != 'crushmap':
+            crushmap = dict(crushmap)
+            crushmap['tunables'] = Profile.TUNABLES[tunables]
+        c = Crush(backward_compatibility=self.args.backward_compatibility)
+        c.parse(crushmap)
+        return c
+
+    @staticmethod
+    def collect_algorithms(c, rule):
+        algorithms = collections.Counter()
+
+        def walk(bucket):
+            algorithms[bucket.get('algorithm', 'straw2')] += 1
+            for child in bucket.get('children', []):
+                if 'children' in child:
+                    walk(child)
+        for step in c.get_crushmap()['rules'][rule]:
+            if step[0] == 'take':
+                walk(c.find_bucket(step[1]))
+        return " ".join("{}:{}".format(a, n) for (a, n) in sorted(algorithms.items()))
+
+    def profile_rule(self, c, rule, replication_count, values, weights):
+        def run(stats=None):
+            return c.map_batch(rule, values, replication_count, weights,
+                               choose_args=self.args.choose_args, stats=stats)
+        elapsed = min(timeit.repeat(run, number=1, repeat=self.args.repeat))
+        stats = {}
+        mapped = run(stats)
+        choose_tries = stats['choose_tries']
+        chosen = choose_tries.sum()
+        ns = elapsed * 1e9 / max(len(values), 1)
+        return (collections.OrderedDict([
+            ('ns/mapping', ns),
+            ('ns/replica', ns / replication_count),
+            ('tries/mapping', stats['tries'] / max(len(values), 1)),
+            ('retried %', (chosen - choose_tries[0]) * 100 / chosen if chosen else 0.0),
+            ('rejects', stats['rejects']),
+            ('collisions', stats['collisions']),
+            ('failed', int((mapped == ITEM_NONE).any(axis=1).sum())),
+        ]), choose_tries)
+
+    def profile_crushmap(self, crushmap):
+        values = self.main.hook_create_value_array()
+        rows = []
+        retries = []
+        for tunables in self.args.tunables or ['crushmap']:
+            c = self.parse(crushmap, tunables)
+            if self.args.weights:
+                with open(self.args.weights) as f_weights:
+                    weights = c.compile_weights(c.parse_weights_file(f_weights))
+            else:
+                weights = None
+            rules = self.args.rule or sorted(c.get_crushmap()['rules'].keys())
+            for rule in rules:
+                algorithms = Profile.collect_algorithms(c, rule)
+                for replication_count in (self.args.replication_count or
+                                          Profile.DEFAULT_REPLICATION_COUNTS):
+                    log.info("profile rule " + rule + " replication count " +
+                             str(replication_count) + " tunables " + tunables)
+                    (row, choose_tries) = self.profile_rule(c, rule, replication_count,
+                                                            values, weights)
+                    key = collections.OrderedDict([
+                        ('rule', rule),
+                        ('replicas', replication_count),
+                        ('tunables', tunables),
+                    ])
+                    key.update(row)
+                    key['algorithms'] = algorithms
+                    rows.append(key)
+                    retries.append(choose_tries)
+        d = pd.DataFrame(rows, columns=list(rows[0].keys()))
+        d = d.set_index(['rule', 'replicas', 'tunables'])
+        size = max([len(np.trim_zeros(r, 'b')) for r in retries] + [1])
+        r = pd.DataFrame([r[:size] for r in retries], index=d.index)
+        return (d, r)
+
+    def profile(self):
+        self.pre_sanity_check_args()
+        crushmap = self.main.convert_to_crushmap(self.args.crushmap)
+        self.post_sanity_check_args()
+        (d, retries) = self.profile_crushmap(crushmap)
+        median = d['ns/replica'].median()
+        d['outlier'] = (len(d) > 1) & (d['ns/replica'] > median * self.args.outlier_factor)
+        if self.args.baseline:
+            (b, _) = self.profile_crushmap(self.main.convert_to_crushmap(self.args.baseline))
+            d['baseline ns/mapping'] = b['ns/mapping']
+            d['ratio'] = d['ns/mapping'] / d['baseline ns/mapping']
+            d['slower'] = d['ratio'] > self.args.outlier_factor
+        return (d, retries)
+
+    def profile_report(self, d, retries):
+        pd.set_option('display.max_rows', None)
+        pd.set_option('display.max_columns', None)
+        pd.set_option('display.width', 160)
+        out = str(d.round(2))
+        out += "\n\nNumber of items chosen after N failed descents:\n\n"
+        out += str(retries)
+        if d['outlier'].any():
+            out += "\n\nThe mapping cost of the following is an outlier:\n\n"
+            out += str(d.loc[d['outlier'], ['ns/replica']].round(2))
+        return out
+
+    def run(self):
+        (d, retries) = self.profile()
+        print(self.profile_report(d, retries))
+        if 'slower' in d and d['slower'].any():
+            log.error("mapping is more than " + str(self.args.outlier_factor) +
+                      " times slower than with the baseline")
+            return 1
+        return 0
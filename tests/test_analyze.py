@@ -337,6 +337,24 @@ root               0.00\
         res = a.run()
         assert "-100.00" in str(res)  # One of the OSDs has a weight of 0.0
 
+    def test_run_simulation_mapping(self):
+        a = Main().constructor(
+            ["analyze", "--rule", "replicated_ruleset",
+             "--replication-count", "2", "--type", "device",
+             "--crushmap", "tests/weights-crushmap.json",
+             "--weights", "tests/weights.json"])
+        a.args.backward_compatibility = True
+        c = Crush(backward_compatibility=True)
+        c.parse(a.args.crushmap)
+        (take, failure_domain) = c.rule_get_take_failure_domain(a.args.rule)
+        expected = a.run_simulation(c, take, failure_domain)
+        mapping = c.map_record(a.args.rule, a.main.hook_create_value_array(),
+                               a.args.replication_count, a.simulation_weights(c))
+        # the weights file is not read again to count a mapping
+        a.args.weights = "tests/weights-does-not-exist.json"
+        d = a.run_simulation(c, take, failure_domain, mapping=mapping)
+        assert expected.equals(d)
+
 # Local Variables:
 # compile-command: "cd .. ; tox -e py27 -- -s -vv tests/test_analyze.py"
 # End:
@@ -0,0 +1,73 @@
+# -*- mode: python; coding: utf-8 -*-
+#
+# Copyright (C) 2017 <contact@redhat.com>
+#
+# Author: Loic Dachary <loic@dachary.org>
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+#
+import os
+import time
+
+from crush.cache import Cache
+
+
+class TestCache(object):
+
+    def test_key(self):
+        assert Cache.key(b'content', 'Main', True) == Cache.key(b'content', 'Main', True)
+        assert Cache.key(b'content', 'Main', True) != Cache.key(b'other', 'Main', True)
+        assert Cache.key(b'content', 'Main', True) != Cache.key(b'content', 'Ceph', True)
+        assert Cache.key(b'content', 'Main', True) != Cache.key(b'content', 'Main', False)
+
+    def test_code_version(self, monkeypatch):
+        key = Cache.key(b'content', 'Main', True)
+        assert Cache.code_version() == Cache.code_version()
+        monkeypatch.setattr(Cache, '_code_version', 'other')
+        assert key != Cache.key(b'content', 'Main', True)
+
+    def test_get_put(self, tmpdir):
+        c = Cache(str(tmpdir.join('cache')), 1024 * 1024)
+        assert c.get('key') is None
+        crushmap = {'trees': [{'name': 'root', 'children': []}]}
+        c.put('key', crushmap)
+        assert crushmap == c.get('key')
+        assert c.get('key') is not c.get('key')
+        open(c.path('broken'), 'w').write('not a pickle')
+        assert c.get('broken') is None
+        assert not os.path.exists(c.path('broken'))
+        # a pickle of an object that no longer exists
+        open(c.path('foreign'), 'wb').write(b'cos\nno_such_attribute\n.')
+        assert c.get('foreign') is None
+        assert not os.path.exists(c.path('foreign'))
+        # the directory may be created by another process
+        c = Cache(str(tmpdir.join('cache')), 1024 * 1024)
+        c.put('other', crushmap)
+        assert crushmap == c.get('other')
+
+    def test_evict(self, tmpdir):
+        c = Cache(str(tmpdir), 1024 * 1024)
+        for key in ('a', 'b', 'c'):
+            c.put(key, 'x' * 1000)
+            os.utime(c.path(key), (time.time(), {'a': 1, 'b': 2, 'c': 3}[key]))
+        c.get('a')
+        c.size = 2 * os.path.getsize(c.path('a'))
+        c.evict()
+        assert c.get('a') is not None
+        assert c.get('b') is None
+        assert c.get('c') is not None
+
+# Local Variables:
+# compile-command: "cd .. ; tox -e py27 -- -s -vv tests/test_cache.py"
+# End:
@@ -111,6 +111,22 @@ class TestCeph(object):
                 assert os.system(cmd + " " + expected_path + " " + out_path) == 0
                 os.unlink(out_path)
 
+    def test_cache(self, tmpdir):
+        cache_dir = str(tmpdir.join('cache'))
+        expected_path = 'tests/sample-ceph-crushmap.txt'
+        out_path = expected_path + ".err"
+        for i in range(2):
+            Ceph().main([
+                '--cache-dir', cache_dir,
+                'convert',
+                '--in-path', 'tests/sample-ceph-crushmap.crush',
+                '--out-path', out_path,
+                '--out-format', 'txt',
+            ])
+            assert os.system("diff -Bbu " + expected_path + " " + out_path) == 0
+            os.unlink(out_path)
+            assert 1 == len(os.listdir(cache_dir))
+
     def test_report(self):
         in_path = 'tests/ceph/ceph-report.json'
         expected_path = 'tests/ceph/crushmap-from-ceph-report.json'
@@ -171,6 +187,7 @@ class TestCeph(object):
         ])
         expected = {u'2.0': -113899774, u'2.1': -1215435108, u'2.2': -832918304}
         assert expected == c.hook_create_values()
+        assert list(expected.values()) == c.hook_create_value_array().tolist()
 
     def test_out_version(self):
         expected_path = 'tests/sample-ceph-crushmap-compat.txt'
@@ -17,6 +17,7 @@
 # You should have received a copy of the GNU General Public License
 # along with this program.  If not, see <http://www.gnu.org/licenses/>.
 #
+import os
 import pytest
 
 from crush.ceph import CephCrushmapConverter, CephCrush
@@ -40,6 +41,41 @@ class TestCephCrush(object):
             crushmap = c._convert_to_crushmap("tests/sample-bugous-crushmap.json")
         assert "Expecting property name" in str(e.value)
 
+    def test_parse_binary(self):
+        path = "tests/sample-ceph-crushmap.crush"
+        c = CephCrush(backward_compatibility=True)
+        c.parse(path)
+        assert 'crushmap' not in c.__dict__
+        mapped = [c.map('data', value, 3, choose_args='1') for value in range(100)]
+        expected = CephCrush(backward_compatibility=True)
+        expected.parse(c._convert_to_crushmap(path))
+        assert expected.get_crushmap() == c.get_crushmap()
+        assert 'crushmap' in c.__dict__
+        assert expected.get_item_by_name('host0') == c.get_item_by_name('host0')
+        assert mapped == [expected.map('data', value, 3, choose_args='1') for value in range(100)]
+        #
+        # a crushmap with -target-weight buckets is parsed as usual
+        # to recover its choose_args
+        #
+        compat = CephCrush(backward_compatibility=True)
+        compat.parse('tests/sample-ceph-crushmap-compat.txt')
+        crushmap = compat.get_crushmap()
+        crushmap['choose_args'] = {'1': crushmap['choose_args'][' placeholder ']}
+        compat.parse(crushmap, copy_crushmap=False)
+        compat.to_file('tests/sample-ceph-crushmap-compat.crush.err', 'crush', 'hammer')
+        c.parse('tests/sample-ceph-crushmap-compat.crush.err')
+        assert 'crushmap' in c.__dict__
+        assert [' placeholder '] == list(c.get_crushmap()['choose_args'].keys())
+        os.unlink('tests/sample-ceph-crushmap-compat.crush.err')
+
+    def test_pools_pps(self):
+        (pools, ps, pps) = CephCrush.pools_pps([(2, 3, 3), (1, 17, 16)])
+        assert [-113899774, -1215435108, -832918304] == pps[:3].tolist()
+        assert 20 == len(pps)
+        names = CephCrush.pg_names(pools, ps)
+        assert ['2.0', '2.1', '2.2', '1.0'] == names[:4]
+        assert '1.10' == names[-1]
+
 
 class TestCephCrushmapConverter(object):
 
@@ -303,6 +303,49 @@ class TestCompare(object):
             'device08': {'device05': 1}
         }
 
+    def test_compare_bad_mapping(self):
+        crushmap = {
+            "trees": [
+                {
+                    "type": "root",
+                    "id": -1,
+                    "name": "dc1",
+                    "children": [
+                        {
+                            "type": "host",
+                            "id": -(i + 2),
+                            "name": "host%d" % i,
+                            "children": [
+                                {"id": i, "name": "device%d" % i, "weight": 1},
+                            ],
+                        } for i in range(2)
+                    ],
+                }
+            ],
+            "rules": {
+                "firstn": [
+                    ["take", "dc1"],
+                    ["chooseleaf", "firstn", 0, "type", "host"],
+                    ["emit"]
+                ],
+            }
+        }
+        c1 = Crush()
+        c1.parse(crushmap)
+        c2 = Crush()
+        c2.parse(copy.deepcopy(crushmap))
+        c = Main().constructor([
+            'compare',
+            '--rule', 'firstn',
+            '--replication-count', '3',
+            '--values-count', '100',
+        ])
+        c.set_origin(c1)
+        c.set_destination(c2)
+        with pytest.raises(AssertionError) as e:
+            c.compare()
+        assert 'failed to map' in str(e.value)
+
     def define_crushmaps_2(self):
         crushmap = {
             "trees": [
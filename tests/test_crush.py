@@ -17,7 +17,10 @@
 # You should have received a copy of the GNU General Public License
 # along with this program.  If not, see <http://www.gnu.org/licenses/>.
 #
+import collections
 import copy
+import numpy as np
+import pickle
 import pytest # noqa needed for caplog
 
 from crush import Crush
@@ -63,6 +66,210 @@ class TestCrush(object):
         assert len(c.map(rule="data", value=1234, replication_count=1,
                          weights={}, choose_args=[])) == 1
 
+    def test_prepare(self):
+        crushmap = self.build_crushmap()
+        c = Crush()
+        assert c.parse(crushmap)
+        weights = np.ones(max(c.items_table()[0]) + 1)
+        weights[3] = 0.0
+        mapper = c.prepare("data", 2, weights=weights)
+        for value in range(100):
+            assert mapper(value) == c.map("data", value, 2, weights=c.compile_weights(weights))
+        mapper = c.prepare("data", 2, ids=True)
+        assert mapper(1) == [c.get_item_by_name(name)['id'] for name in c.map("data", 1, 2)]
+
+    def test_map_batch(self):
+        crushmap = self.build_crushmap()
+        c = Crush(verbose=1)
+        assert c.parse(crushmap)
+        mapped = c.map_batch(rule="data", values=range(100), replication_count=2)
+        assert mapped.shape == (100, 2)
+        for value in range(100):
+            names = c.map(rule="data", value=value, replication_count=2)
+            assert [c.get_item_by_id(id)['name'] for id in mapped[value]] == names
+        assert c.map_batch(rule="data", values=[], replication_count=2).shape == (0, 2)
+        assert (c.map_batch(rule="data", values=range(100), replication_count=2,
+                            threads=4) == mapped).all()
+
+    def test_histogram(self):
+        crushmap = self.build_crushmap()
+        c = Crush()
+        assert c.parse(crushmap)
+        (devices, buckets, failed) = c.histogram("data", range(1000), 2, threads=2)
+        assert failed == 0
+        mapped = c.map_batch("data", range(1000), 2)
+        assert list(devices) == list(np.bincount(mapped.ravel(), minlength=len(devices)))
+        assert buckets[0] == 2000
+        for (id, item) in c._id2item.items():
+            if id < 0 and id != -1:
+                children = [child['id'] for child in item['children']]
+                assert buckets[-1 - id] == devices[children].sum()
+
+    def test_movement(self):
+        crushmap = self.build_crushmap()
+        c = Crush()
+        assert c.parse(crushmap)
+        weights = {"device00": 0.0, "device03": 0.5}
+        for order_matters in (True, False):
+            (moved, am, bm) = c.movement("data", range(1000), 2,
+                                         destination_weights=weights,
+                                         order_matters=order_matters)
+            assert (am == c.map_batch("data", range(1000), 2)).all()
+            assert (bm == c.map_batch("data", range(1000), 2, weights)).all()
+            expected = collections.Counter()
+            for (a, b) in zip(am.tolist(), bm.tolist()):
+                if order_matters:
+                    pairs = [(x, y) for (x, y) in zip(a, b) if x != y]
+                else:
+                    pairs = zip([x for x in a if x not in b], [y for y in b if y not in a])
+                expected.update(pairs)
+            assert moved[:, 2].sum() > 0
+            assert {(f, t): n for (f, t, n) in moved.tolist()} == dict(expected)
+
+    def test_items_table(self):
+        crushmap = self.build_crushmap()
+        c = Crush()
+        assert c.parse(crushmap)
+        (ids, names) = c.items_table()
+        assert len(ids) == len(names) == len(c._id2item)
+        for (id, name) in zip(ids, names):
+            assert c.get_item_by_id(id)['name'] == name
+        mapped = c.map_batch("data", range(100), 2)
+        mapped_names = names[np.searchsorted(ids, mapped)]
+        for value in range(100):
+            assert c.map("data", value, 2, ids=True) == list(mapped[value])
+            assert c.map("data", value, 2) == list(mapped_names[value])
+
+    def test_compile_weights(self):
+        crushmap = self.build_crushmap()
+        c = Crush()
+        assert c.parse(crushmap)
+        weights = {"device00": 0.0, "device03": 0.5}
+        by_id = [0.0, 1.0, 1.0, 0.5]
+        for compiled in (c.compile_weights(weights), c.compile_weights(by_id),
+                         c.compile_weights(np.array(by_id, dtype=np.float32))):
+            for value in range(100):
+                assert (c.map("data", value, 2, weights) == c.map("data", value, 2, compiled))
+        # an array of float indexed by device id is compiled on the fly
+        array = np.array(by_id)
+        for value in range(100):
+            assert c.map("data", value, 2, weights) == c.map("data", value, 2, array)
+        assert (c.map_batch("data", range(100), 2, weights) ==
+                c.map_batch("data", range(100), 2, array)).all()
+        (devices, buckets, failed) = c.histogram("data", range(100), 2, array)
+        assert (devices == c.histogram("data", range(100), 2, weights)[0]).all()
+        mapping = c.map_record("data", range(100), 2, array)
+        assert (c.mapping_results(c.remap(mapping, [-2], array)) ==
+                c.map_batch("data", range(100), 2, weights)).all()
+
+    def test_compile_choose_args(self):
+        crushmap = self.build_crushmap()
+        c = Crush()
+        assert c.parse(crushmap)
+        choose_args = [{"bucket_name": "host0", "weight_set": [[0x10000, 0x10000]]}]
+        compiled = c.compile_choose_args(choose_args)
+        choose_args[0]["weight_set"] = [[0x30000, 0x10000]]
+        assert c.update_choose_args_weight_set(compiled, choose_args[0])
+        assert ((c.map_batch("data", range(100), 2, choose_args=choose_args) ==
+                 c.map_batch("data", range(100), 2, choose_args=compiled)).all())
+
+    def test_mutate(self):
+        crushmap = self.build_crushmap()
+        crushmap['trees'][0]['children'].append({
+            "type": "rack", "name": "rack0", "weight": 0x10000,
+            "children": [{"type": "host", "name": "host10", "children": [
+                {"id": 20, "name": "device20", "weight": 0x10000}]}],
+        })
+        crushmap['choose_args'] = {"one": [
+            {"bucket_name": "host0", "ids": [100, 101], "weight_set": [[1, 3]]},
+        ]}
+        c = Crush()
+        assert c.parse(crushmap)
+
+        def same():
+            d = Crush()
+            assert d.parse(copy.deepcopy(c.get_crushmap()))
+            for choose_args in (None, "one"):
+                assert (c.map_batch("data", range(200), 2, choose_args=choose_args) ==
+                        d.map_batch("data", range(200), 2, choose_args=choose_args)).all()
+
+        assert c.adjust_item_weight("host1", "device02", 5)
+        assert c.get_item_by_name("device02")["weight"] == 5
+        same()
+        assert c.add_item("host0", {"id": 21, "name": "device21", "weight": 4})
+        assert c.get_crushmap()["choose_args"]["one"][0] == {
+            "bucket_name": "host0", "ids": [100, 101, 21], "weight_set": [[1, 3, 4]]}
+        same()
+        assert c.add_item("host10", {"id": 22, "name": "device22"})
+        assert c.remove_item("host0", "device00")
+        assert c.get_crushmap()["choose_args"]["one"][0] == {
+            "bucket_name": "host0", "ids": [101, 21], "weight_set": [[3, 4]]}
+        same()
+        # the weight of rack0 is explicit and does not change
+        assert c.remove_item("host10", "device20")
+        same()
+        assert c.update_choose_args_weight_set("one", {"bucket_name": "host0",
+                                                       "weight_set": [[5, 0]]})
+        assert c.get_crushmap()["choose_args"]["one"][0]["weight_set"] == [[5, 0]]
+        same()
+        # a name read from JSON is unicode on python 2
+        assert c.update_choose_args_weight_set(u"one", {"bucket_name": "host0",
+                                                        "weight_set": [[6, 0]]})
+        assert c.get_crushmap()["choose_args"]["one"][0]["weight_set"] == [[6, 0]]
+        same()
+
+    def test_pickle(self):
+        crushmap = self.build_crushmap()
+        crushmap['choose_args'] = {"one": [
+            {"bucket_name": "host0", "weight_set": [[1, 3]]},
+        ]}
+        c = Crush()
+        assert c.parse(crushmap)
+        d = pickle.loads(pickle.dumps(c))
+        assert d.get_crushmap() == c.get_crushmap()
+        assert d.get_item_by_name("device03")["id"] == 3
+        for choose_args in (None, "one"):
+            assert (c.map_batch("data", range(200), 2, choose_args=choose_args) ==
+                    d.map_batch("data", range(200), 2, choose_args=choose_args)).all()
+        assert c.map("data", 1, 2) == d.map("data", 1, 2)
+
+    def test_compile_straw2_cache(self):
+        crushmap = self.build_crushmap()
+        c = Crush()
+        assert c.parse(crushmap)
+        values = np.arange(1000, dtype=np.int32)
+        cache = c.compile_straw2_cache(values, 2)
+        for weights in (None, {"device00": 0.0, "device03": 0.5}):
+            assert (c.map_batch("data", values, 2, weights, straw2_cache=cache) ==
+                    c.map_batch("data", values, 2, weights)).all()
+        assert c.straw2_cache_info(cache)["buckets"] == [-1]
+
+    def test_map_record(self):
+        crushmap = self.build_crushmap()
+        c = Crush()
+        assert c.parse(crushmap)
+        values = np.arange(1000, dtype=np.int32)
+        mapping = c.map_record("data", values, 2)
+        assert (c.mapping_results(mapping) == c.map_batch("data", values, 2)).all()
+        weights = {"device00": 0.0, "device03": 0.5}
+        mapping = c.remap(mapping, [0, 3], c.compile_weights(weights))
+        assert (c.mapping_results(mapping) == c.map_batch("data", values, 2, weights)).all()
+        (devices, buckets, failed) = c.mapping_histogram(mapping)
+        assert devices[0] == 0 and failed == 0
+        assert c.mapping_info(mapping)["remapped"] < 1000
+
+    def test_map_batch_stats(self):
+        crushmap = self.build_crushmap()
+        c = Crush()
+        assert c.parse(crushmap)
+        values = np.arange(1000, dtype=np.int32)
+        stats = {}
+        c.histogram("data", values, 2, {"device00": 0.0}, stats=stats)
+        assert stats["rejects"] > 0
+        assert stats["choose_tries"].dtype == np.int64
+        assert stats["choose_tries"].sum() == 1000 * 2 * 2
+        assert len(stats["bucket_collisions"]) == 11
+
     def test_get_item_by_(self):
         crushmap = self.build_crushmap()
         c = Crush(verbose=1)
@@ -162,6 +369,40 @@ class TestCrush(object):
         assert 6 == len(optimize[1]['weight_set'][0])
         assert c.find_bucket(name) is None
 
+    def test_parse_copy(self):
+        crushmap = self.build_crushmap()
+        del crushmap['trees'][0]['id']
+        c = Crush()
+        assert c.parse(crushmap)
+        assert c.get_crushmap() is not crushmap
+        assert 'id' not in crushmap['trees'][0]
+        assert c.parse(crushmap, copy_crushmap=False)
+        assert c.get_crushmap() is crushmap
+        # the bucket id is set in the crushmap owned by c
+        assert crushmap['trees'][0]['id'] == -1
+        c.parse('tests/test_crush_filter.json')
+        crushmap = c.get_crushmap()
+        assert c.parse(crushmap, copy_crushmap=False)
+        assert c.get_crushmap() is crushmap
+
+    def test_copy_buckets(self):
+        name = 'cloud6-1429'
+        c = Crush()
+        c.parse('tests/test_crush_filter.json')
+        crushmap = c.get_crushmap()
+        expected = copy.deepcopy(crushmap)
+        f = Crush()
+        f.crushmap = Crush.copy_buckets(crushmap)
+        f.filter(lambda x: x.get('name') != name, f.crushmap['trees'][0])
+        assert f.parse(f.crushmap, copy_crushmap=False)
+        assert f.find_bucket(name) is None
+        # the crushmap is not modified and the copy is filtered as a deep copy would be
+        assert crushmap == expected
+        d = Crush()
+        d.crushmap = copy.deepcopy(crushmap)
+        d.filter(lambda x: x.get('name') != name, d.crushmap['trees'][0])
+        assert f.get_crushmap() == d.get_crushmap()
+
     def test_filter_basic(self):
         root = {
             'name': 'root',
@@ -232,6 +473,84 @@ class TestCrush(object):
         expected = [{'name': 'host0', 'type': 'host'}, {'name': 'host1', 'type': 'host'}]
         assert expected == Crush.collect_buckets_by_type(children, 'host')
 
+    def test_find_buckets_by_type(self):
+        c = Crush()
+        c.parse('tests/test_crush_filter.json')
+        crushmap = c.get_crushmap()
+        for type in ('root', 'host', 'unknown'):
+            assert (Crush.collect_buckets_by_type(crushmap['trees'], type) ==
+                    c.find_buckets_by_type(type))
+            for root in c.find_buckets_by_type('root') + c.find_buckets_by_type('host'):
+                assert (Crush.collect_buckets_by_type([root], type) ==
+                        c.find_buckets_by_type(type, root))
+        root = c.find_buckets_by_type('root')[0]
+        host = c.find_buckets_by_type('host', root)[1]
+        assert c.find_bucket(host['name']) is host
+        assert c.get_item_by_id(host['id']) is host
+        # update_choose_args does not change the trees
+        c.update_choose_args('other', [{'bucket_id': host['id'], 'ids': [1]}])
+        assert c.find_bucket(host['name']) is host
+        # filter invalidates the indexes
+        c.filter(lambda x: x.get('name') != host['name'], root)
+        assert c.find_bucket(host['name']) is None
+        assert host not in c.find_buckets_by_type('host')
+        assert host not in c.find_buckets_by_type('host', root)
+        # and so does a new crushmap
+        c.crushmap = self.build_crushmap()
+        assert ['host%d' % i for i in range(10)] == [
+            b['name'] for b in c.find_buckets_by_type('host', c.find_bucket('dc1'))]
+        # a bucket without children
+        c = Crush()
+        c.parse({
+            "trees": [
+                {"type": "root", "name": "dc1", "id": -1, "children": [
+                    {"type": "host", "name": "h1", "id": -2, "children": [
+                        {"name": "device0", "id": 0, "weight": 1},
+                    ]},
+                    {"type": "host", "name": "h2", "id": -3},
+                ]},
+            ],
+        })
+        h2 = c.find_bucket("h2")
+        assert [h2] == Crush.collect_buckets_by_type([h2], "host")
+        assert [h2] == c.find_buckets_by_type("host", h2)
+        assert [] == c.find_buckets_by_type("root", h2)
+        assert ['h1', 'h2'] == [
+            b['name'] for b in c.find_buckets_by_type("host", c.find_bucket("dc1"))]
+        # a copy of a bucket designates the same bucket
+        assert ['h1', 'h2'] == [
+            b['name'] for b in c.find_buckets_by_type("host", copy.deepcopy(c.find_bucket("dc1")))]
+        # a device has no descendants
+        assert [] == c.find_buckets_by_type("host", c.find_bucket("device0"))
+        # an item found more than once
+        c = Crush()
+        c.parse({
+            "trees": [
+                {"type": "root", "name": "dc1", "id": -1, "children": [
+                    {"type": "host", "name": "h%d" % h, "id": -2 - h, "children": [
+                        {"name": "device0", "id": 0, "weight": 1 + h},
+                    ]} for h in range(2)
+                ]},
+            ],
+        })
+        assert c.get_item_by_name("device0")["weight"] == 2
+        assert c.get_item_by_id(0)["weight"] == 2
+        assert c.find_bucket("device0")["weight"] == 1
+        # buckets without ids
+        c = Crush()
+        c.parse({
+            "trees": [
+                {"type": "root", "name": "dc1", "children": [
+                    {"type": "host", "name": "h%d" % h, "children": [
+                        {"name": "device%d" % h, "id": h, "weight": 1},
+                    ]} for h in range(2)
+                ]},
+            ],
+        })
+        assert ['h0', 'h1'] == [
+            b['name'] for b in c.find_buckets_by_type("host", c.find_bucket("dc1"))]
+        assert [c.find_bucket("h1")] == c.find_buckets_by_type("host", c.find_bucket("h1"))
+
     def test_update_choose_args(self):
         c = Crush()
         c.crushmap = {}
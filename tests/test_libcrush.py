@@ -17,9 +17,14 @@
 # You should have received a copy of the GNU General Public License
 # along with this program.  If not, see <http://www.gnu.org/licenses/>.
 #
+import array
+import os
+import pickle
 import pytest
+import random
+import timeit
 
-from crush.libcrush import LibCrush
+from crush.libcrush import LibCrush, ITEM_NONE
 
 STEP_BACKWARDS = [
     "choose_local_tries",
@@ -152,6 +157,17 @@ class TestLibCrush(object):
         out, err = capsys.readouterr()
         assert 'trees' not in out
 
+        # the trace is shown when parse fails, verbose or not
+        wrong = {
+            'trees': [{"type": "root", "name": "dc1", "id": -1, "children": [1]}],
+        }
+        for verbose in (0, 1):
+            with pytest.raises(RuntimeError):
+                LibCrush(verbose=verbose).parse(wrong)
+            out, err = capsys.readouterr()
+            assert out.count('bucket content') == 1
+            assert out.endswith('error must be a dict\n')
+
     def test_parse_empty(self):
         LibCrush().parse({})
 
@@ -1069,6 +1085,1131 @@ class TestLibCrush(object):
                   replication_count=1)
         assert 'unable to map' in str(e.value)
 
+    def test_map_batch(self):
+        crushmap = {
+            "trees": [
+                {
+                    "type": "root",
+                    "id": -1,
+                    "name": "dc1",
+                    "children": [],
+                }
+            ],
+            "rules": {
+                "data": [
+                    ["take", "dc1"],
+                    ["chooseleaf", "firstn", 0, "type", "host"],
+                    ["emit"]
+                ],
+            }
+        }
+        crushmap['trees'][0]['children'].extend([
+            {
+                "type": "host",
+                "id": -(i + 2),
+                "name": "host%d" % i,
+                "children": [
+                    {"id": (2 * i), "name": "device%02d" % (2 * i), "weight": 1 * 0x10000},
+                    {"id": (2 * i + 1), "name": "device%02d" % (2 * i + 1), "weight": 2 * 0x10000},
+                ],
+            } for i in range(0, 10)
+        ])
+        crushmap['choose_args'] = {
+            "1": [
+                {
+                    "bucket_name": "host9",
+                    "weight_set": [[2 * 0x10000, 1 * 0x10000]]
+                },
+            ]
+        }
+        c = LibCrush(verbose=1)
+        assert c.parse(crushmap)
+        weights = {"device03": 0.5}
+
+        def expected(values, choose_args=None):
+            kwargs = {}
+            if choose_args:
+                kwargs["choose_args"] = choose_args
+            result = []
+            for value in values:
+                mapped = c.map(rule="data", value=value, replication_count=2,
+                               weights=weights, **kwargs)
+                result.extend([int(name[6:]) for name in mapped])
+            return result
+
+        def actual(values, choose_args=None):
+            kwargs = {}
+            if choose_args:
+                kwargs["choose_args"] = choose_args
+            mapped = c.map_batch(rule="data", values=values, replication_count=2,
+                                 weights=weights, **kwargs)
+            assert len(bytes(mapped)) == len(values) * 2 * 4
+            return list(array.array('i', bytes(mapped)))
+
+        assert actual(range(1234, 1334)) == expected(range(1234, 1334))
+        assert actual([1, 5, 1234]) == expected([1, 5, 1234])
+        assert actual(array.array('i', [1234, 5])) == expected([1234, 5])
+        assert actual(range(100), "1") == expected(range(100), "1")
+        assert actual(range(100), crushmap['choose_args']["1"]) == expected(range(100), "1")
+        assert actual([]) == []
+
+        values = range(1000)
+        mapped = c.map_batch(rule="data", values=values, replication_count=2,
+                             weights=weights, choose_args="1")
+        for threads in (2, 7, 2000):
+            assert bytes(c.map_batch(rule="data", values=values, replication_count=2,
+                                     weights=weights, choose_args="1",
+                                     threads=threads)) == bytes(mapped)
+
+    def test_map_batch_bad(self):
+        crushmap = {
+            "trees": [
+                {
+                    "type": "root",
+                    "name": "dc1",
+                    "id": -1,
+                    "children": [{"id": 0, "name": "device0"}],
+                }
+            ],
+            "rules": {
+                "indep": [
+                    ["take", "dc1"],
+                    ["chooseleaf", "indep", 0, "type", 0],
+                    ["emit"]
+                ]
+            }
+        }
+        with pytest.raises(RuntimeError) as e:
+            LibCrush().map_batch(rule="indep", values=[1], replication_count=2)
+        assert 'call parse()' in str(e.value)
+        c = LibCrush()
+        assert c.parse(crushmap)
+        mapped = c.map_batch(rule="indep", values=[1234], replication_count=2)
+        assert list(array.array('i', bytes(mapped))) == [0, ITEM_NONE]
+        with pytest.raises(RuntimeError) as e:
+            c.map_batch(rule="norule", values=[1], replication_count=1)
+        assert 'norule is not found' in str(e.value)
+        with pytest.raises(RuntimeError) as e:
+            c.map_batch(rule="indep", values=[1], replication_count=0)
+        assert 'must be >= 1' in str(e.value)
+        with pytest.raises(RuntimeError) as e:
+            c.map_batch(rule="indep", values=[1], replication_count=1, threads=0)
+        assert 'threads 0 must be >= 1' in str(e.value)
+        with pytest.raises(RuntimeError) as e:
+            c.map_batch(rule="indep", values=array.array('d', [1.0]), replication_count=1)
+        assert 'must contain int32' in str(e.value)
+        with pytest.raises(TypeError):
+            c.map_batch(rule="indep", values=1, replication_count=1)
+        with pytest.raises(TypeError):
+            c.map_batch(rule="indep", values=["abc"], replication_count=1)
+        # the workspace of the threads does not fit on their stack
+        mapped = c.map_batch(rule="indep", values=[1, 2], replication_count=100000, threads=2)
+        assert len(array.array('i', bytes(mapped))) == 200000
+        (devices, buckets, failed) = c.histogram(rule="indep", values=[1, 2],
+                                                 replication_count=100000, threads=2)
+        assert failed == 2
+
+    def test_histogram(self):
+        crushmap = {
+            "trees": [
+                {
+                    "type": "root",
+                    "id": -1,
+                    "name": "dc1",
+                    "children": [
+                        {
+                            "type": "host",
+                            "id": -(i + 2),
+                            "name": "host%d" % i,
+                            "children": [
+                                {"id": 2 * i, "name": "device%d" % (2 * i), "weight": 0x10000},
+                                {"id": 2 * i + 1, "name": "device%d" % (2 * i + 1),
+                                 "weight": 0x10000},
+                            ],
+                        } for i in range(3)
+                    ],
+                }
+            ],
+            "rules": {
+                "data": [
+                    ["take", "dc1"],
+                    ["chooseleaf", "indep", 0, "type", "host"],
+                    ["emit"]
+                ],
+                "hosts": [
+                    ["take", "dc1"],
+                    ["choose", "firstn", 0, "type", "host"],
+                    ["emit"]
+                ],
+            }
+        }
+        c = LibCrush()
+        with pytest.raises(RuntimeError) as e:
+            c.histogram(rule="data", values=[1], replication_count=1)
+        assert 'call parse() before histogram()' in str(e.value)
+        assert c.parse(crushmap)
+
+        def expected(rule, replication_count):
+            mapped = array.array('i', bytes(c.map_batch(rule=rule, values=range(1000),
+                                                        replication_count=replication_count)))
+            devices = [0] * 6
+            buckets = [0] * 4
+            failed = 0
+            for i in range(0, len(mapped), replication_count):
+                row = mapped[i:i + replication_count]
+                if ITEM_NONE in row:
+                    failed += 1
+                for id in row:
+                    if id == ITEM_NONE:
+                        continue
+                    if id >= 0:
+                        devices[id] += 1
+                        buckets[-1 - (-2 - id // 2)] += 1
+                        buckets[0] += 1
+                    else:
+                        buckets[-1 - id] += 1
+                        buckets[0] += 1
+            return (devices, buckets, failed)
+
+        for (rule, replication_count) in (("data", 2), ("data", 4), ("hosts", 2)):
+            for threads in (1, 3):
+                (devices, buckets, failed) = c.histogram(rule=rule, values=range(1000),
+                                                         replication_count=replication_count,
+                                                         threads=threads)
+                assert (list(array.array('q', bytes(devices))),
+                        list(array.array('q', bytes(buckets))),
+                        failed) == expected(rule, replication_count)
+        (devices, buckets, failed) = c.histogram(rule="data", values=range(1000),
+                                                 replication_count=4)
+        assert failed == 1000
+        (devices, buckets, failed) = c.histogram(rule="data", values=[],
+                                                 replication_count=2)
+        assert list(array.array('q', bytes(buckets))) == [0] * 4
+        assert failed == 0
+
+    def test_movement(self):
+        c = LibCrush()
+        origin = array.array('i', [
+            1, 2, 3,
+            1, 2, 3,
+            4, 5, 6,
+            1, 2, 3,
+        ])
+        destination = array.array('i', [
+            1, 2, 3,
+            1, 3, 2,
+            7, 5, 8,
+            9, 2, ITEM_NONE,
+        ])
+
+        def movement(order_matters):
+            (moved_from, moved_to, count) = c.movement(origin, destination, 3, order_matters)
+            return list(zip(array.array('i', bytes(moved_from)),
+                            array.array('i', bytes(moved_to)),
+                            array.array('q', bytes(count))))
+
+        assert movement(True) == [(1, 9, 1), (2, 3, 1), (3, 2, 1), (3, ITEM_NONE, 1),
+                                  (4, 7, 1), (6, 8, 1)]
+        assert movement(False) == [(1, 9, 1), (3, ITEM_NONE, 1), (4, 7, 1), (6, 8, 1)]
+        (moved_from, moved_to, count) = c.movement(range(3000), range(3000), 3)
+        assert len(bytes(count)) == 0
+        # more pairs than the initial size of the table
+        (moved_from, moved_to, count) = c.movement(range(3000), range(1, 3001), 1)
+        assert list(array.array('i', bytes(moved_from))) == list(range(3000))
+        assert list(array.array('q', bytes(count))) == [1] * 3000
+        with pytest.raises(RuntimeError) as e:
+            c.movement([1, 2], [1], 1)
+        assert 'must have the same size' in str(e.value)
+        with pytest.raises(RuntimeError) as e:
+            c.movement([1, 2], [1, 2], 3)
+        assert 'multiple of replication_count 3' in str(e.value)
+
+    def test_map_ids(self):
+        crushmap = {
+            "trees": [
+                {
+                    "type": "root",
+                    "id": -1,
+                    "name": "dc1",
+                    "children": [
+                        {"id": i, "name": "device%d" % i, "weight": 0x10000} for i in range(5)
+                    ],
+                }
+            ],
+            "rules": {
+                "indep": [["take", "dc1"], ["choose", "indep", 0, "type", 0], ["emit"]],
+            }
+        }
+        c = LibCrush()
+        with pytest.raises(RuntimeError) as e:
+            c.items_table()
+        assert 'call parse()' in str(e.value)
+        assert c.parse(crushmap)
+        (ids, names) = c.items_table()
+        assert list(array.array('i', bytes(ids))) == [-1, 0, 1, 2, 3, 4]
+        assert names == ["dc1", "device0", "device1", "device2", "device3", "device4"]
+        for value in range(100):
+            mapped = c.map(rule="indep", value=value, replication_count=6)
+            mapped_ids = c.map(rule="indep", value=value, replication_count=6, ids=True)
+            assert ITEM_NONE in mapped_ids
+            assert [None if i == ITEM_NONE else "device%d" % i for i in mapped_ids] == mapped
+
+    def test_compile_weights(self):
+        crushmap = {
+            "trees": [
+                {
+                    "type": "root",
+                    "id": -1,
+                    "name": "dc1",
+                    "children": [
+                        {"id": i, "name": "device%d" % i, "weight": 0x10000} for i in range(10)
+                    ],
+                }
+            ],
+            "rules": {
+                "data": [["take", "dc1"], ["choose", "firstn", 0, "type", 0], ["emit"]],
+            }
+        }
+        c = LibCrush()
+        with pytest.raises(RuntimeError) as e:
+            c.compile_weights({})
+        assert 'call parse()' in str(e.value)
+        assert c.parse(crushmap)
+        weights = {"device1": 0.0, "device3": 0.5}
+
+        def same(compiled):
+            for value in range(200):
+                assert (c.map(rule="data", value=value, replication_count=2, weights=weights) ==
+                        c.map(rule="data", value=value, replication_count=2, weights=compiled))
+            assert (bytes(c.map_batch(rule="data", values=range(200), replication_count=2,
+                                      weights=weights)) ==
+                    bytes(c.map_batch(rule="data", values=range(200), replication_count=2,
+                                      weights=compiled)))
+
+        compiled = c.compile_weights(weights)
+        same(compiled)
+        same(c.compile_weights(array.array('d', [1.0, 0.0, 1.0, 0.5])))
+        same(c.compile_weights(array.array('f', [1.0, 0.0, 1.0, 0.5, 1.0])))
+
+        with pytest.raises(RuntimeError) as e:
+            c.compile_weights({"nodevice": 1.0})
+        assert 'nodevice is not a known device' in str(e.value)
+        with pytest.raises(RuntimeError) as e:
+            c.compile_weights(array.array('i', [1]))
+        assert 'float32 or float64' in str(e.value)
+        with pytest.raises(RuntimeError) as e:
+            c.compile_weights(array.array('d', [1.0] * 11))
+        assert 'more than the 10 devices' in str(e.value)
+        with pytest.raises(TypeError):
+            c.compile_weights(1)
+        with pytest.raises(TypeError) as e:
+            c.map(rule="data", value=1, replication_count=1, weights=[])
+        assert 'compile_weights' in str(e.value)
+
+        other = LibCrush()
+        assert other.parse(crushmap)
+        with pytest.raises(RuntimeError) as e:
+            other.map(rule="data", value=1, replication_count=1, weights=compiled)
+        assert 'compiled for another map' in str(e.value)
+        assert c.parse(crushmap)
+        with pytest.raises(RuntimeError) as e:
+            c.map_batch(rule="data", values=[1], replication_count=1, weights=compiled)
+        assert 'compiled for another map' in str(e.value)
+
+    def test_compile_choose_args(self):
+        crushmap = {
+            "trees": [
+                {
+                    "type": "root",
+                    "id": -1,
+                    "name": "dc1",
+                    "children": [
+                        {
+                            "type": "host",
+                            "id": -(i + 2),
+                            "name": "host%d" % i,
+                            "children": [
+                                {"id": 2 * i, "name": "device%d" % (2 * i), "weight": 0x10000},
+                                {"id": 2 * i + 1, "name": "device%d" % (2 * i + 1),
+                                 "weight": 0x10000},
+                            ],
+                        } for i in range(5)
+                    ],
+                }
+            ],
+            "rules": {
+                "data": [
+                    ["take", "dc1"],
+                    ["chooseleaf", "firstn", 0, "type", "host"],
+                    ["emit"]
+                ],
+            }
+        }
+        choose_args = [
+            {"bucket_name": "host0", "weight_set": [[0x10000, 0x30000], [0x30000, 0x10000]]},
+            {"bucket_id": -3, "ids": [100, 200]},
+            {"bucket_name": "host2", "weight_set": [[0x10000, 0]]},
+        ]
+        c = LibCrush()
+        with pytest.raises(RuntimeError) as e:
+            c.compile_choose_args(choose_args)
+        assert 'call parse()' in str(e.value)
+        assert c.parse(crushmap)
+        compiled = c.compile_choose_args(choose_args)
+
+        def same(choose_args, compiled):
+            for value in range(200):
+                assert (c.map(rule="data", value=value, replication_count=2,
+                              choose_args=choose_args) ==
+                        c.map(rule="data", value=value, replication_count=2,
+                              choose_args=compiled))
+            assert (bytes(c.map_batch(rule="data", values=range(200), replication_count=2,
+                                      choose_args=choose_args)) ==
+                    bytes(c.map_batch(rule="data", values=range(200), replication_count=2,
+                                      choose_args=compiled, threads=2)))
+
+        same(choose_args, compiled)
+
+        bucket = {"bucket_name": "host2", "weight_set": [[0, 0x10000], [0x20000, 0x10000]]}
+        assert c.update_choose_args_weight_set(compiled, bucket)
+        choose_args[2] = bucket
+        same(choose_args, compiled)
+
+        bucket = {"bucket_id": -3, "ids": [100, 200], "weight_set": [[0x10000, 0x50000]]}
+        assert c.update_choose_args_weight_set(compiled, {"bucket_name": "host1",
+                                                          "weight_set": bucket["weight_set"]})
+        choose_args[1] = bucket
+        same(choose_args, compiled)
+
+        with pytest.raises(RuntimeError) as e:
+            c.update_choose_args_weight_set(compiled, {"bucket_name": "host3",
+                                                       "weight_set": [[1, 1]]})
+        assert 'is not in the compiled choose_args' in str(e.value)
+        with pytest.raises(RuntimeError) as e:
+            c.update_choose_args_weight_set(compiled, {"bucket_name": "host0",
+                                                       "weight_set": [[1, 1]] * 3})
+        assert 'between 1 and 2 positions' in str(e.value)
+        with pytest.raises(RuntimeError) as e:
+            c.update_choose_args_weight_set(compiled, {"bucket_name": "host0",
+                                                       "weight_set": [[1, 1], [1, 1, 1]]})
+        assert 'expected a list of weights with 2 elements' in str(e.value)
+        # the failed updates did not modify the compiled choose_args
+        same(choose_args, compiled)
+        with pytest.raises(TypeError):
+            c.update_choose_args_weight_set(choose_args, bucket)
+
+        assert c.parse(crushmap)
+        with pytest.raises(RuntimeError) as e:
+            c.map(rule="data", value=1, replication_count=1, choose_args=compiled)
+        assert 'compiled for another map' in str(e.value)
+
+    def test_mutate(self):
+        def crushmap():
+            return {
+                "trees": [{
+                    "type": "root",
+                    "id": -1,
+                    "name": "dc1",
+                    "children": [{
+                        "type": "host",
+                        "id": -2 - h,
+                        "name": "host%d" % h,
+                        "children": [
+                            {"id": h * 3 + i, "name": "device%d" % (h * 3 + i), "weight": 0x10000}
+                            for i in range(3)
+                        ],
+                    } for h in range(4)],
+                }],
+                "rules": {
+                    "data": [["take", "dc1"], ["chooseleaf", "firstn", 0, "type", "host"],
+                             ["emit"]],
+                },
+                "choose_args": {
+                    "one": [{"bucket_id": -2, "weight_set": [[0x10000, 0x20000, 0x10000]]}],
+                },
+            }
+
+        def same(c, m):
+            p = LibCrush()
+            assert p.parse(m)
+            for kwargs in ({}, {"choose_args": "one"}):
+                assert (bytes(c.map_batch(rule="data", values=range(1000), replication_count=3,
+                                          **kwargs)) ==
+                        bytes(p.map_batch(rule="data", values=range(1000), replication_count=3,
+                                          **kwargs)))
+
+        c = LibCrush()
+        with pytest.raises(RuntimeError) as e:
+            c.adjust_item_weight("host0", "device0", 0x10000)
+        assert 'call parse()' in str(e.value)
+        m = crushmap()
+        assert c.parse(m)
+        weights = c.compile_weights({"device1": 0.5})
+
+        # the weight of the host in the root is not updated
+        assert c.adjust_item_weight("host1", "device3", 0x30000) == 0x50000
+        assert c.adjust_item_weight("dc1", -3, 0x50000) == 0xe0000
+        m["trees"][0]["children"][1]["children"][0]["weight"] = 0x30000
+        same(c, m)
+        # the size of the buckets did not change
+        c.map(rule="data", value=1, replication_count=1, weights=weights)
+
+        with pytest.raises(RuntimeError) as e:
+            c.add_item("host0", 12, 0x10000, name="device12")
+        assert 'the updated choose_args are required' in str(e.value)
+        m["trees"][0]["children"][0]["children"].append(
+            {"id": 12, "name": "device12", "weight": 0x20000})
+        m["choose_args"]["one"][0]["weight_set"][0].append(0x20000)
+        assert c.add_item("host0", 12, 0x20000, name="device12",
+                          choose_args=m["choose_args"]) == 0x50000
+        assert c.adjust_item_weight("dc1", "host0", 0x50000) == 0x100000
+        same(c, m)
+        assert any("device12" in c.map(rule="data", value=value, replication_count=3)
+                   for value in range(100))
+        with pytest.raises(RuntimeError) as e:
+            c.map(rule="data", value=1, replication_count=1, weights=weights)
+        assert 'compiled for another map' in str(e.value)
+
+        for device in ("device9", "device10", "device11"):
+            c.remove_item("host3", device)
+        assert c.adjust_item_weight("dc1", "host3", 0) == 0xd0000
+        for device in m["trees"][0]["children"][3]["children"]:
+            device["weight"] = 0
+        same(c, m)
+
+        with pytest.raises(RuntimeError) as e:
+            c.add_item("host0", "device1", 0x10000)
+        assert 'already in bucket' in str(e.value)
+        with pytest.raises(RuntimeError) as e:
+            c.add_item("host0", 13, 0x10000, choose_args=m["choose_args"])
+        assert 'needs a name' in str(e.value)
+        with pytest.raises(RuntimeError) as e:
+            c.add_item("host0", "dc1", 0x10000, choose_args=m["choose_args"])
+        assert 'cannot contain it' in str(e.value)
+        with pytest.raises(RuntimeError) as e:
+            c.remove_item("host0", "device3")
+        assert 'is not in bucket' in str(e.value)
+        with pytest.raises(RuntimeError) as e:
+            c.adjust_item_weight("device0", "device1", 0x10000)
+        assert 'no bucket with id 0' in str(e.value)
+        with pytest.raises(RuntimeError) as e:
+            c.adjust_item_weight("host0", "unknown", 0x10000)
+        assert 'is not a known item' in str(e.value)
+
+        # invalid choose_args leave the map as it was
+        bad = {"one": [{"bucket_id": -2, "weight_set": [[0x10000]]}]}
+        with pytest.raises(RuntimeError):
+            c.add_item("host0", 100, 0x10000, name="device100", choose_args=bad)
+        same(c, m)
+        with pytest.raises(RuntimeError) as e:
+            c.add_item("host1", "device100", 0x10000)
+        assert 'is not a known item' in str(e.value)
+        with pytest.raises(RuntimeError):
+            c.remove_item("host0", "device0", choose_args=bad)
+        same(c, m)
+
+        bucket = {"bucket_id": -2, "weight_set": [[0x10000, 0x10000, 0x10000, 0x50000]]}
+        assert c.update_choose_args_weight_set("one", bucket)
+        m["choose_args"]["one"][0]["weight_set"] = bucket["weight_set"]
+        same(c, m)
+        with pytest.raises(RuntimeError) as e:
+            c.update_choose_args_weight_set("one", {"bucket_id": -3, "weight_set": [[1, 1, 1]]})
+        assert 'is not in the choose_args one' in str(e.value)
+        with pytest.raises(RuntimeError) as e:
+            c.update_choose_args_weight_set("two", bucket)
+        assert 'two is not found' in str(e.value)
+
+    def test_encode(self):
+        crushmap = {
+            "trees": [{
+                "type": "root",
+                "id": -1,
+                "name": "dc1",
+                "children": [{
+                    "type": "host",
+                    "id": -2 - h,
+                    "name": "host%d" % h,
+                    "algorithm": algorithm,
+                    "children": [
+                        {"id": h * 3 + i, "name": "device%d" % (h * 3 + i),
+                         "weight": 0x10000 * (i + 1)}
+                        for i in range(3)
+                    ],
+                } for (h, algorithm) in enumerate(["straw", "list", "straw2"])],
+            }],
+            "rules": {
+                "data": [["take", "dc1"], ["chooseleaf", "firstn", 0, "type", "host"],
+                         ["emit"]],
+                "one": [["set_choose_tries", 3], ["take", "host1"],
+                        ["choose", "indep", 1, "type", 0], ["emit"]],
+            },
+            "tunables": {
+                "straw_calc_version": 0,
+                "choose_total_tries": 20,
+            },
+            "choose_args": {
+                "two": [
+                    {"bucket_id": -4, "weight_set": [[1, 2, 3], [3, 2, 1]]},
+                    {"bucket_id": -1, "ids": [-10, -20, -30]},
+                ],
+                3: [],
+            },
+        }
+
+        c = LibCrush(backward_compatibility=1)
+        with pytest.raises(RuntimeError) as e:
+            c.encode()
+        assert 'call parse()' in str(e.value)
+        assert c.parse(crushmap)
+        # the straws of the modified bucket are not those of a newly parsed one
+        c.adjust_item_weight("host0", "device1", 0x40000)
+
+        d = pickle.loads(pickle.dumps(c))
+        assert d.encode() == c.encode()
+        for rule in ("data", "one"):
+            for kwargs in ({}, {"choose_args": "two"}):
+                assert (bytes(c.map_batch(rule=rule, values=range(1000), replication_count=3,
+                                          **kwargs)) ==
+                        bytes(d.map_batch(rule=rule, values=range(1000), replication_count=3,
+                                          **kwargs)))
+        assert d.map(rule="data", value=1, replication_count=1) == \
+            c.map(rule="data", value=1, replication_count=1)
+        assert d.items_table() == c.items_table()
+        assert d.add_item("host0", 9, 0x10000, name="device9")
+
+        encoded = c.encode()
+        with pytest.raises(RuntimeError) as e:
+            d.decode(encoded[:-1])
+        assert 'truncated' in str(e.value)
+        with pytest.raises(RuntimeError) as e:
+            d.map(rule="data", value=1, replication_count=1)
+        assert 'call parse()' in str(e.value)
+        with pytest.raises(RuntimeError) as e:
+            d.decode(b'x' + encoded)
+        assert 'same byte order' in str(e.value)
+        with pytest.raises(TypeError):
+            d.decode(u'string')
+
+        assert pickle.loads(pickle.dumps(LibCrush())).decode(encoded)
+
+    def test_prepare(self):
+        crushmap = {
+            "trees": [
+                {
+                    "type": "root",
+                    "id": -1,
+                    "name": "dc1",
+                    "children": [
+                        {
+                            "type": "host",
+                            "id": -(i + 2),
+                            "name": "host%d" % i,
+                            "children": [
+                                {"id": 2 * i, "name": "device%d" % (2 * i), "weight": 0x10000},
+                                {"id": 2 * i + 1, "name": "device%d" % (2 * i + 1),
+                                 "weight": 0x10000},
+                            ],
+                        } for i in range(5)
+                    ],
+                }
+            ],
+            "rules": {
+                "data": [
+                    ["take", "dc1"],
+                    ["chooseleaf", "firstn", 0, "type", "host"],
+                    ["emit"]
+                ],
+            }
+        }
+        choose_args = [
+            {"bucket_name": "host0", "weight_set": [[0x10000, 0x30000]]},
+            {"bucket_id": -3, "ids": [100, 200]},
+        ]
+        weights = {"device3": 0.0, "device4": 0.5}
+        c = LibCrush()
+        with pytest.raises(RuntimeError) as e:
+            c.prepare(rule="data", replication_count=2)
+        assert 'call parse()' in str(e.value)
+        assert c.parse(crushmap)
+        with pytest.raises(RuntimeError) as e:
+            c.prepare(rule="data", replication_count=0)
+        assert 'must be >= 1' in str(e.value)
+        with pytest.raises(RuntimeError) as e:
+            c.prepare(rule="unknown", replication_count=2)
+        assert 'not found' in str(e.value)
+
+        for kwargs in ({},
+                       {"weights": weights},
+                       {"weights": c.compile_weights(weights)},
+                       {"choose_args": choose_args},
+                       {"choose_args": c.compile_choose_args(choose_args)},
+                       {"ids": 1}):
+            mapper = c.prepare(rule="data", replication_count=2, **kwargs)
+            for value in range(200):
+                assert mapper(value) == c.map(rule="data", value=value, replication_count=2,
+                                              **kwargs)
+
+        mapper = c.prepare(rule="data", replication_count=2)
+        with pytest.raises(TypeError):
+            mapper()
+        with pytest.raises(TypeError):
+            mapper(1, 2)
+        assert c.parse(crushmap)
+        with pytest.raises(RuntimeError) as e:
+            mapper(1)
+        assert 'call prepare() again' in str(e.value)
+
+    def test_check_reciprocals(self):
+        c = LibCrush()
+        edge = ([1, 2, 3, 0xffff, 0x10000, 0x10001, 0xffffffff] +
+                [1 << k for k in range(32)] +
+                [(1 << k) - 1 for k in range(2, 33)] +
+                [(1 << k) + 1 for k in range(1, 32)])
+        assert c.check_reciprocals(edge) == 0
+        r = random.Random(1)
+        assert c.check_reciprocals([r.randint(1, 0xffffffff) for _ in range(200)]) == 0
+        assert c.check_reciprocals([r.randint(1, 0x1000000) for _ in range(200)]) == 0
+        with pytest.raises(RuntimeError) as e:
+            c.check_reciprocals([1, 0])
+        assert 'must not be 0' in str(e.value)
+
+    @pytest.mark.skipif(os.environ.get('LONG') is None, reason="LONG")
+    def test_check_reciprocals_exhaustive(self):
+        c = LibCrush()
+        assert c.check_reciprocals(range(1, 0x20001)) == 0
+        r = random.Random(2)
+        assert c.check_reciprocals([r.randint(1, 0xffffffff) for _ in range(100000)]) == 0
+
+    def test_reciprocals_mapping(self):
+        r = random.Random(3)
+        weight = [0, 1, 0x100, 0xffff, 0x10000, 0x12345, 0x1000000]
+        hosts = []
+        for h in range(20):
+            hosts.append({
+                "type": "host",
+                "id": -(h + 2),
+                "name": "host%d" % h,
+                "children": [
+                    {"id": 10 * h + d, "name": "device%d" % (10 * h + d),
+                     "weight": r.choice(weight) if d % 3 == 0 else r.randint(1, 0x100000)}
+                    for d in range(10)
+                ],
+            })
+        crushmap = {
+            "trees": [{"type": "root", "id": -1, "name": "dc1", "children": hosts}],
+            "rules": {
+                "data": [
+                    ["take", "dc1"],
+                    ["chooseleaf", "firstn", 0, "type", "host"],
+                    ["emit"]
+                ],
+            }
+        }
+        choose_args = [
+            {"bucket_name": "host%d" % h,
+             "weight_set": [[r.randint(0, 0x100000) for d in range(10)] for p in range(2)]}
+            for h in range(0, 20, 2)
+        ]
+        division = LibCrush(reciprocals=0)
+        assert division.parse(crushmap)
+        reciprocal = LibCrush()
+        assert reciprocal.parse(crushmap)
+        values = range(20000)
+
+        def same(**kwargs):
+            expected = division.map_batch(rule="data", values=values, replication_count=3,
+                                          **kwargs)
+            mapped = reciprocal.map_batch(rule="data", values=values, replication_count=3,
+                                          **kwargs)
+            assert bytes(expected) == bytes(mapped)
+
+        same()
+        same(choose_args=choose_args)
+        compiled = {}
+        for c in (division, reciprocal):
+            compiled[c] = c.compile_choose_args(choose_args)
+            c.update_choose_args_weight_set(compiled[c], {
+                "bucket_name": "host0", "weight_set": [[0x10000] * 5 + [0x30000] * 5]})
+        expected = division.map_batch(rule="data", values=values, replication_count=3,
+                                      choose_args=compiled[division])
+        mapped = reciprocal.map_batch(rule="data", values=values, replication_count=3,
+                                      choose_args=compiled[reciprocal])
+        assert bytes(expected) == bytes(mapped)
+
+    def test_map_workspace(self):
+        crushmap = {
+            "trees": [
+                {
+                    "type": "root",
+                    "id": -1,
+                    "name": "dc1",
+                    "children": [
+                        {"id": i, "name": "device%d" % i, "weight": 0x10000} for i in range(40)
+                    ],
+                }
+            ],
+            "rules": {
+                "firstn": [["take", "dc1"], ["choose", "firstn", 0, "type", 0], ["emit"]],
+                "indep": [["take", "dc1"], ["choose", "indep", 0, "type", 0], ["emit"]],
+            }
+        }
+        c = LibCrush()
+        for i in range(2):
+            assert c.parse(crushmap)
+            # replication counts larger than the workspace allocated by
+            # parse() and smaller again, with the same and different values
+            for replication_count in (3, 1, 20, 3, 40, 2):
+                for rule in ("firstn", "indep"):
+                    for value in (0, 1, 0, 1234):
+                        mapped = c.map(rule=rule, value=value,
+                                       replication_count=replication_count)
+                        batch = c.map_batch(rule=rule, values=[value],
+                                            replication_count=replication_count)
+                        expected = array.array('i', bytes(batch))
+                        mapped = [ITEM_NONE if name is None else int(name[6:])
+                                  for name in mapped]
+                        mapped += [ITEM_NONE] * (replication_count - len(mapped))
+                        assert mapped == list(expected)
+
+    @staticmethod
+    def straw2_crushmap(size, weight=lambda i: 0x10000 + i * 37):
+        return {
+            "trees": [{
+                "type": "root",
+                "id": -1,
+                "name": "dc1",
+                "children": [
+                    {"id": i, "name": "device%d" % i, "weight": weight(i)} for i in range(size)
+                ],
+            }],
+            "rules": {
+                "data": [["take", "dc1"], ["choose", "firstn", 0, "type", 0], ["emit"]],
+            }
+        }
+
+    def test_straw2_block(self):
+        r = random.Random(4)
+        for size in (1, 4, 63, 64, 65, 200):
+            weights = [0, 1, 0x10000, r.randint(1, 0x100000)]
+            crushmap = self.straw2_crushmap(size, lambda i: r.choice(weights))
+            choose_args = [{"bucket_name": "dc1",
+                            "ids": [r.randint(-1000, 1000) for i in range(size)],
+                            "weight_set": [[r.randint(0, 0x100000) for i in range(size)]]}]
+            for kwargs in ({}, {"choose_args": choose_args}):
+                mapped = {}
+                for straw2_block in (0, 1):
+                    for reciprocals in (0, 1):
+                        c = LibCrush(straw2_block=straw2_block, reciprocals=reciprocals)
+                        assert c.parse(crushmap)
+                        mapped[(straw2_block, reciprocals)] = bytes(c.map_batch(
+                            rule="data", values=range(2000), replication_count=min(3, size),
+                            **kwargs))
+                assert len(set(mapped.values())) == 1
+
+    def test_interleave(self):
+        r = random.Random(5)
+        for size in (1, 3, 65):
+            weights = [0, 1, 0x10000, r.randint(1, 0x100000)]
+            crushmap = self.straw2_crushmap(size, lambda i: r.choice(weights))
+            crushmap["rules"]["indep"] = [["take", "dc1"], ["choose", "indep", 0, "type", 0],
+                                          ["emit"]]
+            choose_args = [{"bucket_name": "dc1",
+                            "ids": [r.randint(-1000, 1000) for i in range(size)],
+                            "weight_set": [[r.randint(0, 0x100000) for i in range(size)]
+                                           for position in range(2)]}]
+            values = [r.randint(-0x80000000, 0x7fffffff) for i in range(1000)]
+            for rule in ("data", "indep"):
+                for kwargs in ({}, {"choose_args": choose_args}):
+                    mapped = {}
+                    for interleave in (0, 1):
+                        c = LibCrush(interleave=interleave)
+                        assert c.parse(crushmap)
+                        mapped[interleave] = bytes(c.map_batch(
+                            rule=rule, values=values, replication_count=min(3, size),
+                            **kwargs))
+                    assert mapped[0] == mapped[1]
+
+    def test_straw2_cache(self):
+        r = random.Random(6)
+        crushmap = {
+            "trees": [{
+                "type": "root",
+                "id": -1,
+                "name": "dc1",
+                "children": [{
+                    "type": "host",
+                    "id": -2 - h,
+                    "name": "host%d" % h,
+                    "children": [
+                        {"id": h * 8 + i, "name": "device%d" % (h * 8 + i), "weight": 0x10000}
+                        for i in range(8)
+                    ],
+                } for h in range(9)],
+            }],
+            "rules": {
+                "firstn": [["take", "dc1"], ["chooseleaf", "firstn", 0, "type", "host"],
+                           ["emit"]],
+                "indep": [["take", "dc1"], ["chooseleaf", "indep", 0, "type", "host"],
+                          ["emit"]],
+            }
+        }
+        values = [r.randint(-0x80000000, 0x7fffffff) for i in range(500)]
+        c = LibCrush()
+        cache = c.compile_straw2_cache(values, 2, 1 << 30)
+        assert c.straw2_cache_info(cache) == {"budget": 1 << 30, "allocated": 0, "buckets": []}
+        for i in range(6):
+            weight_set = [[r.choice([0, 1, 0x10000, r.randint(1, 0x100000)]) for i in range(9)]
+                          for position in range(3)]
+            crushmap["choose_args"] = {"1": [{"bucket_id": -1, "weight_set": weight_set}]}
+            assert c.parse(crushmap)
+            weights = {"device%d" % r.randint(0, 71): 0.5}
+            for rule in ("firstn", "indep"):
+                kwargs = {"rule": rule, "values": values, "replication_count": 3,
+                          "weights": weights, "choose_args": "1"}
+                expected = bytes(c.map_batch(**kwargs))
+                assert bytes(c.map_batch(straw2_cache=cache, **kwargs)) == expected
+                assert bytes(c.map_batch(straw2_cache=cache, threads=3, **kwargs)) == expected
+                assert (c.histogram(straw2_cache=cache, **kwargs) ==
+                        c.histogram(**kwargs))
+        info = c.straw2_cache_info(cache)
+        assert sorted(info["buckets"]) == list(range(-10, 0))
+        root_size = 500 * 2 * (8 * 9 + 1) + 4 * 9
+        host_size = 500 * 2 * (8 * 8 + 1) + 4 * 8
+        assert info["allocated"] == root_size + 9 * host_size
+
+        # the table of a bucket which ids change is dropped
+        crushmap["choose_args"]["1"][0]["ids"] = list(range(100, 109))
+        assert c.parse(crushmap)
+        kwargs = {"rule": "firstn", "values": values, "replication_count": 2,
+                  "choose_args": "1"}
+        assert bytes(c.map_batch(straw2_cache=cache, **kwargs)) == bytes(c.map_batch(**kwargs))
+        assert c.straw2_cache_info(cache)["allocated"] == info["allocated"]
+
+        # the least recently used tables are evicted to fit in the budget
+        small = c.compile_straw2_cache(values, 2, root_size)
+        assert bytes(c.map_batch(straw2_cache=small, **kwargs)) == bytes(c.map_batch(**kwargs))
+        assert c.straw2_cache_info(small)["buckets"] == [-1]
+        crushmap["rules"]["host0"] = [["take", "host0"], ["choose", "indep", 0, "type", 0],
+                                      ["emit"]]
+        assert c.parse(crushmap)
+        kwargs["rule"] = "host0"
+        assert bytes(c.map_batch(straw2_cache=small, **kwargs)) == bytes(c.map_batch(**kwargs))
+        assert c.straw2_cache_info(small)["buckets"] == [-2]
+
+        with pytest.raises(RuntimeError) as e:
+            c.map_batch(straw2_cache=small, rule="host0", values=values[1:], replication_count=2)
+        assert 'other values' in str(e.value)
+        with pytest.raises(TypeError) as e:
+            c.histogram(straw2_cache="something", rule="host0", values=values,
+                        replication_count=2)
+        assert 'compile_straw2_cache' in str(e.value)
+
+    def test_map_record(self):
+        r = random.Random(7)
+        crushmap = {
+            "trees": [{
+                "type": "root",
+                "id": -1,
+                "name": "dc1",
+                "children": [{
+                    "type": "host",
+                    "id": -2 - h,
+                    "name": "host%d" % h,
+                    "weight": 4 * 0x10000,
+                    "children": [
+                        {"id": h * 4 + i, "name": "device%d" % (h * 4 + i), "weight": 0x10000}
+                        for i in range(4)
+                    ],
+                } for h in range(6)],
+            }],
+            "rules": {
+                "firstn": [["take", "dc1"], ["chooseleaf", "firstn", 0, "type", "host"],
+                           ["emit"]],
+                "indep": [["take", "dc1"], ["chooseleaf", "indep", 0, "type", "host"],
+                          ["emit"]],
+            }
+        }
+        values = [r.randint(-0x80000000, 0x7fffffff) for i in range(2000)]
+        c = LibCrush()
+        assert c.parse(crushmap)
+        for rule in ("firstn", "indep"):
+            kwargs = {"rule": rule, "values": values, "replication_count": 3}
+            m = c.map_record(**kwargs)
+            assert bytes(c.mapping_results(m)) == bytes(c.map_batch(**kwargs))
+            assert c.mapping_histogram(m) == c.histogram(**kwargs)
+            assert bytes(c.mapping_results(c.map_record(threads=3, **kwargs))) == \
+                bytes(c.mapping_results(m))
+            info = c.mapping_info(m)
+            assert (info["rule"], info["replication_count"], info["values"]) == (rule, 3, 2000)
+            assert (info["overflow"], info["remapped"]) == (0, 0)
+
+            # only the values that chose from host2 are mapped again
+            crushmap["choose_args"] = {"1": [{"bucket_id": -4,
+                                              "weight_set": [[0x10000, 0x20000, 0x5000, 0]]}]}
+            assert c.parse(crushmap)
+            kwargs["choose_args"] = "1"
+            remapped = c.remap(m, [-4], choose_args="1", threads=2)
+            assert bytes(c.mapping_results(remapped)) == bytes(c.map_batch(**kwargs))
+            assert 0 < c.mapping_info(remapped)["remapped"] < 2000
+            assert c.mapping_histogram(remapped) == c.histogram(**kwargs)
+
+            # a device removed from a straw2 bucket with an explicit weight
+            del crushmap["trees"][0]["children"][3]["children"][1]
+            assert c.parse(crushmap)
+            removed = c.remap(remapped, [13], choose_args="1")
+            assert bytes(c.mapping_results(removed)) == bytes(c.map_batch(**kwargs))
+            assert c.mapping_info(removed)["remapped"] < c.mapping_info(remapped)["remapped"]
+            crushmap["trees"][0]["children"][3]["children"].insert(
+                1, {"id": 13, "name": "device13", "weight": 0x10000})
+            del crushmap["choose_args"]
+            assert c.parse(crushmap)
+
+        # the values which ids were not all recorded are always mapped again
+        crushmap["tunables"] = {"choose_total_tries": 200}
+        crushmap["rules"]["devices"] = [["take", "host0"], ["choose", "firstn", 0, "type", 0],
+                                        ["emit"]]
+        assert c.parse(crushmap)
+        weights = {"device1": 0.0, "device2": 0.0, "device3": 0.0}
+        m = c.map_record(rule="devices", values=values[:10], replication_count=3,
+                         weights=weights)
+        assert c.mapping_info(m)["overflow"] == 10
+        assert c.mapping_info(c.remap(m, [], weights=weights))["remapped"] == 10
+
+        with pytest.raises(TypeError) as e:
+            c.mapping_results("something")
+        assert 'map_record' in str(e.value)
+
+    def test_stats(self):
+        crushmap = {
+            "trees": [{
+                "type": "root",
+                "id": -1,
+                "name": "dc1",
+                "children": [{
+                    "type": "host",
+                    "id": -2 - h,
+                    "name": "host%d" % h,
+                    "children": [
+                        {"id": h * 4 + i, "name": "device%d" % (h * 4 + i), "weight": 0x10000}
+                        for i in range(4)
+                    ],
+                } for h in range(3)],
+            }],
+            "rules": {
+                "firstn": [["take", "dc1"], ["choose", "firstn", 0, "type", 0], ["emit"]],
+                "indep": [["take", "dc1"], ["choose", "indep", 0, "type", 0], ["emit"]],
+                "host": [["take", "dc1"], ["chooseleaf", "firstn", 0, "type", "host"],
+                         ["emit"]],
+            }
+        }
+        c = LibCrush()
+        assert c.parse(crushmap)
+        values = range(1000)
+        weights = {"device0": 0.0, "device5": 0.5}
+        for rule in ("firstn", "indep"):
+            stats = {}
+            kwargs = {"rule": rule, "values": values, "replication_count": 4, "weights": weights}
+            mapped = c.map_batch(stats=stats, **kwargs)
+            chosen = sum(1 for row in mapped.tolist() for device in row if device != 0x7fffffff)
+            choose_tries = list(stats["choose_tries"])
+            assert len(choose_tries) == 51
+            assert sum(choose_tries) == chosen
+            assert stats["tries"] == sum(n * choose_tries[n] for n in range(51)) + chosen
+            assert stats["rejects"] > 0 and stats["collisions"] > 0
+            assert stats["local_retries"] == 0
+            # the devices collide in the host they are chosen from
+            assert stats["bucket_collisions"][0] == 0
+            assert sum(stats["bucket_collisions"]) == stats["collisions"]
+            for name in ("histogram", "map_record"):
+                other = {}
+                getattr(c, name)(stats=other, threads=3, **kwargs)
+                for key in ("tries", "local_retries", "rejects", "collisions"):
+                    assert other[key] == stats[key]
+                for key in ("choose_tries", "bucket_collisions"):
+                    assert list(other[key]) == list(stats[key])
+
+        # three hosts cannot hold four replicas
+        stats = {}
+        c.map_batch(rule="host", values=values, replication_count=4, stats=stats)
+        assert stats["bucket_collisions"][0] >= 1000 * 47
+
+        # legacy tunables retry in the same bucket
+        crushmap["tunables"] = {"choose_local_tries": 2, "choose_local_fallback_tries": 5}
+        c = LibCrush(backward_compatibility=True)
+        assert c.parse(crushmap)
+        stats = {}
+        c.map_batch(rule="firstn", values=values, replication_count=4, weights=weights,
+                    stats=stats)
+        assert stats["local_retries"] > 0
+
+        with pytest.raises(TypeError) as e:
+            c.map_batch(rule="firstn", values=values, replication_count=4, stats=[])
+        assert 'must be a dict' in str(e.value)
+
+    @pytest.mark.skipif(os.environ.get('LONG') is None, reason="LONG")
+    def test_straw2_block_benchmark(self):
+        for size in (4, 16, 64, 256, 1024, 4096):
+            crushmap = self.straw2_crushmap(size)
+            values = range(max(2000, 400000 // size))
+            result = {}
+            for straw2_block in (0, 1):
+                c = LibCrush(straw2_block=straw2_block)
+                assert c.parse(crushmap)
+
+                def run():
+                    return bytes(c.map_batch(rule="data", values=values, replication_count=1))
+                result[straw2_block] = min(timeit.repeat(run, number=1, repeat=3)) / len(values)
+                assert run() == result.setdefault("mapped", run())
+            print("straw2 bucket of %d items: %d ns scalar, %d ns by blocks" % (
+                size, result[0] * 1e9, result[1] * 1e9))
+
+    @pytest.mark.skipif(os.environ.get('LONG') is None, reason="LONG")
+    def test_map_overhead(self):
+        #
+        # The rule only traverses the small tree and the cost of a
+        # map() call must not depend on the number of buckets in the
+        # unrelated big tree.
+        #
+        def tree(name, id, hosts):
+            children = []
+            for h in range(hosts):
+                id -= 1
+                children.append({
+                    "type": "host",
+                    "id": id,
+                    "name": "%s-host%d" % (name, h),
+                    "children": [
+                        {"id": 2 * len(devices) + i,
+                         "name": "%s-device%d-%d" % (name, h, i),
+                         "weight": 0x10000} for i in range(2)
+                    ],
+                })
+                devices.append(None)
+            return {"type": "root", "id": id - 1, "name": name, "children": children}
+
+        rules = {
+            "data": [
+                ["take", "small"],
+                ["chooseleaf", "firstn", 0, "type", "host"],
+                ["emit"]
+            ]
+        }
+        devices = []
+        small = {"trees": [tree("small", 0, 10)], "rules": rules}
+        devices = []
+        big = {"trees": [tree("small", 0, 10), tree("big", -100, 20000)], "rules": rules}
+        result = {}
+        for name, crushmap in (("small", small), ("big", big)):
+            c = LibCrush()
+            assert c.parse(crushmap)
+
+            def run():
+                for value in range(1000):
+                    c.map(rule="data", value=value, replication_count=3)
+            result[name] = min(timeit.repeat(run, number=1, repeat=5)) / 1000
+            print("map() on the %s map: %d ns per call" % (name, result[name] * 1e9))
+        assert result["big"] < result["small"] * 2
+
     def test_convert(self):
         c = LibCrush(verbose=1)
         crushmap = c.ceph_read("tests/sample-ceph-crushmap.txt")
@@ -1076,6 +2217,23 @@ class TestLibCrush(object):
         crushmap = c.ceph_read("tests/sample-ceph-crushmap.crush")
         assert 'devices' in crushmap
 
+    def test_ceph_load(self):
+        data = open("tests/sample-ceph-crushmap.crush", "rb").read()
+        c = LibCrush(backward_compatibility=1)
+        assert c.ceph_load(data) is True
+        assert ["device1"] == c.map(rule="data", value=1234, replication_count=3, choose_args="1")
+        assert 'devices' in c.ceph_read_binary(data)
+        # Ceph tunables require backward_compatibility, parse() explains why
+        assert LibCrush().ceph_load(data) is False
+        with pytest.raises(RuntimeError) as e:
+            c.ceph_load(b"not a crushmap")
+        assert 'not a binary Ceph crushmap' in str(e.value)
+        with pytest.raises(RuntimeError) as e:
+            c.map(rule="data", value=1234, replication_count=3)
+        assert 'parse()' in str(e.value)
+        with pytest.raises(TypeError):
+            c.ceph_load(u"not bytes")
+
     def test_pool_pps(self):
         c = LibCrush()
 
@@ -1088,6 +2246,30 @@ class TestLibCrush(object):
         pps_2_values = sorted(set(pps_2.values()))
         assert pps_1_values == pps_2_values
 
+    def test_pools_pps(self):
+        c = LibCrush()
+
+        (pools, pss, ppss) = c.ceph_pools_pps([(0, 16, 16), (3, 23, 16)])
+        for a in (pools, pss, ppss):
+            assert 'i' == a.format
+            assert 16 + 23 == len(a)
+        assert [0] * 16 + [3] * 23 == pools.tolist()
+        assert list(range(16)) + list(range(23)) == pss.tolist()
+        for (pool, pg_num, pgp_num) in ((0, 16, 16), (3, 23, 16)):
+            expected = c.ceph_pool_pps(pool, pg_num, pgp_num)
+            for i in range(len(pools)):
+                if pools[i] == pool:
+                    assert expected["%d.%x" % (pool, pss[i])] == ppss[i]
+
+        (pools, pss, ppss) = c.ceph_pools_pps([])
+        assert 0 == len(pools)
+
+        with pytest.raises(RuntimeError) as e:
+            c.ceph_pools_pps([(0, 16, 0)])
+        assert 'pgp_num 0' in str(e.value)
+        with pytest.raises(TypeError):
+            c.ceph_pools_pps([(0, 16)])
+
     def test_ceph_incompat(self):
         c = LibCrush(verbose=1)
 
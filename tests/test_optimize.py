@@ -317,6 +317,43 @@ class TestOptimize(object):
         (count, crushmap) = a.optimize(crushmap)
         assert 240 == count
 
+    def test_optimize_multithread(self):
+        crushmap = {
+            "trees": [{
+                "type": "root",
+                "id": -1,
+                "name": "dc1",
+                "children": [{
+                    "type": "host",
+                    "id": -2 - h,
+                    "name": "host%d" % h,
+                    "weight": (3 * h + 6) * 0x10000,
+                    "children": [
+                        {"id": h * 3 + i, "name": "device%d" % (h * 3 + i),
+                         "weight": (h + i + 1) * 0x10000}
+                        for i in range(3)
+                    ],
+                } for h in range(3)],
+            }],
+            "rules": {
+                "data": [["take", "dc1"], ["chooseleaf", "firstn", 0, "type", "host"],
+                         ["emit"]],
+            }
+        }
+        p = [
+            '--values-count', '100',
+            '--replication-count', '2',
+            '--rule', 'data',
+            '--choose-args', 'optimize',
+            '--no-positions',
+        ]
+        o = Main().constructor(['optimize', '--no-multithread'] + p)
+        (count, expected) = o.optimize(copy.deepcopy(crushmap))
+        o = Main().constructor(['optimize'] + p)
+        assert o.args.multithread
+        assert (count, expected) == o.optimize(copy.deepcopy(crushmap))
+        assert len(expected['choose_args']['optimize']) == 4
+
     def test_optimize_report_compat_one_pool(self):
         #
         # verify --choose-args is set to --pool when the crushmap contains
@@ -0,0 +1,119 @@
+# -*- mode: python; coding: utf-8 -*-
+#
+# Copyright (C) 2017 <contact@redhat.com>
+#
+# Author: Loic Dachary <loic@dachary.org>
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+#
+import logging
+import pytest # noqa needed for caplog
+
+from crush import Crush
+from crush.main import Main
+from crush.profile import Profile
+
+logging.basicConfig(format='%(asctime)s %(levelname)s %(message)s',
+                    level=logging.DEBUG)
+
+
+class TestProfile(object):
+
+    def make_crushmap(self, hosts_count):
+        return {
+            "trees": [{
+                "type": "root",
+                "name": "dc1",
+                "children": [{
+                    "type": "host",
+                    "name": "host%d" % h,
+                    "algorithm": "list" if h == 0 else "straw2",
+                    "children": [
+                        {"id": h * 3 + i, "name": "device%d" % (h * 3 + i), "weight": 0x10000}
+                        for i in range(3)
+                    ],
+                } for h in range(hosts_count)],
+            }],
+            "rules": {
+                "firstn": [["take", "dc1"], ["chooseleaf", "firstn", 0, "type", "host"],
+                           ["emit"]],
+                "indep": [["take", "dc1"], ["chooseleaf", "indep", 0, "type", "host"],
+                          ["emit"]],
+            }
+        }
+
+    def make_profile(self, crushmap, p):
+        a = Main().constructor(['profile', '--values-count', '1000', '--repeat', '1'] + p)
+        a.args.crushmap = crushmap
+        return a
+
+    def test_sanity_check_args(self):
+        a = Main().constructor([
+            'profile',
+        ])
+        with pytest.raises(Exception) as e:
+            a.pre_sanity_check_args()
+        assert 'missing --crushmap' in str(e.value)
+
+        a = Main().constructor([
+            'profile', '--crushmap', 'crushmap.json', '--tunables', 'jewel',
+        ])
+        with pytest.raises(Exception) as e:
+            a.pre_sanity_check_args()
+        assert '--tunables jewel requires backward compatibility' in str(e.value)
+        a.args.backward_compatibility = True
+        a.pre_sanity_check_args()
+
+    def test_collect_algorithms(self):
+        c = Crush()
+        c.parse(self.make_crushmap(3))
+        assert Profile.collect_algorithms(c, "firstn") == "list:1 straw2:3"
+
+    def test_profile(self):
+        a = self.make_profile(self.make_crushmap(3), [
+            '--replication-count', '2',
+            '--replication-count', '4',
+            '--tunables', 'crushmap',
+            '--tunables', 'argonaut',
+        ])
+        a.args.backward_compatibility = True
+        (d, retries) = a.profile()
+        assert len(d) == 2 * 2 * 2
+        assert list(d.index.names) == ['rule', 'replicas', 'tunables']
+        assert (d['ns/mapping'] > 0).all()
+        # three hosts cannot hold four replicas
+        assert d.loc[('firstn', 2, 'crushmap'), 'failed'] == 0
+        assert d.loc[('firstn', 4, 'crushmap'), 'failed'] == 1000
+        assert d.loc[('firstn', 4, 'crushmap'), 'collisions'] > 0
+        # each chosen host and device is counted in the retry distribution
+        assert retries.loc[('indep', 2, 'crushmap')].sum() == 1000 * 2 * 2
+        assert retries.loc[('firstn', 2, 'argonaut')].sum() == 1000 * 2 * 2
+        assert 'Number of items chosen after N failed descents' in a.profile_report(d, retries)
+
+    def test_baseline(self, tmpdir):
+        path = str(tmpdir.join('baseline.json'))
+        c = Crush()
+        c.parse(self.make_crushmap(3))
+        c.to_file(path)
+        a = self.make_profile(self.make_crushmap(30), [
+            '--rule', 'firstn',
+            '--replication-count', '3',
+            '--baseline', path,
+            '--outlier-factor', '0.01',
+        ])
+        (d, retries) = a.profile()
+        assert len(d) == 1
+        assert d['ratio'].iloc[0] > 0.01
+        assert d['slower'].all()
+        assert a.run() == 1